@@ -0,0 +1,206 @@
+"""
+Benchmarks of the stages of the loading of a sequence: merging of the images,
+encoding, packing of the fields (the old convlen/bitstobytes and DMDPacking),
+framing of the commands, and the whole defsequence on a simulated DMD (see
+DMDSimulator), with a few kinds of patterns:
+
+    black        all the pixels off
+    light sheet  the stripes of pattern/ligth_sheet/ligth_sheet.encd
+    random       random pixels, the worst case for the encoder
+    hadamard     Walsh-Hadamard patterns on blocks of 8x8 pixels
+
+The results are printed (or saved with --output) as JSON, to compare versions:
+
+    python -m DMD_ScopeFoundry.DMDBenchmark --repeat 5 --output results.json
+
+The old per pixel encoders (DMDDevice.encode and DmdDeviceHID.new_encode_loop)
+take tens of seconds for each image, so they are measured only with --legacy.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import numpy
+from DMD_ScopeFoundry import DMDDeviceHID
+from DMD_ScopeFoundry.DMDDeviceHID import (DmdDeviceHID, mergeimages, new_encode, new_encode_loop, encode_image,
+                                           frame_command, convlen, bitstobytes)
+from DMD_ScopeFoundry.DMDEncodedFile import load_legacy
+from DMD_ScopeFoundry.DMDPacking import pack_u16, pattern_entry
+from DMD_ScopeFoundry.DMDSimulator import SimulatedDevice, decode_image, image_planes
+
+HEIGHT = 1080
+WIDTH = 1920
+LIGHT_SHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pattern', 'ligth_sheet', 'ligth_sheet.encd')
+
+def black_planes():
+
+    return [numpy.zeros((HEIGHT, WIDTH), dtype = bool) for i in range(24)]
+
+def light_sheet_planes():
+    """
+    The planes of the first encoded group of the light sheet file in pattern/.
+    """
+    num, encodedimages, sizes = load_legacy(LIGHT_SHEET)
+    planes = image_planes(decode_image(bytes(bytearray(encodedimages[0]))))
+
+    return planes[:num]
+
+def random_planes(seed = 0):
+
+    generator = numpy.random.default_rng(seed)
+
+    return [generator.random((HEIGHT, WIDTH)) < 0.5 for i in range(24)]
+
+def hadamard_planes(block = 8):
+    """
+    Rows 1-24 of a Walsh-Hadamard matrix, each one shown on the blocks of
+    block x block pixels of the DMD (the sign of row k at column c is the
+    parity of the bits in common between k and c).
+    """
+    y, x = numpy.indices((HEIGHT, WIDTH))
+    cells = (y//block)*(WIDTH//block) + x//block
+    planes = []
+    for k in range(1, 25):
+        common = cells & k
+        parity = numpy.zeros(cells.shape, dtype = numpy.uint8)
+        while common.any():
+            parity ^= (common & 1).astype(numpy.uint8)
+            common >>= 1
+        planes.append(parity.astype(bool))
+
+    return planes
+
+INPUTS = {'black': black_planes,
+          'light sheet': light_sheet_planes,
+          'random': random_planes,
+          'hadamard': hadamard_planes}
+
+def measure(function, repeat = 5, number = 1):
+    """
+    Calls function number times for repeat times, and returns the statistics
+    of the time of a call, in seconds.
+    """
+    times = []
+    for r in range(repeat):
+        t = time.perf_counter()
+        for n in range(number):
+            function()
+        times.append((time.perf_counter() - t)/number)
+
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'repeat': repeat, 'number': number}
+
+def packing_benchmarks(repeat):
+
+    results = []
+    results.append(dict(measure(lambda: bitstobytes(convlen(504, 16)), repeat, 10000),
+                        name = 'convlen + bitstobytes', input = 'u16'))
+    results.append(dict(measure(lambda: pack_u16(504), repeat, 10000),
+                        name = 'pack_u16', input = 'u16'))
+    results.append(dict(measure(lambda: pattern_entry(5, 100000, 1, '111', False, 0, True, 3, 7), repeat, 10000),
+                        name = 'pattern_entry', input = 'pattern'))
+
+    packet = bytes(504)
+    frames = frame_command('w', 0x11, 0x1a, 0x2b, packet, pack_u16(504))
+    results.append(dict(measure(lambda: frame_command('w', 0x11, 0x1a, 0x2b, packet, pack_u16(504), frames), repeat, 10000),
+                        name = 'frame_command', input = '504 bytes'))
+
+    dmd = DmdDeviceHID(device = SimulatedDevice())
+    results.append(dict(measure(dmd.stopsequence, repeat, 1000),
+                        name = 'command + checkforerrors', input = 'stop sequence'))
+
+    return results
+
+def image_benchmarks(name, planes, repeat, groups, legacy):
+
+    results = []
+    merged = mergeimages(planes)
+    encoded, size = new_encode(merged)
+    raw = merged.nbytes
+
+    results.append(dict(measure(lambda: mergeimages(planes), repeat),
+                        name = 'mergeimages', input = name))
+
+    backends = ['numpy'] + (['numba'] if DMDDeviceHID.numba is not None else [])
+    for backend in backends:
+        new_encode(merged, backend) #compiles the numba functions
+        results.append(dict(measure(lambda: new_encode(merged, backend), repeat),
+                            name = 'new_encode ({})'.format(backend), input = name,
+                            bytes = size, ratio = raw/size))
+
+    chosen, chosensize = encode_image(merged)
+    results.append(dict(measure(lambda: encode_image(merged), repeat),
+                        name = 'encode_image', input = name, compression = int(chosen[25]),
+                        bytes = chosensize, ratio = raw/chosensize))
+    
+    if legacy:
+        results.append(dict(measure(lambda: new_encode_loop(merged), 1),
+                            name = 'new_encode_loop', input = name, bytes = size, ratio = raw/size))
+        try:
+            from DMD_ScopeFoundry.DMDDevice import encode
+        except ImportError: #DMDDevice needs pyusb
+            pass
+        else:
+            results.append(dict(measure(lambda: encode(merged), 1),
+                                name = 'DMDDevice.encode', input = name))
+
+    images = planes*groups
+    num = len(images)
+    def load():
+        dmd = DmdDeviceHID(device = SimulatedDevice(decode = False))
+        #without dedup the repeated planes would be uploaded only once
+        dmd.defsequence(images, [100000]*num, [False]*num, [0]*num, [True]*num, 0, dedup = False)
+    result = measure(load, repeat)
+    result.update(name = 'defsequence', input = name, patterns = num,
+                  patterns_per_second = num/result['median'])
+    results.append(result)
+
+    return results
+
+def run(inputs = None, repeat = 5, groups = 4, legacy = False):
+    """
+    Runs all the benchmarks, and returns the results as a dictionary. What the
+    functions measured print is discarded.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = packing_benchmarks(repeat)
+        for name in inputs or INPUTS:
+            results += image_benchmarks(name, INPUTS[name](), repeat, groups, legacy)
+
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'numba': getattr(DMDDeviceHID.numba, '__version__', None),
+            'encoder backend': DMDDeviceHID.ENCODER_BACKEND,
+            'encoder version': DMDDeviceHID.ENCODER_VERSION,
+            'processors': os.cpu_count(),
+            'results': results}
+
+def main(args = None):
+
+    parser = argparse.ArgumentParser(description = "Benchmarks of the encoding and loading of DMD patterns.")
+    parser.add_argument('--repeat', type = int, default = 5, help = "repetitions of each measure")
+    parser.add_argument('--groups', type = int, default = 4, help = "groups of 24 patterns loaded by defsequence")
+    parser.add_argument('--inputs', nargs = '+', choices = list(INPUTS), help = "kinds of patterns (all by default)")
+    parser.add_argument('--legacy', action = 'store_true', help = "measure also the old per pixel encoders (slow)")
+    parser.add_argument('--output', help = "JSON file of the results (printed by default)")
+    args = parser.parse_args(args)
+
+    results = run(args.inputs, args.repeat, args.groups, args.legacy)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent = 1)
+    else:
+        json.dump(results, sys.stdout, indent = 1)
+        print ()
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,86 @@
+"""
+On disk cache of the encoded images.
+
+Each encoded image is stored in a file named after its key (a hash of the merged
+image and of the version of the encoder, see DMDDeviceHID.encoded_key), so that
+loading again a sequence of patterns already seen skips the encoding.
+
+The least recently used files are deleted when the total size of the cache
+exceeds maxsize. The cache is only an help: if a file cannot be written or read
+(e.g. because another process is using it), the image is simply encoded again.
+"""
+
+import os
+import threading
+import numpy
+
+class EncodedCache:
+
+    def __init__(self, directory, maxsize = 1 << 30):
+
+        self.directory = directory
+        self.maxsize = maxsize #bytes
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+
+        return os.path.join(self.directory, key + '.bin')
+
+    def get(self, key):
+        """
+        Returns the encoded image stored with key and its size, or None if it is
+        not in the cache.
+        """
+        path = self.path(key)
+        try:
+            encoded = numpy.fromfile(path, dtype = numpy.uint8)
+            os.utime(path) #it is now the most recently used
+        except OSError:
+            return None
+
+        return encoded, len(encoded)
+
+    def put(self, key, encoded):
+        """
+        Stores an encoded image, and deletes the least recently used ones if the
+        cache is too big.
+        """
+        path = self.path(key)
+        temp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident()) #a file for each writer
+        try:
+            numpy.asarray(encoded, dtype = numpy.uint8).tofile(temp)
+            os.replace(temp, path) #the other processes never see a half written file
+        except OSError:
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used images until the cache is smaller than maxsize.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.bin'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(entry[1] for entry in entries)
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def size(self):
+        """
+        Total size of the images in the cache, in bytes.
+        """
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.bin'))
@@ -21,6 +21,8 @@ import PIL.Image
 import pickle
 import os
 import usb.backend.libusb1 as libusb1
+from DMD_ScopeFoundry.DMDPacking import (pack_u16, pack_u32, pattern_entry, lut_config,
+                                         setbmp_payload)
 
 class DmdDevice:
     
@@ -36,17 +38,12 @@ class DmdDevice:
     def command(self,mode,sequencebyte,com1,com2,data=None):
         buffer = []
 
-        flagstring=''
         if mode=='r':
-            flagstring+='1'
+            buffer.append(0xc0)
         else:
-            flagstring+='0'        
-        flagstring+='1000000'
-        buffer.append(bitstobytes(flagstring)[0])
+            buffer.append(0x40)
         buffer.append(sequencebyte)
-        temp=bitstobytes(convlen(len(data)+2,16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
+        buffer.extend(pack_u16(len(data)+2))
         buffer.append(com2)
         buffer.append(com1)
 
@@ -155,71 +152,15 @@ class DmdDevice:
 
 
     def configurelut(self,imgnum,repeatnum):
-        img=convlen(imgnum,11)
-        repeat=convlen(repeatnum,32)
 
-        string=repeat+'00000'+img
-
-        im_bytes=bitstobytes(string)
-
-        self.command('w',0x00,0x1a,0x31,im_bytes)
+        self.command('w',0x00,0x1a,0x31,lut_config(imgnum,repeatnum))
         self.checkforerrors()
 
     def definepattern(self,index,exposure,bitdepth,color,triggerin,darktime, triggerout,patind,bitpos):
-        payload=[]
-        index=convlen(index,16)
-        index=bitstobytes(index)
-        for i in index:
-            payload.append(i)
-
-        exposure=convlen(exposure,24) #24 or 32?
-        exposure=bitstobytes(exposure)
-        for i in exposure:
-            payload.append(i)
-            
-        optionsbyte=''
-        #optionsbyte+='0'*8 #I put this line. I dont know if it's right. see the manual
-        optionsbyte+='1'
-        bitdepth=convlen(bitdepth-1,3)
-        optionsbyte=bitdepth+optionsbyte
-        optionsbyte=color+optionsbyte
-        if triggerin:
-            optionsbyte='1'+optionsbyte
-        else:
-            optionsbyte='0'+optionsbyte
-
-        payload.append(bitstobytes(optionsbyte)[0])
-
-        darktime=convlen(darktime,24)
-        darktime=bitstobytes(darktime)
-        for i in darktime:
-            payload.append(i)
-
-        triggerout=convlen(not triggerout,8)
-        triggerout=bitstobytes(triggerout)
-        for i in triggerout:
-            payload.append(i)
-
-        patind=convlen(patind,11)
-        bitpos=convlen(bitpos,5)
-        lastbits=bitpos+patind
-        lastbits=bitstobytes(lastbits)
-        for i in lastbits:
-            payload.append(i)
-
-        trigg1 = convlen(0,1)
-        trigg1 = bitstobytes(trigg1)
-        trigg2 = convlen(0, 16)
-        trigg2 = bitstobytes(trigg2)
-        trigg3 = convlen(20, 16)
-        trigg3 = bitstobytes(trigg3)
-        triggering = []
-        for i in trigg1:
-            triggering.append(i)
-        for i in trigg2:
-            triggering.append(i)
-        for i in trigg3:
-            triggering.append(i)
+        
+        payload=pattern_entry(index,exposure,bitdepth,color,triggerin,darktime,triggerout,patind,bitpos)
+
+        triggering=[0x00]+list(pack_u16(0))+list(pack_u16(20))
         self.command('w', 0x00, 0x1a, 0x1e, triggering)
         self.command('w',0x00,0x1a,0x34,payload)
         self.checkforerrors()
@@ -227,19 +168,8 @@ class DmdDevice:
     
 
     def setbmp(self,index,size):
-        payload=[]
-
-        index=convlen(index,5)
-        index='0'*11+index
-        index=bitstobytes(index)
-        for i in index:
-            payload.append(i) 
-
-
-        total=convlen(size,32)
-        total=bitstobytes(total)
-        for i in total:
-            payload.append(i)         
+        
+        payload=setbmp_payload(index,size)
         
         self.command('w',0x00,0x1a,0x2a,payload)
         #self.command('w',0x00,0x1a,0x2c,payload) #read page 57 of programmer guide
@@ -251,7 +181,7 @@ class DmdDevice:
 
     def bmpload(self,image,size):
 
-        t=time.clock()
+        t=time.perf_counter()
 
         packnum=int(size//504)+1
 
@@ -262,19 +192,12 @@ class DmdDevice:
             if i %100==0:
                 print (i,packnum)
                 
-            payload=[]
-            
             if i<packnum-1:
-                leng=convlen(504,16)
                 bits=504
             else:
-                leng=convlen(size%504,16)
                 bits=size%504
                 
-            leng=bitstobytes(leng)
-            
-            for j in range(2):
-                payload.append(leng[j])
+            payload=list(pack_u16(bits))
                 
             for j in range(bits):
                 payload.append(image[counter])
@@ -284,7 +207,7 @@ class DmdDevice:
             #self.command('w',0x11,0x1a,0x2d,payload) #read page 57 of programmer guide
             self.checkforerrors()
             
-        print("Time for loading: ", time.clock()-t)
+        print("Time for loading: ", time.perf_counter()-t)
 
 #     def save_encoded_sequence(self, images):
 #         
@@ -370,7 +293,7 @@ class DmdDevice:
 
         encodedimages=[]
         sizes=[]
-        t=time.clock()
+        t=time.perf_counter()
 
         for i in range(int((num-1)//24)+1):
             print ('merging...')
@@ -395,7 +318,7 @@ class DmdDevice:
                 for j in range(i*24,num):
                     self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
         
-        print ("Time for merging and encoding: ", time.clock()-t)
+        print ("Time for merging and encoding: ", time.perf_counter()-t)
         self.configurelut(num,rep)
 
         for i in range(int((num-1)//24)+1): #for i in range(len(encodedimages)) should work?
@@ -403,7 +326,7 @@ class DmdDevice:
             print ('uploading...')
             self.bmpload(encodedimages[int((num-1)//24)-i],sizes[int((num-1)//24)-i])
             
-        print ("Total time: ", time.clock()-t)
+        print ("Total time: ", time.perf_counter()-t)
 
 def save_encoded_sequence(images, folder, name):
     
@@ -506,21 +429,9 @@ def new_encode(image):
     bitstring.append(0x6c)
     bitstring.append(0x64)
     
-    width=convlen(1920,16)
-    width=bitstobytes(width)
-    for i in width:
-        bitstring.append(i)
-
-    height=convlen(1080,16)
-    height=bitstobytes(height)
-    for i in height:
-        bitstring.append(i)
-
-
-    total=convlen(0,32)
-    total=bitstobytes(total)
-    for i in total:
-        bitstring.append(i)        
+    bitstring.extend(pack_u16(1920)) #width
+    bitstring.extend(pack_u16(1080)) #height
+    bitstring.extend(pack_u32(0)) #total size, written at the end
 
     for i in range(8):
         bitstring.append(0xff)
@@ -755,10 +666,7 @@ def new_encode(image):
 
     print (size)
 
-    total=convlen(size,32)
-    total=bitstobytes(total)
-    for i in range(len(total)):
-        bitstring[i+8]=total[i]    
+    bitstring[8:12]=pack_u32(size)
     
     
     return bitstring, bytecount
@@ -777,21 +685,9 @@ def encode(image):
     bitstring.append(0x6c)
     bitstring.append(0x64)
     
-    width=convlen(1920,16)
-    width=bitstobytes(width)
-    for i in width:
-        bitstring.append(i)
-
-    height=convlen(1080,16)
-    height=bitstobytes(height)
-    for i in height:
-        bitstring.append(i)
-
-
-    total=convlen(0,32)
-    total=bitstobytes(total)
-    for i in total:
-        bitstring.append(i)        
+    bitstring.extend(pack_u16(1920)) #width
+    bitstring.extend(pack_u16(1080)) #height
+    bitstring.extend(pack_u32(0)) #total size, written at the end
 
     for i in range(8):
         bitstring.append(0xff)
@@ -946,10 +842,7 @@ def encode(image):
 
     print (size)
 
-    total=convlen(size,32)
-    total=bitstobytes(total)
-    for i in range(len(total)):
-        bitstring[i+8]=total[i]    
+    bitstring[8:12]=pack_u32(size)
 
     return bitstring, bytecount
 
@@ -19,102 +19,161 @@ For the detailed comprehension of the code, please refer to the manual (search D
 20/02/19
 """
 
-import hid
 import time
 import numpy
 import os
-import pickle
+import functools
+import hashlib
+import queue
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
+from multiprocessing import shared_memory
+from threading import Thread
+from DMD_ScopeFoundry.DMDPacking import (pack_u16, pattern_entry, lut_config, 
+                                         setbmp_payload, image_header,
+                                         UNCOMPRESSED, RLE, ENHANCED_RLE)
+from DMD_ScopeFoundry.DMDStats import ProtocolStats
+from DMD_ScopeFoundry.DMDLut import PatternLut, pattern_payloads, check_patterns
+from DMD_ScopeFoundry.DMDLayout import PlaneLayout
+from DMD_ScopeFoundry.DMDEncodedFile import (EncodedFile, is_encoded_file, 
+                                             load_legacy, write_encoded)
+
+try:
+    import hid #only needed to talk to the DMD: the encoding works without it
+except ImportError:
+    hid = None
+
+try:
+    import numba #optional, it makes the encoding run at memory speed
+except ImportError:
+    numba = None
+
+def instrumented(method):
+    """
+    Records the time, the bytes and reports written and the answers read during
+    each call of a method of DmdDeviceHID in its stats (see DMDStats), if any.
+    """
+    name=method.__name__
+    
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if self.stats is None:
+            return method(self,*args,**kwargs)
+        with self.stats.measure(name):
+            return method(self,*args,**kwargs)
+    
+    return wrapper
 
 class DmdDeviceHID:
     
-    def __init__(self):
-        
-        hid.enumerate()
-        self.device = hid.Device(vid=0x0451, pid=0xc900)
-        time.sleep(0.5)
+    def __init__(self, device=None):
+        """
+        Opens the DMD. Another object with the write and read methods of hid.Device
+        can be given as device (e.g. DMDSimulator.SimulatedDevice, to work without the DMD).
+        """
+        if device is not None:
+            self.device = device
+        else:
+            if hid is None:
+                raise ImportError("The hid package (hidapi) is needed to connect to the DMD.")
+            hid.enumerate()
+            self.device = hid.Device(vid=0x0451, pid=0xc900)
+            time.sleep(0.5)
         #self.device.open(0x0451, 0xc900) #open the communication
         #self.device.open(0x0145, 0x022E) #open the communication
         # print(self.device.get_manufacturer_string())
         # print(self.device.get_product_string())
         # print(self.device.get_serial_number_string())
         self.ans = []
-
+        self.ackwindow = 1 #packets of bmpload sent before reading an answer, see bmpload
+        self.cache = None #DMDCache.EncodedCache where the encoded images are kept, if any
+        self.stats = ProtocolStats() #timing of the operations, None to not record it
+        self.lut = None #DMDLut.PATTERN array of the patterns of the sequence loaded, see updatelut
+        self.lutrepeat = 0
+        self.imagenum = 0 #images uploaded with the sequence
+        self.state = 'stop'
+
+    @instrumented
     def command(self,mode,sequencebyte,com1,com2,data=None):
-        buffer = []
-
-        flagstring=''
-        if mode=='r':
-            flagstring+='1'
-        else:
-            flagstring+='0'        
-        flagstring+='1000000' #the one indicates we want an answer by the device.
-        buffer.append(0x0)
-        buffer.append(bitstobytes(flagstring)[0])
-        buffer.append(sequencebyte)
-        temp=bitstobytes(convlen(len(data)+2,16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
-        buffer.append(com2) 
-        buffer.append(com1)
-
-        if len(buffer)+len(data)<=65: #65 = max number of sent bytes 
+        """
+        Sends a command to the device. All the reports are built at once by 
+        frame_command, and then written one by one.
+        """
+        self.write_frames(frame_command(mode,sequencebyte,com1,com2,data))
         
-            for i in data:
-                buffer.append(i)
-
-            for i in range(65-len(buffer)):
-                buffer.append(0x00)
-
-
-            self.device.write(buffer)
-
-        else:
-            for i in range(65-len(buffer)):
-                buffer.append(data[i])
-
-            self.device.write(buffer)
-
-            buffer = [0x00]
-
-            j=0
-            while j<len(data)-58:
-                buffer.append(data[j+58])
-                j=j+1
-                if j%64==0: #we need 64 instead of 65
-                    self.device.write(buffer)
-
-                    buffer = [0x00]
-
-            if j%64!=0:
-
-                while j%64!=0:
-                    buffer.append(0x00)
-                    j=j+1
-                    
-                self.device.write(buffer)               
+    def write_frames(self,frames):
+        
+        frames=memoryview(frames)
+        
+        for i in range(0,len(frames),REPORT_SIZE):
+            self.device.write(bytes(frames[i:i+REPORT_SIZE]))
+        
+        if self.stats is not None:
+            self.stats.written(len(frames),len(frames)//REPORT_SIZE)
+    
+    def read(self,size):
+        """
+        Reads an answer of the device (a round trip, for the stats).
+        """
+        if self.stats is not None:
+            self.stats.read()
+        
+        return self.device.read(size)
                 
 
+    @instrumented
     def checkforerrors(self):
         """
         This part needs to be checked
         """
-        self.ans = self.device.read(1)
-        self.flag = convlen(self.ans[0], 8)
-        #print(self.flag)
+        self.ans = self.read(1)
+        #print(self.ans[0])
 #         length = convlen(self.ans[3], 8)
 #         length = length+convlen(self.ans[4], 8)
 #         print(length)
 #         num = int(length, 2)
 #         print(num)
 #         self.device.read(num)
-        if self.flag[2]=="1":
+        if self.ans[0] & 0x20: #error flag
             print("An error occurred! --> ", self.ans)
-            self.command('r',0x22,0x01,0x00,[])
-            self.error = self.device.read(1)
-
-            self.command('r',0x22,0x01,0x01,[])
-            self.response = self.device.read(128)
+            self.readerror()
+            return True
         #print(self.response)
+        return False
+        
+    def checkanswers(self,count):
+        """
+        Reads the answers of the last count commands (sent asking for an answer, but
+        without reading it): True if any of them has the error flag, and then the
+        error is read as in checkforerrors.
+        """
+        failed=[i for i in range(count) if self.read(1)[0] & 0x20]
+        if failed:
+            print("An error occurred! --> in the commands", failed, "of the last", count)
+            self.readerror()
+            return True
+        
+        return False
+        
+    def readerror(self):
+        
+        self.command('r',0x22,0x01,0x00,[])
+        self.error = self.read(1)
+
+        self.command('r',0x22,0x01,0x01,[])
+        self.response = self.read(128)
+        
+    @instrumented
+    def errorcode(self):
+        """
+        Reads the error code register of the DLPC900 (0 means no error, see the
+        programmer's guide for the others).
+        """
+        self.command('r',0x22,0x01,0x00,[])
+        self.ans = self.read(64)
+        
+        return self.ans[4]
 
 
 
@@ -162,69 +221,29 @@ class DmdDeviceHID:
     def startsequence(self):
         self.command('w',0x00,0x1a,0x24,[2])
         self.checkforerrors()
+        self.state='start'
 
     def pausesequence(self):
         self.command('w',0x00,0x1a,0x24,[1])
         self.checkforerrors()
+        self.state='pause'
 
     def stopsequence(self):
         self.command('w',0x00,0x1a,0x24,[0])
         self.checkforerrors()
+        self.state='stop'
 
 
+    @instrumented
     def configurelut(self,imgnum,repeatnum):
-        img=convlen(imgnum,11)
-        repeat=convlen(repeatnum,32)
-
-        string=repeat+'00000'+img
-
-        im_bytes=bitstobytes(string)
         
-        self.command('w',0x00,0x1a,0x31,im_bytes)
+        self.command('w',0x00,0x1a,0x31,lut_config(imgnum,repeatnum))
         self.checkforerrors()
         
+    @instrumented
     def definepattern(self,index,exposure,bitdepth,color,triggerin,darktime, triggerout,patind,bitpos):
         
-        payload=[]
-        index=convlen(index,16)
-        index=bitstobytes(index)
-        for i in index:
-            payload.append(i)
-
-        exposure=convlen(exposure,24) #24 or 32?
-        exposure=bitstobytes(exposure)
-        for i in exposure:
-            payload.append(i)
-            
-        optionsbyte=''
-        #optionsbyte+='0'*8 #I put this line. I dont know if it's right. see the manual
-        optionsbyte+='1'
-        bitdepth=convlen(bitdepth-1,3)
-        optionsbyte=bitdepth+optionsbyte
-        optionsbyte=color+optionsbyte
-        if triggerin:
-            optionsbyte='1'+optionsbyte
-        else:
-            optionsbyte='0'+optionsbyte
-
-        payload.append(bitstobytes(optionsbyte)[0])
-
-        darktime=convlen(darktime,24)
-        darktime=bitstobytes(darktime)
-        for i in darktime:
-            payload.append(i)
-
-        triggerout=convlen(not triggerout,8)
-        triggerout=bitstobytes(triggerout)
-        for i in triggerout:
-            payload.append(i)
-
-        patind=convlen(patind,11)
-        bitpos=convlen(bitpos,5)
-        lastbits=bitpos+patind
-        lastbits=bitstobytes(lastbits)
-        for i in lastbits:
-            payload.append(i)
+        payload=pattern_entry(index,exposure,bitdepth,color,triggerin,darktime,triggerout,patind,bitpos)
 
 #         trigg1 = convlen(0,1)
 #         trigg1 = bitstobytes(trigg1)
@@ -243,149 +262,381 @@ class DmdDeviceHID:
         self.command('w',0x00,0x1a,0x34,payload)
         self.checkforerrors()
         
+    @instrumented
+    def definepatterns(self,lut,indices=None):
+        """
+        Defines all the patterns of a PatternLut (or of a DMDLut.PATTERN array), 
+        checked before sending anything. The definitions are sent back to back, 
+        MAX_ANSWERS at a time, and then the answers to them are read together,
+        checking the error flag of each (as bmpload does with an ack window: the
+        error code register tells only about the last definition). If there is an
+        error, the patterns are defined again one by one with definepattern, to 
+        know which one is wrong.
+        
+        The patterns are defined as the 0...n-1 patterns of the LUT, or as the 
+        patterns in indices if they are given (see updatelut).
+        
+        Returns True if the device reported an error.
+        """
+        entries=lut.array() if isinstance(lut,PatternLut) else check_patterns(lut)
+        if len(entries)==0:
+            return False
+        
+        template=numpy.frombuffer(frame_command('w',0x00,0x1a,0x34,bytes(12)),dtype=numpy.uint8)
+        frames=numpy.tile(template,(len(entries),1)) #a definition fills a single report
+        frames[:,7:19]=pattern_payloads(entries,indices)
+        
+        for i in range(0,len(entries),MAX_ANSWERS):
+            chunk=frames[i:i+MAX_ANSWERS]
+            self.write_frames(chunk.reshape(-1))
+            if self.checkanswers(len(chunk)):
+                break
+        else:
+            return False
+        
+        print("Defining again the patterns one by one...")
+        if indices is None:
+            indices=range(len(entries))
+        for j,e in zip(indices,entries):
+            self.definepattern(int(j),*(int(e[name]) for name in e.dtype.names))
+        
+        return True
+    
+    @instrumented
+    def updatelut(self,lut,rep=None):
+        """
+        Changes the patterns of the sequence already loaded (e.g. their exposure or
+        dark time) without uploading again the images: only the patterns different
+        from the ones defined last time are sent, and then the LUT is configured 
+        again (with the same number of repeats if rep is None). The patterns can refer
+        only to the images uploaded with the sequence. If the sequence was running,
+        it is started again.
+        
+        Returns the indices of the patterns sent.
+        """
+        if self.lut is None:
+            raise RuntimeError("No sequence loaded: use defsequence or def_sequence_by_file first.")
+        
+        entries=lut.array() if isinstance(lut,PatternLut) else check_patterns(lut)
+        if rep is None:
+            rep=self.lutrepeat
+        if len(entries) and entries['patind'].max()>=self.imagenum:
+            raise ValueError("The patterns refer to image {}, but only {} images are loaded".format(
+                entries['patind'].max(),self.imagenum))
+        
+        common=min(len(entries),len(self.lut))
+        changed=numpy.flatnonzero(entries[:common]!=self.lut[:common])
+        changed=numpy.concatenate((changed,numpy.arange(common,len(entries))))
+        
+        running=self.state=='start'
+        self.stopsequence()
+        
+        error=self.definepatterns(entries[changed],changed)
+        self.configurelut(len(entries),rep)
+        self.lut=None if error else entries.copy() #after an error, better to load everything again
+        self.lutrepeat=rep
+        
+        if running:
+            self.startsequence()
+        
+        return changed
+        
+    @instrumented
     def setbmp(self,index,size):
-        payload=[]
-
-        index=convlen(index,5)
-        index='0'*11+index
-        index=bitstobytes(index)
-        for i in index:
-            payload.append(i) 
-
-
-        total=convlen(size,32)
-        total=bitstobytes(total)
-        for i in total:
-            payload.append(i)         
+        
+        payload=setbmp_payload(index,size)
         
         self.command('w',0x00,0x1a,0x2a,payload)
         #self.command('w',0x00,0x1a,0x2c,payload) #read page 57 of programmer guide
         self.checkforerrors()
         
-    def bmpload(self,image,size):
-
-        t=time.clock()
+    @instrumented
+    def bmpload(self,image,size,ackwindow=None):
+        """
+        Uploads an encoded image in packets of 504 bytes (with the 2 bytes of their
+        length and the 6 of the header they fill exactly 8 reports). The image can be
+        a bytes, bytearray or numpy.uint8 buffer: each packet is a memoryview slice
+        of it, copied straight into a report buffer that is reused for all the packets.
+        
+        With ackwindow = 1 (self.ackwindow by default) the answer of the device is read
+        after every packet, as usual. With ackwindow = N > 1 the packets are sent back
+        to back, and the answers of the last N packets are read together every N
+        packets (and after the last one), checking the error flag of each of them: the
+        error code register tells only about the last command, so a packet in the 
+        middle of a window that fails would not be seen reading it. The hid library
+        keeps at most MAX_ANSWERS answers not read yet, so the window is not larger
+        than that; ackwindow = 0 means the largest window.
+        
+        Returns True if the device reported an error.
+        """
+        if ackwindow is None:
+            ackwindow=self.ackwindow
+        window=min(ackwindow or MAX_ANSWERS,MAX_ANSWERS)
+        
+        t=time.perf_counter()
 
+        image=as_buffer(image)
         packnum=int(size//504)+1
-
-        counter=0
+        frames=None
+        error=False
 
         for i in range(packnum):
             
             if i %100==0:
                 print (i,packnum)
-                
-            payload=[]
             
             if i<packnum-1:
-                leng=convlen(504,16)
                 bits=504
             else:
-                leng=convlen(size%504,16)
                 bits=size%504
-                
-            leng=bitstobytes(leng)
             
-            for j in range(2):
-                payload.append(leng[j])
-                
-            for j in range(bits):
-                payload.append(image[counter])
-                counter+=1
-
-            self.command('w',0x11,0x1a,0x2b,payload) #0x11 is for a response, IDK if we need it
+            frames=frame_command('w',0x11,0x1a,0x2b,image[i*504:i*504+bits],pack_u16(bits),frames) #0x11 is for a response, IDK if we need it
+            self.write_frames(frames)
 
             #self.command('w',0x11,0x1a,0x2d,payload) #read page 57 of programmer guide
-            self.checkforerrors()
-        print("Time for loading: ", time.clock()-t)
+            if window==1:
+                error=self.checkforerrors() or error
+            elif (i+1)%window==0 or i==packnum-1:
+                if self.checkanswers(i%window+1):
+                    error=True
+                    break
+        
+        print("Time for loading: ", time.perf_counter()-t)
+        
+        return error
+    
+    @instrumented
+    def uploadimage(self,index,image,size):
+        """
+        Uploads an encoded image as the index-th image of the sequence (setbmp +
+        bmpload). If the device reports an error while the packets are sent with 
+        an ack window, the upload is repeated reading the answer to every packet.
+        """
+        self.setbmp(index,size)
+        print ('uploading...')
+        
+        if self.bmpload(image,size) and self.ackwindow!=1:
+            print ('uploading again checking every packet...')
+            self.setbmp(index,size)
+            self.bmpload(image,size,1)
 
-    def defsequence(self,images,exp,ti,dt,to,rep):
+    @instrumented
+    def defsequence(self,images,exp,ti,dt,to,rep,workers=None,dedup=True,pack=False):
 
         self.stopsequence()
 
-        arr=[]
-
-        for i in images:
-            arr.append(i)
-
-##        arr.append(numpy.ones((1080,1920),dtype='uint8'))
-        num=len(arr)
+        if hasattr(images,'read'):
+            arr=images #read a group at a time by encode_groups (e.g. DMDPatterns.PatternFiles)
+            num=len(arr)
+        elif hasattr(images,'__len__'):
+            arr=list(images)
+            num=len(arr)
+        else:
+            arr=images #an iterator (e.g. DMDPatterns.read_patterns), streamed by encode_groups
+            num=len(exp)
 
-        encodedimages=[]
-        sizes=[]
-        t=time.clock()
+        t=time.perf_counter()
+        self.timings={'encode':[],'upload':[],'first upload':None}
+        self.compressions=Counter() #images uploaded by compression (see encode_image)
         
-        self.configurelut(num,rep)
+        lut=PatternLut.sequence(exp[:num],ti,dt,to).array() #checked before sending anything
+        self.lut=None
         
-        for i in range(int((num-1)//24)+1):
-            print ('merging...')
-            if i<(int((num-1)//24)):
-                imagedata=mergeimages(arr[i*24:(i+1)*24])
-            else:
-                imagedata=mergeimages(arr[i*24:])
-            
-
-            print('encoding...')
-            
-            imagedata,size=new_encode(imagedata)
-            
-
-            encodedimages.append(imagedata)
-            sizes.append(size)
-
-            if i<(int((num-1)//24)):
-                for j in range(i*24,(i+1)*24):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
-            else:
-                for j in range(i*24,num):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
+        """
+        With dedup the patterns repeated in the sequence are uploaded only once:
+        only the planes never seen before are merged and encoded, and the LUT 
+        points each pattern to the image and bit of its plane (see DMDLayout).
+        With an iterator the layout is complete only when all the images have
+        been read, i.e. when the first group to upload is ready. The images that
+        are read only when needed are all read once to find the repeated ones
+        (only if dedup), and the new ones are read again when they are encoded.
+        With pack the planes are uploaded in the order that makes the encoded 
+        images smaller (see PlaneLayout.pack), and the LUT keeps the order of 
+        the sequence.
+        """
+        layout=PlaneLayout(dedup)
+        if hasattr(arr,'read') and not pack:
+            planes=arr.subset(layout.select(arr))
+        else:
+            planes=layout.unique(arr)
+            if hasattr(images,'__len__') and not hasattr(images,'read'):
+                planes=list(planes)
+            if pack:
+                planes=layout.pack(planes)
         
-        print ("Time for merging and encoding: ", time.clock()-t)
+        def definelut():
+            if len(layout)!=num:
+                raise ValueError("{} patterns for {} exposures".format(len(layout),num))
+            lut['patind'],lut['bitpos']=layout.positions()
+            if layout.duplicates:
+                print (layout.duplicates, 'repeated patterns, not uploaded again')
+            self.configurelut(num,rep)
+            self.definepatterns(lut)
         
+        """
+        The groups are encoded starting from the last one, since the DLPC900 wants
+        them in reverse order, and each one is passed to the upload thread as soon 
+        as it is ready: in this way the usb link works while the next groups are 
+        read and encoded. (If the images come from an iterator, they are all encoded
+        before uploading the last group, see encode_stream, unless pack keeps them.)
+        """
+        encoded=queue.Queue()
+        self.upload_error=None
+        uploader=None
+        
+        try:
+            print ('merging and encoding...')
+            for index,imagedata,size,duration in encode_groups(planes,workers,reverse=True,cache=self.cache):
+                self.timings['encode'].append(duration)
+                self.compressions[{UNCOMPRESSED:'uncompressed',RLE:'rle',ENHANCED_RLE:'enhanced rle'}[int(imagedata[25])]]+=1
+                if uploader is None:
+                    definelut()
+                    uploader=Thread(target=self.upload_queue,args=(encoded,t))
+                    uploader.start()
+                encoded.put((index,imagedata,size))
+            if uploader is None: #no images
+                definelut()
+        finally:
+            if uploader is not None:
+                encoded.put(None)
+                uploader.join()
+        
+        if self.upload_error is not None:
+            raise self.upload_error
+        
+        self.lut,self.lutrepeat,self.imagenum=lut,rep,(int(lut['patind'].max())+1 if num else 0)
+        
+        self.timings['total']=time.perf_counter()-t
+        print ("Time for merging and encoding: ", sum(self.timings['encode']))
+        print ("Time for uploading: ", sum(self.timings['upload']))
+        print ("First upload started after: ", self.timings['first upload'])
+        print ("Total time: ", self.timings['total'])
+        print ("Compression of the images: ", dict(self.compressions))
+        
+    def upload_queue(self,encoded,t):
+        """
+        Uploads the encoded groups put in the queue by defsequence, until None is
+        found. It runs in a separate thread, and it records the time of each upload
+        in self.timings.
+        """
+        try:
+            while True:
+                group=encoded.get()
+                if group is None:
+                    break
+                
+                index,imagedata,size=group
+                start=time.perf_counter()
+                if self.timings['first upload'] is None:
+                    self.timings['first upload']=start-t
+                    
+                self.uploadimage(index,imagedata,size)
+                self.timings['upload'].append(time.perf_counter()-start)
+                
+        except Exception as error:
+            self.upload_error=error
 
-        for i in range(int((num-1)//24)+1): #for i in range(len(encodedimages)) should work?
-            self.setbmp(int((num-1)//24)-i,sizes[int((num-1)//24)-i])
-            print ('uploading...')
-            self.bmpload(encodedimages[int((num-1)//24)-i],sizes[int((num-1)//24)-i])
-            
-        print ("Total time: ", time.clock()-t)
-
+    @instrumented
     def def_sequence_by_file(self,files,exp,ti,dt,to,rep):
         """
         Function that define the sequence of images on the pattern by fetching
-        the encoding and all other necessary data from an .encd file.
+        the encoding and all other necessary data from an .encd file. 
+        
+        The version 2 files (see DMDEncodedFile) are streamed: each group is mapped
+        only while it is uploaded, straight from the mapping, so the memory used does
+        not depend on the length of the sequence. The old pickled files are still 
+        accepted, but they are loaded all at once.
         """
         self.stopsequence()
         
-        files = pickle.load(open(files, "rb"))
-        
-        number_images = files[0]
-        encoded_images = files[1]
-        images_sizes = files[2]
-        
-        exp = exp*number_images
-        ti = ti*number_images
-        dt = dt*number_images
-        to = to*number_images
+        if is_encoded_file(files):
+            encoded=EncodedFile(files)
+            number_images=encoded.num
+        else:
+            print ('old .encd file, loading all of it (see DMDEncodedFile.convert_legacy)...')
+            number_images,encoded_images,images_sizes=load_legacy(files)
+            encoded=None
         
-        for i in range(int((number_images-1)//24)+1):
+        try:
+            exp = exp*number_images
+            ti = ti*number_images
+            dt = dt*number_images
+            to = to*number_images
             
-            if i<(int((number_images-1)//24)):
-                for j in range(i*24,(i+1)*24):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
-            else:
-                for j in range(i*24,number_images):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
-                    
-        self.configurelut(number_images,rep)
-
-        for i in range(int((number_images-1)//24)+1): 
-            self.setbmp(int((number_images-1)//24)-i,images_sizes[int((number_images-1)//24)-i])
-            print ('uploading...')
-            self.bmpload(encoded_images[int((number_images-1)//24)-i],images_sizes[int((number_images-1)//24)-i])
+            lut=PatternLut.sequence(exp[:number_images],ti,dt,to).array()
+            self.lut=None
+            self.definepatterns(lut)
+                        
+            self.configurelut(number_images,rep)
+    
+            for i in reversed(range((number_images-1)//24+1)):
+                if encoded is not None:
+                    self.uploadimage(i,encoded[i],encoded.sizes[i])
+                else:
+                    self.uploadimage(i,encoded_images[i],images_sizes[i])
+            
+            self.lut,self.lutrepeat,self.imagenum=lut,rep,(number_images+23)//24
+        finally:
+            if encoded is not None:
+                encoded.close()
         
         return number_images
             
+REPORT_SIZE = 65 #report id (0x00) + 64 bytes, the max number of sent bytes
+MAX_ANSWERS = 30 #answers not read yet kept by hidapi (the older ones are dropped)
+
+def as_buffer(data):
+    """
+    Returns a flat memoryview of bytes on data, without copying it when it is
+    already a bytes, bytearray, memoryview or numpy.uint8 array (lists, like the
+    ones of the old .encd files, are converted once).
+    """
+    if data is None:
+        return memoryview(b'')
+    if isinstance(data,numpy.ndarray):
+        return memoryview(numpy.ascontiguousarray(data,dtype=numpy.uint8)).cast('B')
+    if isinstance(data,(bytes,bytearray,memoryview)):
+        return memoryview(data).cast('B')
+    return memoryview(bytes(data))
+
+def frame_command(mode,sequencebyte,com1,com2,data=None,prefix=b'',frames=None,answer=True):
+    """
+    Builds all the hid reports of a command in a single preallocated bytearray.
+    The 6 bytes of the header (flags, sequence byte, length and command), the 
+    prefix and the data are split in chunks of 64 bytes (the last one padded with
+    zeros), and each chunk is preceded by the report id 0x00. If answer is False,
+    the device is asked not to answer to the command.
+    
+    The data are copied as memoryview slices straight into the reports. If frames
+    has the right size it is reused (bmpload uses the same one for all the packets).
+    """
+    data=as_buffer(data)
+    
+    length=len(prefix)+len(data)
+    flags=0x80 if mode=='r' else 0x00
+    if answer:
+        flags|=0x40 #this bit indicates we want an answer by the device.
+    head=bytes((flags,sequencebyte))+pack_u16(length+2)+bytes((com2,com1))+bytes(prefix)
+    start=len(head)
+    total=start+len(data)
+    reports=(total+63)//64
+    
+    if frames is None or len(frames)!=reports*REPORT_SIZE:
+        frames=bytearray(reports*REPORT_SIZE)
+        
+    frames[1:1+start]=head
+    
+    for i in range(reports):
+        begin=max(64*i,start)
+        end=min(64*(i+1),total)
+        frames[i*REPORT_SIZE]=0x00
+        frames[i*REPORT_SIZE+1+begin-64*i:i*REPORT_SIZE+1+end-64*i]=data[begin-start:end-start]
+    
+    if total%64:
+        frames[-(64-total%64):]=bytes(64-total%64)
+    
+    return frames
+
 def convlen(a,l):
     """
     This function converts a number "a" into a bit string of
@@ -414,31 +665,835 @@ def bitstobytes(a):
 
     return bytelist
 
-def mergeimages(images):
+def mergeimages(images, bitdepth = 1, out = None):
     """
-    function that encodes a 8 bit numpy array matrix as a enhanced run length encoded string of bits
+    Merges the images in a single 24 bit image (1080x1920x3): the image i takes the
+    bits from i*bitdepth to (i+1)*bitdepth-1, where the bits 0-7 are in the third
+    channel, 8-15 in the second one and 16-23 in the first one.
+    
+    The 1 bit images are packed 8 at a time in a byte with shifts, without big
+    temporary arrays; the images with more bits are packed in a uint32. The result
+    is written in out, if given, so that the same buffer can be used for all the groups.
     """
-    mergedimage=numpy.zeros((1080,1920,3),dtype='uint8') #put this as numpy.uint8?
+    if len(images)*bitdepth > 24:
+        raise ValueError("{} images of {} bits do not fit in 24 bits".format(len(images), bitdepth))
+    
+    height, width = numpy.shape(images[0])
+    if out is None:
+        out = numpy.empty((height, width, 3), dtype = numpy.uint8)
+    
+    if bitdepth == 1:
+        byte = numpy.empty((height, width), dtype = numpy.uint8)
+        plane = numpy.empty((height, width), dtype = numpy.uint8)
+        for c in range(3):
+            byte[:] = 0
+            for i, image in enumerate(images[8*c:8*(c+1)]):
+                numpy.left_shift(numpy.asarray(image, dtype = bool).view(numpy.uint8), i, out = plane)
+                byte |= plane
+            out[:,:,2-c] = byte
+            
+    else:
+        pixels = numpy.zeros((height, width), dtype = numpy.uint32)
+        for i, image in enumerate(images):
+            pixels |= (numpy.asarray(image, dtype = numpy.uint32) & ((1 << bitdepth) - 1)) << (i*bitdepth)
+        for c in range(3):
+            out[:,:,2-c] = (pixels >> (8*c)) & 0xff
+            
+    return out
 
-    for i in range(len(images)):
+ENCODE_VERTICAL = 0 #the pixels are copied from the previous row
+ENCODE_RUN = 1 #the same pixel is repeated n times
+ENCODE_LITERAL = 2 #n different pixels follow
+
+def _next_true(trues, positions, rowend):
+    """
+    trues contains the (sorted) flat indices of the pixels for which a condition
+    holds, with the total number of pixels appended at the end. For each position,
+    returns the first of these pixels at its right (itself included), without going
+    beyond the end of the row.
+    """
+    return numpy.minimum(trues[numpy.searchsorted(trues, positions)], rowend)
+
+def _next_true_all(condition, positions, rowend):
+    """
+    Same as _next_true for all the pixels (positions are the flat indices of all
+    of them), given the condition of each pixel: a cumulative minimum from the right.
+    """
+    trues = positions.copy()
+    trues[~condition] = len(positions)
+    
+    return numpy.minimum(numpy.minimum.accumulate(trues[::-1])[::-1], rowend)
+
+RUN_PASSES = 32 #passes of enhanced_rle_runs, one run per row at a time, before deciding to jump
+JUMP_PASSES = 400 #passes still needed by the longest row above which pointer jumping is faster
+
+def enhanced_rle_runs(image):
+    """
+    Finds the runs in which the enhanced rle encoder splits the image: returns the
+    flat index of the first pixel of each run (row by row), the number of pixels of
+    the run and its kind (ENCODE_VERTICAL, ENCODE_RUN or ENCODE_LITERAL).
+    
+    The decision that new_encode_loop takes for each pixel (copy from the previous
+    row, repeat the same pixel, or write different pixels) depends only on the pixel
+    itself and on its neighbours, so it is computed once on the whole image. Then,
+    starting from the first pixel, we jump from a run to the following one, for all
+    the rows at the same time. This takes a pass for each run of the longest row
+    (a fraction of ms each): if after RUN_PASSES passes the rows not finished yet
+    seem to need more than JUMP_PASSES passes (e.g. random or sparse pixels, with
+    up to a thousand runs per row), they are done by pointer jumping. The start of 
+    the following run is computed for every pixel (this costs about as much as 400
+    passes), and these links are doubled at each pass (jump = jump[jump]), marking
+    the pixels reached, so that log2 of the number of runs passes are enough.
+    
+    This is the reference when numba is not installed, and it does not encode a
+    1080x1920 frame in less than 100 ms in all cases: the frames with few runs take
+    10-60 ms, the random ones about 0.11 s, and the images with about a million
+    runs (e.g. sparse random pixels, or a random plane merged with black ones)
+    about 0.3 s for the runs and 0.1 s more for writing them (0.8 s with one pass
+    per run). Most of it is spent computing the links of all the pixels, not in the
+    jumps. The numba backend takes 10-30 ms for all of them.
+    """
+    height, width = image.shape[0], image.shape[1]
+    size = height*width
+    
+    pixels = image[:,:,0].astype(numpy.uint32) << 16
+    pixels |= image[:,:,1].astype(numpy.uint32) << 8
+    pixels |= image[:,:,2]
+    
+    horizontal = numpy.zeros((height, width), dtype = bool) #pixel j is equal to pixel j+1
+    horizontal[:,:-1] = pixels[:,1:] == pixels[:,:-1]
+    
+    vertical = numpy.zeros((height, width), dtype = bool) #pixel is equal to the one in the previous row
+    vertical[1:] = pixels[1:] == pixels[:-1]
+    
+    """
+    For the first row, the old loop compares the pixels with the last row
+    (image[i-1] with i = 0) when it decides if a single pixel has to be written,
+    so we have to do the same.
+    """
+    above = vertical.copy()
+    above[0] = pixels[0] == pixels[-1]
+    
+    single = numpy.ones((height, width), dtype = bool)
+    single[:,:-2] = horizontal[:,1:-1] | above[:,1:-1]
+    
+    literal_stop = horizontal.copy()
+    literal_stop[:,-1] = True
+    
+    vertical = vertical.ravel()
+    horizontal = horizontal.ravel()
+    literal_stop = literal_stop.ravel()
+    repeated = (horizontal | single.ravel())
+    
+    end = numpy.array([size])
+    vertical_stops = numpy.concatenate((numpy.flatnonzero(~vertical), end))
+    horizontal_stops = numpy.concatenate((numpy.flatnonzero(~horizontal), end))
+    literal_stops = numpy.concatenate((numpy.flatnonzero(literal_stop), end))
+    
+    starts = []
+    current = numpy.arange(height)*width
+    passes = 0
+    jumping = False
+    
+    while current.size and not jumping:
+        rowend = current - current % width + width
+        following = numpy.where(vertical[current], _next_true(vertical_stops, current, rowend),
+                                numpy.where(repeated[current], _next_true(horizontal_stops, current, rowend) + 1,
+                                            _next_true(literal_stops, current, rowend)))
+        starts.append(current)
+        current = following[following < rowend]
+        passes += 1
+        
+        if passes == RUN_PASSES and current.size:
+            done = current % width
+            jumping = passes*((width - done)/done).max() > JUMP_PASSES
+    
+    if jumping:
+        index = numpy.int32 if size < 2**31 - 1 else numpy.int64
+        positions = numpy.arange(size, dtype = index)
+        rowend = positions - positions % width + width
+        """
+        The link of the last run of a row points to an extra node (size), which
+        points to itself. Only the pixels where a run can start (the ones where
+        the passes above stopped, and the ones some link points to) are kept as
+        nodes, renumbered in order. At each pass, reached holds the runs at less
+        than 2**k links from the runs where the passes above stopped, and jump
+        the node 2**k links ahead.
+        """
+        following = numpy.where(vertical, _next_true_all(~vertical, positions, rowend),
+                                numpy.where(repeated, _next_true_all(~horizontal, positions, rowend) + 1,
+                                            _next_true_all(literal_stop, positions, rowend)))
+        links = numpy.append(numpy.where(following < rowend, following, size), size).astype(index)
         
-        if i<8:
-            mergedimage[:,:,2]=mergedimage[:,:,2]+images[i]*(2**i) #with the multiplication, the 8 bit pixel contains the info abopu all the 8 images (if we are in binary...)
+        nodes = numpy.zeros(size + 1, dtype = bool)
+        nodes[links] = True
+        nodes[current] = True
+        renumber = (numpy.cumsum(nodes) - 1).astype(index)
+        nodes = numpy.flatnonzero(nodes)
+        jump = renumber[links[nodes]]
+        current = renumber[current]
+        last = len(nodes) - 1 #the extra node
+        
+        reached = numpy.zeros(len(nodes), dtype = bool)
+        reached[current] = True
+        while (jump[current] != last).any():
+            reached[jump[reached]] = True
+            jump = jump[jump]
+        starts.append(nodes[:-1][reached[:-1]])
+    
+    starts = numpy.sort(numpy.concatenate(starts))
+    stops = numpy.append(starts[1:], size)
+    stops = numpy.minimum(stops, starts - starts % width + width) #the last run of a row ends with the row
+    counts = stops - starts
+    kinds = numpy.where(vertical[starts], ENCODE_VERTICAL,
+                        numpy.where(repeated[starts], ENCODE_RUN, ENCODE_LITERAL))
+    
+    return starts, counts, kinds
 
-        if i>7 and i<16:
-            mergedimage[:,:,1]=mergedimage[:,:,1]+images[i]*(2**(i-8))
+def enhanced_rle_write(image, starts, counts, kinds):
+    """
+    Writes the encoded image (header included) from the runs found by enhanced_rle_runs.
+    The position of each run in the output is given by the cumulative sum of the
+    sizes of the previous runs, so that everything is written at once.
+    """
+    height, width = image.shape[0], image.shape[1]
+    
+    twobytes = counts >= 128
+    countsize = 1 + twobytes
+    prefix = numpy.where(kinds == ENCODE_VERTICAL, 2, numpy.where(kinds == ENCODE_LITERAL, 1, 0))
+    datasize = numpy.where(kinds == ENCODE_RUN, 3, numpy.where(kinds == ENCODE_LITERAL, 3*counts, 0))
+    runsize = prefix + countsize + datasize
+    
+    ## every row ends with 0x00 0x00
+    
+    offset = numpy.cumsum(runsize) - runsize + 48 + 2*(starts // width)
+    
+    end = 48 + int(runsize.sum()) + 2*height
+    bytecount = end + 3
+    bytecount += -bytecount % 4
+    
+    bitstring = numpy.zeros(bytecount, dtype = numpy.uint8)
+    
+    bitstring[offset[kinds == ENCODE_VERTICAL] + 1] = 0x01
+    
+    countpos = offset + prefix
+    bitstring[countpos] = numpy.where(twobytes, (counts & 0x7f) | 0x80, counts)
+    bitstring[countpos[twobytes] + 1] = counts[twobytes] >> 7
+    
+    datapos = countpos + countsize
+    databefore = numpy.cumsum(datasize) - datasize
+    shift = numpy.arange(int(datasize.sum()))
+    bitstring[numpy.repeat(datapos - databefore, datasize) + shift] = \
+        image.ravel()[numpy.repeat(3*starts - databefore, datasize) + shift]
+    
+    bitstring[end + 1] = 0x01 #end of image: 0x00 0x01 0x00
+    bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount), dtype = numpy.uint8)
+    
+    return bitstring, bytecount
 
-        if i>15 and i<24: #maybe 24 because in RGB you have 8*3
-            mergedimage[:,:,0]=mergedimage[:,:,0]+images[i]*(2**(i-16))
+def _write_count(bitstring, pos, n):
+    """
+    Writes the number of pixels of a run (1 byte if < 128, otherwise 2 bytes).
+    """
+    if n >= 128:
+        bitstring[pos] = (n & 0x7f) | 0x80
+        bitstring[pos+1] = n >> 7
+        return pos + 2
+    bitstring[pos] = n
+    return pos + 1
+
+def _enhanced_rle_scan(image, pixels, bitstring):
+    """
+    Same decisions of new_encode_loop, but on the packed 24 bit pixels. It is 
+    compiled with numba when available (in pure python it is as slow as the old loop).
+    The encoded rows are written in bitstring after the 48 bytes of the header, and
+    the position of the end of the image is returned.
+    """
+    height, width = pixels.shape
+    pos = 48
+    
+    for i in range(height):
+        above = i - 1 if i > 0 else height - 1 #new_encode_loop compares the first row with the last one
+        j = 0
+        
+        while j < width:
             
-    return mergedimage
+            if i > 0 and pixels[i,j] == pixels[i-1,j]:
+                k = j + 1
+                while k < width and pixels[i,k] == pixels[i-1,k]:
+                    k += 1
+                bitstring[pos] = 0x00
+                bitstring[pos+1] = 0x01
+                pos = _write_count(bitstring, pos + 2, k - j)
+                j = k
+                
+            elif j < width - 1 and pixels[i,j] == pixels[i,j+1]:
+                k = j + 1
+                while k < width - 1 and pixels[i,k] == pixels[i,k+1]:
+                    k += 1
+                pos = _write_count(bitstring, pos, k + 1 - j)
+                for c in range(3):
+                    bitstring[pos+c] = image[i,j,c]
+                pos += 3
+                j = k + 1
+                
+            elif j >= width - 2 or pixels[i,j+1] == pixels[i,j+2] or pixels[i,j+1] == pixels[above,j+1]:
+                bitstring[pos] = 0x01
+                for c in range(3):
+                    bitstring[pos+1+c] = image[i,j,c]
+                pos += 4
+                j += 1
+                
+            else:
+                k = j
+                while k < width - 1 and pixels[i,k] != pixels[i,k+1]:
+                    k += 1
+                bitstring[pos] = 0x00
+                pos = _write_count(bitstring, pos + 1, k - j)
+                for l in range(j, k):
+                    for c in range(3):
+                        bitstring[pos+c] = image[i,l,c]
+                    pos += 3
+                j = k
+                
+        bitstring[pos] = 0x00
+        bitstring[pos+1] = 0x00
+        pos += 2
+        
+    bitstring[pos] = 0x00
+    bitstring[pos+1] = 0x01
+    bitstring[pos+2] = 0x00
+    
+    return pos + 3
+
+if numba is not None:
+    _write_count = numba.njit(cache = True)(_write_count)
+    _enhanced_rle_scan = numba.njit(cache = True)(_enhanced_rle_scan)
+    ENCODER_BACKEND = 'numba'
+else:
+    ENCODER_BACKEND = 'numpy'
 
-def new_encode(image):
+def new_encode(image, backend = None):
+    """
+    Enhanced rle encoder (see manual of TI). The output is exactly the same of 
+    new_encode_loop, byte by byte, but it takes milliseconds instead of tens of seconds:
+    10-30 ms for a 1080x1920 frame with numba, up to about 0.4 s without it (see
+    enhanced_rle_runs).
+    
+    With backend = 'numba' the rows are scanned by the compiled _enhanced_rle_scan,
+    with backend = 'numpy' the vectorized enhanced_rle_runs and enhanced_rle_write are
+    used (they are the reference when numba is not installed). By default ENCODER_BACKEND
+    is used, which is 'numba' if available.
+    
+    The images made of vertical stripes (all the rows are the same) or horizontal
+    lines (every row has a single color) are written directly, without scanning
+    them, see invariant_encode.
+    
+    The encoded image is returned as a numpy.uint8 array, together with its size.
+    """
+    if backend is None:
+        backend = ENCODER_BACKEND
+    if backend not in ('numba', 'numpy'):
+        raise ValueError("Unknown encoder backend: {}".format(backend))
+    if backend == 'numba' and numba is None:
+        raise ValueError("The numba backend needs the numba package.")
+    
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    fast = invariant_encode(image, backend)
+    
+    if fast is not None:
+        bitstring, bytecount = fast
+        
+    elif backend == 'numba':
+        height, width = image.shape[0], image.shape[1]
+        pixels = image[:,:,0].astype(numpy.uint32) << 16
+        pixels |= image[:,:,1].astype(numpy.uint32) << 8
+        pixels |= image[:,:,2]
+        
+        bitstring = numpy.zeros(48 + height*(4*width + 2) + 8, dtype = numpy.uint8) #worst case: a single pixel every 4 bytes
+        bytecount = _enhanced_rle_scan(image, pixels, bitstring)
+        bytecount += -bytecount % 4
+        bitstring = bitstring[:bytecount].copy()
+        bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount), dtype = numpy.uint8)
+        
+    else:
+        bitstring, bytecount = enhanced_rle_write(image, *enhanced_rle_runs(image))
+    
+    return bitstring, bytecount
+
+def _count_bytes(n):
+    """
+    The number of pixels of a run, as _write_count writes it.
+    """
+    return bytes(((n & 0x7f) | 0x80, n >> 7)) if n >= 128 else bytes((n,))
+
+def _encoded_rows(image, backend):
+    """
+    The encoded rows of an image (each one with its 0x00 0x00 at the end), without
+    the header and the end of the image.
+    """
+    height, width = image.shape[0], image.shape[1]
+    
+    if backend == 'numba':
+        pixels = image[:,:,0].astype(numpy.uint32) << 16
+        pixels |= image[:,:,1].astype(numpy.uint32) << 8
+        pixels |= image[:,:,2]
+        bitstring = numpy.zeros(48 + height*(4*width + 2) + 8, dtype = numpy.uint8)
+        end = _enhanced_rle_scan(image, pixels, bitstring) - 3
+        return bitstring[48:end]
+    
+    starts, counts, kinds = enhanced_rle_runs(image)
+    prefix = numpy.where(kinds == ENCODE_VERTICAL, 2, numpy.where(kinds == ENCODE_LITERAL, 1, 0))
+    datasize = numpy.where(kinds == ENCODE_RUN, 3, numpy.where(kinds == ENCODE_LITERAL, 3*counts, 0))
+    end = 48 + int((prefix + 1 + (counts >= 128) + datasize).sum()) + 2*height
+    
+    return enhanced_rle_write(image, starts, counts, kinds)[0][48:end]
+
+def stripes_encode(row, height, backend = None):
+    """
+    Encodes (as new_encode) the image made of height copies of row (width x 3
+    pixels), e.g. the merged profiles of stripes or sinusoidal bars, without
+    building the image: the first row is encoded, and each of the others is a copy
+    of the previous one. The first row is encoded as a 1 row image, since it is 
+    compared with the last row, which is the same.
+    """
+    if backend is None:
+        backend = ENCODER_BACKEND
+    
+    row = numpy.ascontiguousarray(row, dtype = numpy.uint8).reshape(1, -1, 3)
+    width = row.shape[1]
+    
+    first = _encoded_rows(row, backend)
+    copy = numpy.frombuffer(b'\x00\x01' + _count_bytes(width) + b'\x00\x00', dtype = numpy.uint8)
+    
+    end = 48 + len(first) + (height - 1)*len(copy)
+    bytecount = end + 3
+    bytecount += -bytecount % 4
+    
+    bitstring = numpy.zeros(bytecount, dtype = numpy.uint8)
+    bitstring[48:48 + len(first)] = first
+    bitstring[48 + len(first):end] = numpy.tile(copy, height - 1)
+    bitstring[end + 1] = 0x01 #end of image: 0x00 0x01 0x00
+    bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount), dtype = numpy.uint8)
+    
+    return bitstring, bytecount
+
+def lines_encode(column, width):
+    """
+    Encodes (as new_encode) the image whose row i has the color column[i] (height
+    x 3 pixels) in all its width (at least 2) pixels, e.g. horizontal lines, without
+    building the image: each row is a single run, or a copy of the previous row 
+    if it has the same color.
+    """
+    column = numpy.ascontiguousarray(column, dtype = numpy.uint8).reshape(-1, 3)
+    height = len(column)
+    
+    pixels = column[:,0].astype(numpy.uint32) << 16 | column[:,1].astype(numpy.uint32) << 8 | column[:,2]
+    same = numpy.zeros(height, dtype = bool)
+    same[1:] = pixels[1:] == pixels[:-1]
+    
+    count = numpy.frombuffer(_count_bytes(width), dtype = numpy.uint8)
+    rowsize = numpy.where(same, 2 + len(count), len(count) + 3) + 2 #with the end of row
+    offset = 48 + numpy.cumsum(rowsize) - rowsize
+    
+    end = 48 + int(rowsize.sum())
+    bytecount = end + 3
+    bytecount += -bytecount % 4
+    
+    bitstring = numpy.zeros(bytecount, dtype = numpy.uint8)
+    copies = offset[same]
+    bitstring[copies + 1] = 0x01
+    bitstring[copies[:,None] + 2 + numpy.arange(len(count))] = count
+    runs = offset[~same]
+    bitstring[runs[:,None] + numpy.arange(len(count))] = count
+    bitstring[runs[:,None] + len(count) + numpy.arange(3)] = column[~same]
+    bitstring[end + 1] = 0x01
+    bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount), dtype = numpy.uint8)
+    
+    return bitstring, bytecount
+
+def invariant_encode(image, backend = None):
+    """
+    Encodes the image with stripes_encode if all its rows are the same, or with
+    lines_encode if each row has a single color. Returns None for the other images
+    (the checks stop early, comparing first the first and the last row or column).
+    """
+    height, width = image.shape[0], image.shape[1]
+    if height < 2 or width < 2:
+        return None
+    
+    rows = image.reshape(height, -1)
+    if rows.shape[1] % 8 == 0:
+        rows = rows.view(numpy.uint64)
+    if numpy.array_equal(rows[0], rows[-1]) and (rows[1:] == rows[0]).all():
+        return stripes_encode(image[0], height, backend)
+    
+    if not numpy.array_equal(image[:,0], image[:,-1]):
+        return None
+    if width % 8 == 0:
+        """
+        A row of a single color repeats every 3 bytes, so every 24 bytes: its 
+        first 8 pixels are the same, and each 8 bytes are the same of 24 bytes before.
+        """
+        words = image.reshape(height, -1).view(numpy.uint64)
+        single = (image[:,:8] == image[:,:1]).all() and (words[:,3:] == words[:,:-3]).all()
+    else:
+        single = (image == image[:,:1]).all()
+    if single:
+        return lines_encode(image[:,0], width)
+    
+    return None
+
+def uncompressed_size(image):
+    """
+    Size of the image without compression, header included.
+    """
+    bytecount = 48 + image.shape[0]*image.shape[1]*3
+    
+    return bytecount + -bytecount % 4
+
+def uncompressed_encode(image):
+    """
+    The image without compression: the header and then the 3 bytes of each pixel,
+    row by row (in the order of the pixels of new_encode).
+    """
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    height, width = image.shape[0], image.shape[1]
+    
+    bytecount = uncompressed_size(image)
+    bitstring = numpy.zeros(bytecount, dtype = numpy.uint8)
+    bitstring[48:48 + image.size] = image.ravel()
+    bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount, UNCOMPRESSED), dtype = numpy.uint8)
+    
+    return bitstring, bytecount
+
+def packed_pixels(image):
+    """
+    The pixels of the image as 24 bit integers (height x width numpy.uint32).
+    """
+    pixels = image[:,:,0].astype(numpy.uint32) << 16
+    pixels |= image[:,:,1].astype(numpy.uint32) << 8
+    pixels |= image[:,:,2]
+    
+    return pixels
+
+def rle_runs(image, pixels = None):
+    """
+    Finds the runs of the (not enhanced) rle: the same pixel repeated n times, or
+    n different pixels (at least 2), with n up to 255 and without going beyond the
+    end of the row. Returns them as enhanced_rle_runs does (only ENCODE_RUN and 
+    ENCODE_LITERAL). The packed_pixels of the image can be given, if already computed.
+    """
+    height, width = image.shape[0], image.shape[1]
+    
+    if pixels is None:
+        pixels = packed_pixels(image)
+    pixels = pixels.ravel()
+    
+    new = numpy.ones(height*width, dtype = bool) #a run starts with a pixel different from the previous one, or with a row
+    new[1:] = pixels[1:] != pixels[:-1]
+    new[::width] = True
+    starts = numpy.flatnonzero(new)
+    counts = numpy.diff(numpy.append(starts, height*width))
+    
+    pieces = (counts + 254)//255 #the runs longer than 255 pixels are split
+    first = numpy.cumsum(pieces) - pieces
+    piece = numpy.arange(int(pieces.sum())) - numpy.repeat(first, pieces)
+    starts = numpy.repeat(starts, pieces) + 255*piece
+    counts = numpy.minimum(numpy.repeat(counts, pieces) - 255*piece, 255)
+    
+    """
+    The single pixels that follow each other in a row are written together,
+    up to 255 at a time.
+    """
+    single = counts == 1
+    follows = numpy.zeros(len(starts), dtype = bool)
+    follows[1:] = single[1:] & single[:-1] & (starts[1:] % width != 0)
+    group = numpy.cumsum(~follows) - 1
+    position = numpy.arange(len(starts)) - numpy.flatnonzero(~follows)[group]
+    first = numpy.flatnonzero(~follows | (position % 255 == 0))
+    
+    counts = numpy.add.reduceat(counts, first)
+    starts = starts[first]
+    kinds = numpy.where(single[first] & (counts > 1), ENCODE_LITERAL, ENCODE_RUN)
+    
+    return starts, counts, kinds
+
+def rle_size(counts, kinds, height):
+    """
+    Size of the rle encoded image, header included, given its runs.
+    """
+    bytecount = 48 + int(numpy.where(kinds == ENCODE_RUN, 4, 2 + 3*counts).sum()) + 2*height + 2
+    
+    return bytecount + -bytecount % 4
+
+def rle_min_size(pixels):
+    """
+    Lower bound of the size of the rle encoded image (given its packed_pixels),
+    without finding its runs: each pixel that starts a row or that is different
+    from the previous one takes at least 3 bytes (in a run, or among the different
+    pixels of a literal).
+    """
+    height = pixels.shape[0]
+    new = height + int(numpy.count_nonzero(pixels[:,1:] != pixels[:,:-1]))
+    bytecount = 48 + 3*new + 2*height + 2
+    
+    return bytecount + -bytecount % 4
+
+def invariant_rle_size(image):
+    """
+    Size of the rle of an image encoded by invariant_encode (all the rows are the
+    same, or each row has a single color): the rle does not copy the previous row,
+    so every row takes the same bytes of the first one, whose runs are enough.
+    """
+    height = image.shape[0]
+    starts, counts, kinds = rle_runs(image[:1])
+    bytecount = 48 + height*(int(numpy.where(kinds == ENCODE_RUN, 4, 2 + 3*counts).sum()) + 2) + 2
+    
+    return bytecount + -bytecount % 4
+
+def rle_write(image, starts, counts, kinds):
+    """
+    Writes the rle encoded image (header included) from the runs found by rle_runs,
+    as enhanced_rle_write: n and the pixel for a repeated pixel, 0x00, n and the
+    pixels for n different pixels, 0x00 0x00 at the end of each row and 0x00 0x01
+    at the end of the image.
+    """
+    height, width = image.shape[0], image.shape[1]
+    
+    literal = kinds == ENCODE_LITERAL
+    prefix = numpy.where(literal, 2, 1)
+    datasize = numpy.where(literal, 3*counts, 3)
+    runsize = prefix + datasize
+    
+    offset = numpy.cumsum(runsize) - runsize + 48 + 2*(starts // width)
+    
+    end = 48 + int(runsize.sum()) + 2*height
+    bytecount = rle_size(counts, kinds, height)
+    
+    bitstring = numpy.zeros(bytecount, dtype = numpy.uint8)
+    bitstring[offset + prefix - 1] = counts
+    
+    datapos = offset + prefix
+    databefore = numpy.cumsum(datasize) - datasize
+    shift = numpy.arange(int(datasize.sum()))
+    bitstring[numpy.repeat(datapos - databefore, datasize) + shift] = \
+        image.ravel()[numpy.repeat(3*starts - databefore, datasize) + shift]
+    
+    bitstring[end + 1] = 0x01 #end of image: 0x00 0x01
+    bitstring[:48] = numpy.frombuffer(image_header(width, height, bytecount, RLE), dtype = numpy.uint8)
+    
+    return bitstring, bytecount
+
+def rle_encode(image):
+    """
+    Rle encoder (the compression 0x01 of the manual of TI), returns the encoded
+    image and its size as new_encode.
+    """
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    
+    return rle_write(image, *rle_runs(image))
+
+def encode_image(image, compression = None, backend = None):
+    """
+    Encodes the image with the given compression (UNCOMPRESSED, RLE or ENHANCED_RLE,
+    see DMDPacking), or with the one that gives the smallest image if compression
+    is None: the enhanced rle is usually the best, but the images with random
+    pixels are smaller without compression, and the images with long runs in 
+    rows that are not repeated (e.g. the light sheet) are smaller with the rle.
+    The three sizes are always compared, with the same size the enhanced rle is
+    preferred, then the rle. The rle is written only if it is the smallest: its
+    size is computed from the first row for the images of invariant_encode, and
+    its runs are not even found if rle_min_size is already too big (e.g. for the
+    images with random pixels).
+    
+    The compression chosen is in the header of the encoded image (byte 25).
+    """
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    
+    if compression == UNCOMPRESSED:
+        return uncompressed_encode(image)
+    if compression == RLE:
+        return rle_encode(image)
+    if compression == ENHANCED_RLE:
+        return new_encode(image, backend)
+    if compression is not None:
+        raise ValueError("Unknown compression: {}".format(compression))
+    
+    uncompressed = uncompressed_size(image)
+    runs = None
+    fast = invariant_encode(image, backend)
+    
+    if fast is not None:
+        encoded, size = fast
+        rle = invariant_rle_size(image)
+    else:
+        encoded, size = new_encode(image, backend)
+        pixels = packed_pixels(image)
+        rle = rle_min_size(pixels) #the runs are found only if the rle can be the smallest
+        if rle < size and rle <= uncompressed:
+            runs = rle_runs(image, pixels)
+            rle = rle_size(runs[1], runs[2], image.shape[0])
+    
+    if rle < size and rle <= uncompressed:
+        return rle_write(image, *runs) if runs is not None else rle_encode(image)
+    if uncompressed < size:
+        return uncompressed_encode(image)
+    
+    return encoded, size
+
+def enhanced_rle_size(image, backend = None):
+    """
+    Size of the image encoded by new_encode, computed without writing it and
+    without scanning the rows that are the same as the previous one: such a row
+    is always a single copy of the previous row, and removing it does not change
+    how the other rows are encoded. So the size is exact, and for the images made
+    of vertical stripes or lines (most of our patterns) it takes only the time of
+    comparing the rows.
+    """
+    if backend is None:
+        backend = ENCODER_BACKEND
+    
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    height, width = image.shape[0], image.shape[1]
+    
+    rows = image.reshape(height, -1)
+    if rows.shape[1] % 8 == 0:
+        rows = rows.view(numpy.uint64) #compared 8 bytes at a time
+    kept = numpy.ones(height, dtype = bool)
+    kept[1:] = (rows[1:] != rows[:-1]).any(axis = 1)
+    copies = height - int(kept.sum())
+    if copies:
+        image = image[kept]
+    
+    if backend == 'numba':
+        if numba is None:
+            raise ValueError("The numba backend needs the numba package.")
+        pixels = image[:,:,0].astype(numpy.uint32) << 16
+        pixels |= image[:,:,1].astype(numpy.uint32) << 8
+        pixels |= image[:,:,2]
+        bitstring = numpy.zeros(48 + len(image)*(4*width + 2) + 8, dtype = numpy.uint8)
+        bytecount = _enhanced_rle_scan(image, pixels, bitstring)
+    elif backend == 'numpy':
+        starts, counts, kinds = enhanced_rle_runs(image)
+        prefix = numpy.where(kinds == ENCODE_VERTICAL, 2, numpy.where(kinds == ENCODE_LITERAL, 1, 0))
+        datasize = numpy.where(kinds == ENCODE_RUN, 3, numpy.where(kinds == ENCODE_LITERAL, 3*counts, 0))
+        bytecount = 48 + int((prefix + 1 + (counts >= 128) + datasize).sum()) + 2*len(image) + 3
+    else:
+        raise ValueError("Unknown encoder backend: {}".format(backend))
+    
+    bytecount += copies*(2 + (2 if width >= 128 else 1) + 2) #0x00 0x01, the width, end of row
+    
+    return bytecount + -bytecount % 4
+
+def upload_bytes(size):
+    """
+    Bytes written to the DMD to upload an encoded image of size bytes (setbmp and
+    the packets of bmpload, whole reports).
+    """
+    full, last = divmod(size, 504)
+    
+    return REPORT_SIZE*(1 + 8*full + (8 + last + 63)//64)
+
+DEFAULT_UPLOAD_RATE = 0.064 #MB/s, a report each ms of a full speed usb, until the rate of a load is measured
+MAX_PLANES = 400 #binary patterns kept by the DLPC900 in pattern on the fly mode (DLP6500, see the datasheet)
+
+def estimate_sizes(sizes, patterns, planes, rate = None):
+    """
+    The prediction of estimate_sequence, given the size of each encoded image.
+    """
+    written = sum(upload_bytes(size) for size in sizes)
+    
+    return {'patterns': patterns, 'planes': planes, 'images': len(sizes),
+            'encoded bytes': int(sum(sizes)), 'written bytes': written,
+            'upload time': written/1e6/(rate or DEFAULT_UPLOAD_RATE),
+            'fits': planes <= MAX_PLANES and len(sizes) <= 32}
+
+def estimate_sequence(images, dedup = True, pack = False, rate = None):
+    """
+    Predicts what defsequence uploads for the images, without encoding them: the
+    images are merged as defsequence does (the repeated planes only once, if dedup,
+    and in the order of PlaneLayout.pack, if pack) and the size of each merged image
+    is the smallest of enhanced_rle_size, rle_size and uncompressed_size, i.e. the
+    size of the image chosen by encode_image.
+    
+    Returns a dictionary with the number of patterns, of planes and of images 
+    uploaded, the encoded bytes and the bytes written to the DMD, the time to write
+    them at rate MB/s (DEFAULT_UPLOAD_RATE if None), and if they fit in the memory
+    of the DLPC900 (MAX_PLANES).
+    """
+    layout = PlaneLayout(dedup)
+    planes = layout.unique(images)
+    if pack:
+        planes = iter(layout.pack(planes))
+    groups = iter(lambda: list(islice(planes, 24)), [])
+    
+    sizes = []
+    merged = None
+    for group in groups:
+        merged = mergeimages(group, out = merged)
+        runs = rle_runs(merged)
+        sizes.append(min(enhanced_rle_size(merged), rle_size(runs[1], runs[2], merged.shape[0]),
+                         uncompressed_size(merged)))
+    
+    return estimate_sizes(sizes, len(layout), layout.planes, rate)
+
+def estimate_file(path, rate = None):
+    """
+    Same as estimate_sequence for an .encd file, from the sizes of its images.
+    """
+    if is_encoded_file(path):
+        with EncodedFile(path) as encoded:
+            num, sizes = encoded.num, list(encoded.sizes)
+    else:
+        num, encodedimages, sizes = load_legacy(path)
+    
+    return estimate_sizes(sizes, num, num, rate)
+
+ENCODER_VERSION = 3 #to be changed when the output of encode_image changes, so that the cached images are not used
+
+def encoded_key(image):
+    """
+    Key of an image in the cache of the encoded images: a hash of the merged
+    image (the encoding depends only on it) and of the version of the encoder.
+    """
+    image = numpy.ascontiguousarray(image, dtype = numpy.uint8)
+    digest = hashlib.blake2b(digest_size = 20)
+    digest.update('{} {}'.format(ENCODER_VERSION, image.shape).encode())
+    digest.update(image)
+    
+    return digest.hexdigest()
+
+def cached_encode(image, cache = None):
+    """
+    Same as encode_image, but if a cache (DMDCache.EncodedCache) is given the
+    encoded image is taken from it when present, and stored in it otherwise.
+    """
+    if cache is None:
+        return encode_image(image)
+    
+    key = encoded_key(image)
+    found = cache.get(key)
+    if found is not None:
+        return found
+    
+    encoded, size = encode_image(image)
+    cache.put(key, encoded)
+    
+    return encoded, size
+
+def new_encode_loop(image):
     """
     I have rewritten the encoding function to make it clearer and straightforward.
     Besides, I have deleted the condition for which the function remains trapped
     in an infinite loop for some hadamard pattern. Everything seems to work fine.
+    
+    This is the original pixel by pixel version of the enhanced rle encoder: it is
+    really slow (tens of seconds for each image), so it is kept only as a reference
+    for checking the output of new_encode. The size of the image is taken from
+    its shape, so that it can be checked also on small images.
     """
+    rows, columns = image.shape[0], image.shape[1]
 
 ## header creation
     bytecount=48    
@@ -449,12 +1504,12 @@ def new_encode(image):
     bitstring.append(0x6c)
     bitstring.append(0x64)
     
-    width=convlen(1920,16)
+    width=convlen(columns,16)
     width=bitstobytes(width)
     for i in width:
         bitstring.append(i)
 
-    height=convlen(1080,16)
+    height=convlen(rows,16)
     height=bitstobytes(height)
     for i in height:
         bitstring.append(i)
@@ -484,13 +1539,13 @@ def new_encode(image):
     i=0
     j=0
 
-    while i <1080:
+    while i <rows:
 
-        while j <1920:
+        while j <columns:
 
             if i>0:
                 if numpy.all(image[i,j,:]==image[i-1,j,:]):
-                    while j<1920 and numpy.all(image[i,j,:]==image[i-1,j,:]):
+                    while j<columns and numpy.all(image[i,j,:]==image[i-1,j,:]):
                         n=n+1
                         j=j+1
                         
@@ -513,11 +1568,11 @@ def new_encode(image):
 
             
                 else:
-                    if j < 1919: #1919 since I compare j and j+1 pixel
+                    if j < columns-1: #columns-1 since I compare j and j+1 pixel
                         if numpy.all(image[i,j,:]==image[i,j+1,:]):
                             n=n+1
                     
-                            while j<1919 and numpy.all(image[i,j,:]==image[i,j+1,:]):
+                            while j<columns-1 and numpy.all(image[i,j,:]==image[i,j+1,:]):
                                 n=n+1
                                 j=j+1
                             if n>=128:
@@ -538,7 +1593,7 @@ def new_encode(image):
                             
                             j=j+1
                             n=0
-                        elif j > 1917 or numpy.all(image[i,j+1,:]==image[i,j+2,:]) or numpy.all(image[i,j+1,:]==image[i-1,j+1,:]):
+                        elif j > columns-3 or numpy.all(image[i,j+1,:]==image[i,j+2,:]) or numpy.all(image[i,j+1,:]==image[i-1,j+1,:]):
                             bitstring.append(0x01)
                             bytecount+=1
                             bitstring.append(image[i,j,0])
@@ -554,10 +1609,10 @@ def new_encode(image):
     
                             toappend=[]
     
-                            while j<1919 and numpy.any(image[i,j,:]!=image[i,j+1,:]):
+                            while j<columns-1 and numpy.any(image[i,j,:]!=image[i,j+1,:]):
 
                                 """
-                                I've moved the j<1919 condition as first condition since sometimes it
+                                I've moved the j<columns-1 condition as first condition since sometimes it
                                 tries to read image array at wrong index.
                                 """
                                 n=n+1
@@ -583,7 +1638,7 @@ def new_encode(image):
                                 bytecount+=1
                             #j=j+1
                             n=0                           
-                    elif j == 1919:
+                    elif j == columns-1:
                         
                         bitstring.append(0x01)
                         bytecount+=1
@@ -596,12 +1651,12 @@ def new_encode(image):
                         n=0
             else:
                 
-                if j < 1919: #1919 since I compare j and j+1 pixel
+                if j < columns-1: #columns-1 since I compare j and j+1 pixel
                 
                     if numpy.all(image[i,j,:]==image[i,j+1,:]):
                         n=n+1
                 
-                        while j<1919 and numpy.all(image[i,j,:]==image[i,j+1,:]):
+                        while j<columns-1 and numpy.all(image[i,j,:]==image[i,j+1,:]):
                             n=n+1
                             j=j+1
                         if n>=128:
@@ -622,7 +1677,7 @@ def new_encode(image):
                         
                         j=j+1
                         n=0
-                    elif j > 1917 or numpy.all(image[i,j+1,:]==image[i,j+2,:]) or numpy.all(image[i,j+1,:]==image[i-1,j+1,:]):
+                    elif j > columns-3 or numpy.all(image[i,j+1,:]==image[i,j+2,:]) or numpy.all(image[i,j+1,:]==image[i-1,j+1,:]):
                         bitstring.append(0x01)
                         bytecount+=1
                         bitstring.append(image[i,j,0])
@@ -638,10 +1693,10 @@ def new_encode(image):
 
                         toappend=[]
 
-                        while j<1919 and numpy.any(image[i,j,:]!=image[i,j+1,:]):
+                        while j<columns-1 and numpy.any(image[i,j,:]!=image[i,j+1,:]):
 
                             """
-                            I've moved the j<1919 condition as first condition since sometimes it
+                            I've moved the j<columns-1 condition as first condition since sometimes it
                             tries to read image array at wrong index.
                             """
                             n=n+1
@@ -667,7 +1722,7 @@ def new_encode(image):
                             bytecount+=1
                         #j=j+1
                         n=0                           
-                elif j == 1919:
+                elif j == columns-1:
                     
                     bitstring.append(0x01)
                     bytecount+=1
@@ -705,77 +1760,240 @@ def new_encode(image):
     
     return bitstring, bytecount
 
-def save_encoded_sequence(images, folder, name):
+def _encode_group(name, shape, dtype, start, stop, cache = None):
+    """
+    Merges and encodes the images from start to stop of the stack shared
+    by encode_groups. It runs in the worker processes, and it returns also
+    the time spent.
+    """
+    t = time.perf_counter()
+    block = shared_memory.SharedMemory(name = name)
+    stack = numpy.ndarray(shape, dtype = dtype, buffer = block.buf)
+    
+    encoded, size = cached_encode(mergeimages(stack[start:stop]), cache)
+    
+    del stack #the buffer must be released before closing the shared memory
+    block.close()
+    
+    return encoded, size, time.perf_counter() - t
+
+def _encode_merged(merged, cache = None):
+    """
+    Encodes a merged image in a worker process of encode_stream, and returns
+    also the time spent.
+    """
+    t = time.perf_counter()
+    encoded, size = cached_encode(merged, cache)
     
+    return encoded, size, time.perf_counter() - t
+
+def _encode_group_stream(groups, workers = None, cache = None, count = None):
     """
-    Function that save an encoded sequence of image into a file.
+    Merges and encodes the groups (index and list of images) that come from an 
+    iterator: each group is merged as soon as it arrives and sent to the pool of
+    processes, with at most 2*workers groups waiting, and they are yielded as
+    encode_groups does, in the order they come. The pool has at most a process
+    for each group: if their number (count) is not known, the first groups are
+    merged before starting it, to count them.
     """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    def merged():
+        for index, group in groups:
+            t = time.perf_counter()
+            yield index, mergeimages(group), time.perf_counter() - t
+    
+    pending = merged()
+    if count is None and workers > 1:
+        first = list(islice(pending, workers))
+        count = len(first)
+        pending = chain(first, pending)
+    if count is not None:
+        workers = min(workers, count)
+    
+    if workers <= 1:
+        for index, image, merging in pending:
+            t = time.perf_counter()
+            encoded, size = cached_encode(image, cache)
+            yield index, encoded, size, merging + time.perf_counter() - t
+        return
+    
+    def result(entry):
+        index, future, merging = entry
+        encoded, size, duration = future.result()
+        return index, encoded, size, merging + duration
+    
+    with ProcessPoolExecutor(workers) as pool:
+        waiting = deque()
+        for index, image, merging in pending:
+            waiting.append((index, pool.submit(_encode_merged, image, cache), merging))
+            del image
+            
+            while waiting and (len(waiting) >= 2*workers or waiting[0][1].done()):
+                yield result(waiting.popleft())
         
-    arr=[]
+        while waiting:
+            yield result(waiting.popleft())
 
-    for i in images:
-        arr.append(i)
+def encode_stream(images, workers = None, reverse = False, cache = None):
+    """
+    Same as encode_groups, for images that come one at a time from an iterator
+    (e.g. DMDPatterns.read_patterns): each group of 24 images is merged as soon as
+    it is complete and encoded by _encode_group_stream, so that only a few images
+    are in memory.
+    
+    With reverse = True the encoded groups are kept until the last one is ready
+    (they are much smaller than the images), and then yielded starting from it.
+    """
+    if reverse:
+        yield from reversed(list(encode_stream(images, workers, False, cache)))
+        return
+    
+    images = iter(images)
+    groups = iter(lambda: list(islice(images, 24)), [])
+    
+    yield from _encode_group_stream(enumerate(groups), workers, cache)
 
-    num=len(arr)
+def encode_read(images, workers = None, reverse = False, cache = None):
+    """
+    Same as encode_groups, for images read only when needed (they have a len, and
+    images.read(start, stop) returns the images from start to stop, as 
+    DMDPatterns.PatternFiles and DMDLayout.PackedPlanes): the groups are read one
+    at a time, starting from the last one if reverse is True, while the previous
+    ones are encoded.
+    """
+    num = len(images)
+    indices = range((num + 23)//24)
+    if reverse:
+        indices = reversed(indices)
+    groups = ((index, images.read(24*index, min(24*index + 24, num))) for index in indices)
+    
+    yield from _encode_group_stream(groups, workers, cache, (num + 23)//24)
 
-    encodedimages=[]
-    sizes=[]
+def encode_groups(images, workers = None, reverse = False, cache = None):
+    """
+    Merges the images in groups of 24 and encodes each group. The groups are
+    independent, so they are encoded in parallel by a pool of processes
+    (workers = os.cpu_count() by default, with workers = 1 everything is done
+    in this process). The images are passed to the processes through a shared
+    memory block.
     
-    for i in range(int((num-1)//24)+1):
-        print ('merging...')
-        if i<(int((num-1)//24)):
-            imagedata=mergeimages(arr[i*24:(i+1)*24])
-        else:
-            imagedata=mergeimages(arr[i*24:])
+    This is a generator: for each group it yields the index of the group, the
+    encoded image, its size and the time spent for encoding, in order (starting
+    from the last group if reverse is True) and as soon as the group is ready.
+    
+    If a cache (DMDCache.EncodedCache) is given, the groups already encoded
+    once are only merged, and the encoding is read from the cache.
+    
+    If images is an iterator (it has no len), the images are not stacked in 
+    memory: they are merged and encoded as they arrive, see encode_stream. The
+    images read only when needed (e.g. DMDPatterns.PatternFiles) are read a group
+    at a time, in the order of the groups, see encode_read.
+    """
+    if hasattr(images, 'read'):
+        yield from encode_read(images, workers, reverse, cache)
+        return
+    if not hasattr(images, '__len__'):
+        yield from encode_stream(images, workers, reverse, cache)
+        return
+    
+    images = list(images)
+    num = len(images)
+    groups = [(start, min(start + 24, num)) for start in range(0, num, 24)]
+    indices = list(range(len(groups)))
+    if reverse:
+        indices.reverse()
+    
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(groups))
+    
+    if workers <= 1:
+        merged = None
+        for index in indices:
+            t = time.perf_counter()
+            start, stop = groups[index]
+            merged = mergeimages(images[start:stop], out = merged)
+            encoded, size = cached_encode(merged, cache)
+            yield index, encoded, size, time.perf_counter() - t
+        return
+    
+    first = numpy.asarray(images[0])
+    block = shared_memory.SharedMemory(create = True, size = num*first.nbytes)
+    stack = numpy.ndarray((num,) + first.shape, dtype = first.dtype, buffer = block.buf)
+    
+    try:
+        for i in range(num):
+            stack[i] = images[i]
         
+        starts = [groups[index][0] for index in indices]
+        stops = [groups[index][1] for index in indices]
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(_encode_group, repeat(block.name), repeat(stack.shape),
+                               repeat(stack.dtype.str), starts, stops, repeat(cache))
+            for index, (encoded, size, duration) in zip(indices, results):
+                yield index, encoded, size, duration
+    finally:
+        del stack
+        block.close()
+        block.unlink()
 
-        print('encoding...')
-        
-        imagedata,size=new_encode(imagedata)
+def encode_sequence(images, workers = None, cache = None):
+    """
+    Merges and encodes all the images (see encode_groups), and returns the
+    encoded groups in order, with their sizes.
+    """
+    encoded = list(encode_groups(images, workers, cache = cache))
+    
+    encodedimages = [e[1] for e in encoded]
+    sizes = [e[2] for e in encoded]
+    
+    return encodedimages, sizes
+
+def save_encoded_sequence(images, folder, name, workers = None, cache = None):
+    
+    """
+    Function that save an encoded sequence of image into a file (version 2
+    .encd file, see DMDEncodedFile).
+    """
         
+    arr=[]
 
-        encodedimages.append(imagedata)
-        sizes.append(size)
+    for i in images:
+        arr.append(i)
+
+    num=len(arr)
+
+    print ('merging and encoding...')
+    encodedimages, sizes = encode_sequence(arr, workers, cache)
         
-    files = [num, encodedimages, sizes]
     if not os.path.isdir(folder):
         os.makedirs(folder)
-    pickle.dump(files, open(folder + name + '.encd', 'wb'), pickle.HIGHEST_PROTOCOL)
+    write_encoded(folder + name + '.encd', num, encodedimages, sizes)
 
 if __name__ == "__main__":
     
     hiddev = DmdDeviceHID()
 
-    import PIL.Image
+    from DMD_ScopeFoundry.DMDPatterns import pattern_files, read_patterns
 
     try:
         #hiddev.reset()
-        images=[]
-         
-        directory_in_str = "X:\\Gianmaria\\DMD\\Patterns\\DMD_patterns\\bin_sinusoidal_pattern\\"
-        directory = os.fsencode(directory_in_str)
-        i = 0
-        for file in sorted(os.listdir(directory)):
-            filename = os.fsdecode(file)
-            if filename.endswith("320.png"):
-                """
-                Here is necessary to speciofy the array as boolean, since, otherwise, python
-                sees an 8 bit image, adn, when we merge images, there are overflow issues, besides
-                of issues in adding patterns. With boolean, I think, Python automatically transforms
-                the image in a "boolean" image.
-                """
-                arr = numpy.asarray(PIL.Image.open(directory_in_str+filename), dtype = numpy.bool)
-                images.append(arr)
-                i += 1
-            if i > 1:
-                break
+        """
+        The images are read as boolean arrays (see DMDPatterns.read_pattern), since,
+        otherwise, python sees an 8 bit image, and, when we merge images, there are 
+        overflow issues. They are read while the groups are encoded, a few at a time.
+        """
+        files = pattern_files("X:\\Gianmaria\\DMD\\Patterns\\DMD_patterns\\bin_sinusoidal_pattern\\*320.png")[:2]
+        images = read_patterns(files)
      
         hiddev.changemode(3)
         
-        exposure=[1000000]*len(images)
-        dark_time=[0]*len(images)
-        trigger_in=[False]*len(images)
-        trigger_out=[True]*len(images)
+        exposure=[1000000]*len(files)
+        dark_time=[0]*len(files)
+        trigger_in=[False]*len(files)
+        trigger_out=[True]*len(files)
         
         hiddev.defsequence(images,exposure,trigger_in,dark_time,trigger_out, 60)
         
@@ -0,0 +1,102 @@
+"""
+Encoding of pattern libraries without the DMD.
+
+Each folder of patterns is encoded into the .encd file (version 2, see
+DMDEncodedFile) that DmdHardware loads instead of encoding the images again:
+<folder>/<folder name>.encd, or <output>/<folder name>.encd with --output.
+The folders whose file is newer than all their images are skipped (unless
+--force is given); with --cache the groups already encoded are taken from a
+DMDCache.EncodedCache, so that images touched but not changed are not encoded
+again. For example:
+
+    python -m DMD_ScopeFoundry.DMDEncode D:\\patterns\\light_sheet D:\\patterns\\hadamard_* --workers 8
+
+The images of a folder are read a few at a time and the groups are encoded in
+parallel by a pool of processes (see DMDDeviceHID.encode_groups), so the
+folders are encoded one after the other using all the processors.
+"""
+
+import argparse
+import glob
+import os
+import re
+import time
+from DMD_ScopeFoundry.DMDCache import EncodedCache
+from DMD_ScopeFoundry.DMDDeviceHID import encode_groups
+from DMD_ScopeFoundry.DMDEncodedFile import write_encoded
+from DMD_ScopeFoundry.DMDPatterns import pattern_files, read_patterns, is_up_to_date
+
+def output_file(folder, output = None):
+    """
+    Name of the .encd file of a folder of patterns.
+    """
+    folder = os.path.normpath(folder)
+    name = os.path.basename(folder) + '.encd'
+
+    return os.path.join(output if output is not None else folder, name)
+
+def encode_folder(folder, output = None, workers = None, cache = None, force = False):
+    """
+    Encodes the patterns of folder into its .encd file, and returns a dictionary
+    with the number of frames, the time spent, the size of the patterns (at 1 bit
+    per pixel) and of the encoded file, or None if the file was already up to date.
+    """
+    files = pattern_files(folder)
+    path = output_file(folder, output)
+    if not files:
+        raise FileNotFoundError("No patterns found in {}".format(folder))
+    if not force and is_up_to_date(path, files):
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    t = time.perf_counter()
+    shape = []
+    def groups():
+        for index, encoded, size, duration in encode_groups(read_patterns(files), workers, cache = cache):
+            shape[:] = encoded[4:8].view('<u2') #width and height, from the header
+            yield encoded[:size]
+
+    write_encoded(path, len(files), groups())
+    elapsed = time.perf_counter() - t
+
+    return {'file': path,
+            'frames': len(files),
+            'time': elapsed,
+            'pattern bytes': len(files)*int(shape[0])*int(shape[1])//8,
+            'encoded bytes': os.path.getsize(path)}
+
+def report(stats):
+
+    return "{}: {} frames in {:.2f} s, {:.1f} frames/s, {:.1f} MB/s, compression {:.1f}x".format(
+        stats['file'], stats['frames'], stats['time'], stats['frames']/stats['time'],
+        stats['pattern bytes']/stats['time']/1e6, stats['pattern bytes']/stats['encoded bytes'])
+
+def main(args = None):
+
+    parser = argparse.ArgumentParser(description = "Encodes folders of DMD patterns into .encd files.")
+    parser.add_argument('folders', nargs = '+', help = "folders of patterns (globs are expanded)")
+    parser.add_argument('--output', help = "folder of the .encd files (by default each one is saved in its folder)")
+    parser.add_argument('--workers', type = int, help = "processes used for encoding (all the processors by default)")
+    parser.add_argument('--cache', help = "folder of the cache of the encoded groups")
+    parser.add_argument('--force', action = 'store_true', help = "encode also the folders that are up to date")
+    args = parser.parse_args(args)
+
+    folders = []
+    for folder in args.folders:
+        folders += sorted(glob.glob(folder)) if re.search(r'[*?[]', folder) else [folder]
+    cache = EncodedCache(args.cache) if args.cache else None
+
+    for folder in folders:
+        if not os.path.isdir(folder):
+            print (folder, "is not a folder, skipped")
+            continue
+        stats = encode_folder(folder, args.output, args.workers, cache, args.force)
+        if stats is None:
+            print (output_file(folder, args.output), "is up to date")
+        else:
+            print (report(stats))
+
+if __name__ == "__main__":
+
+    main()
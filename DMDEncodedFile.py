@@ -0,0 +1,182 @@
+"""
+Binary file format (version 2) of the encoded sequences (.encd files).
+
+The old .encd files are pickles of [number of images, encoded images, sizes],
+where every encoded image is a list of numpy scalars: they are huge, slow to
+load and unpickling them can run any code. The version 2 files are:
+
+    header, 16 bytes: b'ENCD', version (u16), 0 (u16), number of images (u32),
+                      number of groups of 24 images (u32)
+    table, 16 bytes per group: offset of the encoded group from the start
+                               of the file (u64), its size in bytes (u64)
+    the encoded groups, one after the other
+
+all little endian. EncodedFile reads only the header and the table, and maps
+each encoded group when it is asked for: the group is a memoryview on its own
+mapping, that can be passed as it is to DmdDeviceHID.bmpload without copying
+it, and it is unmapped as soon as the view is deleted. So a sequence of any
+length is streamed to the DMD with the memory of a single group, and the
+upload starts immediately. The old files can be converted with
+convert_legacy, or from the command line:
+
+    python -m DMD_ScopeFoundry.DMDEncodedFile old.encd [other.encd ...]
+"""
+
+import mmap
+import os
+import pickle
+import struct
+import sys
+import numpy
+
+MAGIC = b'ENCD'
+VERSION = 2
+HEADER = struct.Struct('<4sHHII') #magic, version, reserved, number of images, number of groups
+ENTRY = struct.Struct('<QQ') #offset, size
+
+def is_encoded_file(path):
+    """
+    True if the file at path is in the version 2 format (and not an old pickle).
+    """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def write_encoded(path, num, encodedimages, sizes = None):
+    """
+    Writes the encoded groups of a sequence of num images in a version 2 file.
+    The groups can be numpy arrays, bytes or lists of bytes (as in the old files),
+    and they can also be yielded one at a time by a generator. If the sizes are
+    not given, the whole groups are written.
+
+    The file is written with a temporary name and then renamed, so that a
+    broken file is never left at path.
+    """
+    groups = (num + 23)//24
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+
+    try:
+        with open(temp, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, 0, num, groups))
+            file.seek(HEADER.size + groups*ENTRY.size)
+
+            table = []
+            for i, encoded in enumerate(encodedimages):
+                if isinstance(encoded, (bytes, bytearray, memoryview)):
+                    data = numpy.frombuffer(encoded, dtype = numpy.uint8) #asarray would not take the bytes
+                else:
+                    data = numpy.asarray(encoded, dtype = numpy.uint8).ravel()
+                if sizes is not None:
+                    data = data[:sizes[i]]
+                table.append((file.tell(), len(data)))
+                file.write(data.tobytes())
+
+            if len(table) != groups:
+                raise ValueError("{} images need {} encoded groups, {} given".format(num, groups, len(table)))
+
+            file.seek(HEADER.size)
+            for offset, size in table:
+                file.write(ENTRY.pack(offset, size))
+    except BaseException:
+        os.remove(temp)
+        raise
+
+    os.replace(temp, path)
+
+def load_legacy(path):
+    """
+    Loads an old (pickled) .encd file, returning the number of images, the encoded
+    groups and their sizes. Only for trusted files: unpickling can run any code.
+    """
+    with open(path, 'rb') as file:
+        num, encodedimages, sizes = pickle.load(file)
+
+    return num, encodedimages, sizes
+
+def convert_legacy(path, newpath = None):
+    """
+    Converts an old .encd file into a version 2 file, by default named as the old
+    one with _v2 added. Returns the name of the new file.
+    """
+    if newpath is None:
+        newpath = os.path.splitext(path)[0] + '_v2.encd'
+
+    num, encodedimages, sizes = load_legacy(path)
+    write_encoded(newpath, num, encodedimages, sizes)
+
+    return newpath
+
+class EncodedFile:
+    """
+    Version 2 .encd file. file[i] is the i-th encoded group, as a read only
+    memoryview of a mapping of only that part of the file, and file.sizes are
+    their sizes. Better not to keep the groups around: each one keeps its
+    mapping alive.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, 'rb')
+
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("{} is not an encoded sequence".format(path))
+            magic, version, _, self.num, groups = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("{} is not an encoded sequence (it starts with {!r}, not {!r})".format(path, magic, MAGIC))
+            if version != VERSION:
+                raise ValueError("{} has version {}, only version {} is supported".format(path, version, VERSION))
+
+            table = self.file.read(groups*ENTRY.size)
+            if len(table) < groups*ENTRY.size:
+                raise ValueError("{} is truncated".format(path))
+            table = list(ENTRY.iter_unpack(table))
+            self.offsets = [entry[0] for entry in table]
+            self.sizes = [entry[1] for entry in table]
+
+            length = os.fstat(self.file.fileno()).st_size
+            if any(offset + size > length for offset, size in table):
+                raise ValueError("{} is truncated".format(path))
+        except Exception:
+            self.file.close()
+            raise
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+
+        offset, size = self.offsets[index], self.sizes[index]
+        if size == 0:
+            return memoryview(b'')
+
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY #the mapping must start at a multiple of it
+        mapping = mmap.mmap(self.file.fileno(), offset + size - start, offset = start, access = mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'): #not on windows
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+        return memoryview(mapping)[offset - start:]
+
+    def __iter__(self):
+
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+
+        self.file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+if __name__ == "__main__":
+
+    for path in sys.argv[1:]:
+        print (path, '-->', convert_legacy(path))
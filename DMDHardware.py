@@ -13,11 +13,27 @@ Here we define the hardware class to be integrated in a ScopeFoundry app.
 from threading import Thread
 from ScopeFoundry import HardwareComponent
 from qtpy import QtCore, QtWidgets
-from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID
-import numpy
+from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID, estimate_sequence, estimate_file
+from DMD_ScopeFoundry.DMDCache import EncodedCache
+from DMD_ScopeFoundry.DMDPatterns import open_patterns, encoded_file
 import os
 import sys
-import PIL.Image
+import time
+
+def pattern_values(text, default):
+    """
+    Values of a setting for each pattern, from a string of integers separated by
+    commas or spaces. If the string is empty, default is used for all the patterns.
+    """
+    values = [int(value) for value in text.replace(',', ' ').split()]
+    
+    return values or [default]
+
+def each_pattern(values, num):
+    """
+    Repeats the values cyclically to have one value for each of the num patterns.
+    """
+    return [values[j % len(values)] for j in range(num)]
 
 class DmdHardware(HardwareComponent):
     
@@ -31,22 +47,52 @@ class DmdHardware(HardwareComponent):
                                                  initial = 1000000, vmin = 1, spinbox_step = 50000, unit = "us") #the spinbox_step does not work since it only works with float
         self.dark_time = self.add_logged_quantity("dark_time", dtype = int, si = False, ro = 0,
                                                  initial = 0, vmin = 0, unit = "us")
+        self.exposure_list = self.add_logged_quantity("exposure_list", dtype = str, ro = 0,
+                                                      initial = "") #exposure of each pattern (us, separated by commas, repeated if they are less than the patterns), exposure for all if empty
+        self.dark_time_list = self.add_logged_quantity("dark_time_list", dtype = str, ro = 0,
+                                                       initial = "") #the same for the dark time
+        self.repeat = self.add_logged_quantity("repeat", dtype = int, si = False, ro = 0,
+                                               initial = 0, vmin = 0) #number of repetitions of the sequence, 0 for forever
         self.bit_depth = self.add_logged_quantity("bit_depth", dtype = int, ro = 1, initial = 1)
         self.trigger_input = self.add_logged_quantity("trigger_input", dtype = bool, si = False, ro = 0,
                                                       initial = False)
         self.trigger_output = self.add_logged_quantity("trigger_output", dtype = bool, si = False, ro = 0,
                                                       initial = True)
+        self.ack_window = self.add_logged_quantity("ack_window", dtype = int, si = False, ro = 0,
+                                                   initial = 1, vmin = 0) #packets uploaded before reading an answer, see DmdDeviceHID.bmpload
+        self.cache_dir = self.add_logged_quantity("cache_dir", dtype = 'file', is_dir = True,
+                                                  initial = "") #folder of the encoded images already seen, no cache if empty
+        self.cache_size = self.add_logged_quantity("cache_size", dtype = int, si = False, ro = 0,
+                                                   initial = 1024, vmin = 0, unit = "MB")
+        self.load_time = self.add_logged_quantity("load_time", dtype = float, ro = 1,
+                                                  initial = 0, unit = "s") #duration of the last load_pattern
+        self.upload_rate = self.add_logged_quantity("upload_rate", dtype = float, ro = 1,
+                                                    initial = 0, unit = "MB/s") #of the images in the last load_pattern
+        self.predicted_size = self.add_logged_quantity("predicted_size", dtype = float, ro = 1,
+                                                       initial = 0, unit = "MB") #written to the DMD by load_pattern, see estimate_load
+        self.predicted_time = self.add_logged_quantity("predicted_time", dtype = float, ro = 1,
+                                                       initial = 0, unit = "s") #to upload the images, at the upload_rate of the last load
+        self.pack_planes = self.add_logged_quantity("pack_planes", dtype = bool, ro = 0,
+                                                    initial = False) #upload the planes in the order that compresses them best, see DMDLayout
+        self.live_timing = self.add_logged_quantity("live_timing", dtype = bool, ro = 0,
+                                                    initial = False) #send the exposure, dark time, triggers and repeat as soon as they change, see update_timing
         
         
 
-        self.file_path = self.add_logged_quantity("file_path", dtype = 'file', is_dir = False, 
+        self.file_path = self.add_logged_quantity("file_path", dtype = 'file', is_dir = False, #an image, a folder, a glob, a multi-page tiff or an .encd file
                                                initial = "D:\\LabPrograms\\ScopeFoundry_POLIMI\\DMD_Pattern\\Calibration_pattern\\Periodic Pattern\\modulated_lightsheet_32.png")
         
         self.add_operation("browser", self.file_browser)
+        self.add_operation("estimate_load", self.estimate_load_threaded_mode)
         self.add_operation("load_pattern", self.load_sequence_threaded_mode)
         self.add_operation("start_pattern", self.start_sequence)
         self.add_operation("pause_pattern", self.pause_sequence)
         self.add_operation("stop_pattern", self.stop_sequence)
+        self.add_operation("update_timing", self.update_timing)
+        
+        for lq in (self.exposure, self.dark_time, self.exposure_list, self.dark_time_list,
+                   self.trigger_input, self.trigger_output, self.repeat):
+            lq.add_listener(self.timing_changed)
 
         
         
@@ -57,6 +103,8 @@ class DmdHardware(HardwareComponent):
         self.dmd.stopsequence()
         
         self.mode.hardware_set_func = self.dmd.changemode(self.mode.val)
+        self.dmd.ackwindow = self.ack_window.val
+        self.ack_window.hardware_set_func = self.set_ack_window
         t = Thread(target=self.load_start_stop)
         t.start()
 
@@ -70,12 +118,57 @@ class DmdHardware(HardwareComponent):
             lq.hardware_read_func = None
             lq.hardware_set_func = None
     
+    def set_ack_window(self, ackwindow):
+        
+        self.dmd.ackwindow = ackwindow
+    
+    def encoded_cache(self):
+        """
+        Cache of the encoded images in cache_dir, so that loading again the same
+        patterns (e.g. with a different exposure) does not encode them again.
+        """
+        cache_dir = os.fsdecode(self.cache_dir.val)
+        if not cache_dir:
+            return None
+        
+        return EncodedCache(cache_dir, self.cache_size.val*2**20)
+    
     @QtCore.Slot()
     def load_sequence_threaded_mode(self):
         
         t = Thread(target=self.load_sequence)
         t.start()
     
+    @QtCore.Slot()
+    def estimate_load_threaded_mode(self):
+        
+        t = Thread(target=self.estimate_load)
+        t.start()
+    
+    def estimate_load(self):
+        """
+        Predicts the bytes that load_pattern writes to the DMD for file_path, and the
+        time to upload them, without encoding the images (see 
+        DMDDeviceHID.estimate_sequence, with the same pack_planes of load_pattern)
+        or, for an .encd file, from the sizes of its images. It works also without
+        the DMD.
+        """
+        source = os.fsdecode(self.file_path.val)
+        rate = self.upload_rate.val or None #measured by the last load_pattern, if any
+        
+        encoded = encoded_file(source)
+        if encoded is not None:
+            estimate = estimate_file(encoded, rate)
+        else:
+            num, images = open_patterns(source)
+            estimate = estimate_sequence(images, pack = self.pack_planes.val, rate = rate)
+        
+        self.predicted_size.update_value(estimate['written bytes']/1e6)
+        self.predicted_time.update_value(estimate['upload time'])
+        print("{patterns} patterns, {planes} planes in {images} images, {encoded bytes} bytes encoded".format(**estimate))
+        if not estimate['fits']:
+            print("The patterns do not fit in the memory of the DMD!")
+        
     def load_start_stop(self):
         
         self.load_sequence()
@@ -84,20 +177,64 @@ class DmdHardware(HardwareComponent):
         self.stop_sequence()
         
     def load_sequence(self):
+        """
+        Loads the patterns of file_path: a single image, a folder or a glob of images,
+        a multi-page tiff or an .encd file. If the patterns have already been encoded
+        in an .encd file (see DMDPatterns.encoded_file) it is uploaded directly,
+        otherwise the images are read and encoded in parallel while loading.
+        """
+        t = time.perf_counter()
+        self.dmd.stats.reset()
         
-        images=[]
-    
-        file_path = os.fsdecode(self.file_path.val)
-        arr = numpy.array(PIL.Image.open(file_path), dtype = numpy.bool)
-        images.append(arr)
-        exposure=[self.exposure.val]*len(images)
-        dark_time=[self.dark_time.val]*len(images)
-        trigger_input=[self.trigger_input.val]*len(images)
-        trigger_output=[self.trigger_output.val]*len(images)
-        
-        self.dmd.defsequence(images,exposure,trigger_input,dark_time,trigger_output,0)
+        source = os.fsdecode(self.file_path.val)
+        exposure = pattern_values(self.exposure_list.val, self.exposure.val)
+        dark_time = pattern_values(self.dark_time_list.val, self.dark_time.val)
+        trigger_input = [self.trigger_input.val]
+        trigger_output = [self.trigger_output.val]
+        
+        encoded = encoded_file(source)
+        if encoded is not None:
+            print("Loading the encoded file", encoded)
+            self.dmd.def_sequence_by_file(encoded,exposure,trigger_input,dark_time,trigger_output,self.repeat.val)
+        else:
+            num, images = open_patterns(source)
+            self.dmd.cache = self.encoded_cache()
+            self.dmd.defsequence(images,each_pattern(exposure,num),each_pattern(trigger_input,num),
+                                 each_pattern(dark_time,num),each_pattern(trigger_output,num),self.repeat.val,
+                                 pack=self.pack_planes.val)
+        
+        self.load_time.update_value(time.perf_counter() - t)
+        if 'bmpload' in self.dmd.stats.totals: #else the rate measured before is kept
+            self.upload_rate.update_value(self.dmd.stats.summary('bmpload')['MB/s'])
+        print(self.dmd.stats.report())
         print("****************\n\nStop Loading sequence!\n\n****************")
     
+    @QtCore.Slot()
+    def update_timing(self):
+        """
+        Sends the exposure, dark time, triggers and repeat of the settings for the
+        sequence already loaded, without encoding and uploading again the images
+        (only the patterns that changed are defined again, see DmdDeviceHID.updatelut).
+        """
+        if self.dmd.lut is None:
+            print("No sequence loaded, use load_pattern")
+            return
+        
+        lut = self.dmd.lut.copy()
+        num = len(lut)
+        lut['exposure'] = each_pattern(pattern_values(self.exposure_list.val, self.exposure.val), num)
+        lut['darktime'] = each_pattern(pattern_values(self.dark_time_list.val, self.dark_time.val), num)
+        lut['triggerin'] = self.trigger_input.val
+        lut['triggerout'] = self.trigger_output.val
+        
+        changed = self.dmd.updatelut(lut, self.repeat.val)
+        print(len(changed), "patterns updated")
+    
+    def timing_changed(self):
+        
+        if self.live_timing.val and hasattr(self, 'dmd') and self.dmd.lut is not None:
+            self.update_timing()
+    
     @QtCore.Slot()
     def start_sequence(self):
 
@@ -0,0 +1,243 @@
+"""
+Layout of the patterns of a sequence in the 24 bit images uploaded to the DMD.
+
+The pattern j of the LUT shows the bit bitpos of the image patind: by default
+defsequence puts pattern j in the bit j%24 of the image j//24, but a plane that
+is repeated in the sequence (e.g. calibration frames, or scans going back and
+forth) needs to be uploaded only once. PlaneLayout hashes each plane, keeps
+only the first one of the identical planes, and gives the position (image and
+bit) of the plane of each pattern:
+
+    layout = PlaneLayout()
+    planes = list(layout.unique(images)) #the planes to merge and upload
+    patind, bitpos = layout.positions()  #for each pattern of images
+
+The enhanced rle compresses a merged image well when its 24 planes have their
+edges in the same places (the runs of pixels and the rows copied from the previous
+one are broken by the edges of any plane). layout.pack(planes) changes the order
+of the planes uploaded, putting together the planes with similar edges (see
+pack_order), while the LUT still shows them in the order of the sequence.
+
+pack keeps the planes that come from an iterator as packed bits (PackedPlanes).
+The images of DMDPatterns.PatternFiles are read only when needed: select hashes
+them, and only the new ones are read again, when they are encoded.
+"""
+
+import hashlib
+import numpy
+
+SIGNATURE_LINES = 16 #rows (and columns) where the edges of a plane are sampled
+SIGNATURE_BIN = 8 #pixels of the same row (or column) put together in the signature
+
+def plane_key(image):
+    """
+    Hash of a binary plane (its shape and its pixels as booleans).
+    """
+    plane = numpy.ascontiguousarray(image, dtype = bool)
+    key = hashlib.blake2b(repr(plane.shape).encode(), digest_size = 20)
+    key.update(plane.view(numpy.uint8).data)
+
+    return key.digest()
+
+def _binned_edges(lines, size):
+    """
+    Edges along the lines (a 2d boolean array, one line per row), put together
+    size pixels at a time.
+    """
+    edges = lines[:,1:] != lines[:,:-1]
+    edges = numpy.pad(edges, ((0, 0), (0, -edges.shape[1] % size)))
+
+    return edges.reshape(len(edges), -1, size).any(axis = 2)
+
+def edge_signature(image):
+    """
+    Cheap description of where the edges of a plane are: the horizontal edges on
+    SIGNATURE_LINES rows and the vertical edges on SIGNATURE_LINES columns, each
+    one in a bin of SIGNATURE_BIN pixels. It is returned as packed bits (uint8).
+    """
+    plane = numpy.asarray(image, dtype = bool)
+    height, width = plane.shape
+    rows = numpy.linspace(0, height - 1, SIGNATURE_LINES).astype(int)
+    columns = numpy.linspace(0, width - 1, SIGNATURE_LINES).astype(int)
+    edges = numpy.concatenate((_binned_edges(plane[rows], SIGNATURE_BIN).ravel(),
+                               _binned_edges(plane[:,columns].T, SIGNATURE_BIN).ravel()))
+
+    return numpy.packbits(edges)
+
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype = numpy.int64)
+
+def _popcount(bits):
+
+    return POPCOUNT[bits].sum(axis = -1)
+
+def union_cost(signatures, order, groupsize = 24):
+    """
+    Edges of the merged images (the union of the edges of their planes) when the
+    planes are uploaded in order, summed on all the images.
+    """
+    cost = 0
+    for start in range(0, len(order), groupsize):
+        cost += int(_popcount(numpy.bitwise_or.reduce(signatures[order[start:start + groupsize]])))
+
+    return cost
+
+def pack_order(signatures, groupsize = 24):
+    """
+    Order of the planes (given their edge signatures, n x bytes) that puts in the
+    same image the planes with the same edges: each image is started with the first
+    plane left, and filled adding each time the plane that adds the fewest edges
+    to it. If this does not reduce the edges of the images, the order is not changed.
+    """
+    signatures = numpy.asarray(signatures, dtype = numpy.uint8)
+    num = len(signatures)
+    left = numpy.arange(num)
+    order = []
+
+    while len(left):
+        union = signatures[left[0]].copy()
+        group = [left[0]]
+        left = left[1:]
+        while len(group) < groupsize and len(left):
+            best = int(numpy.argmin(_popcount(signatures[left] | union))) #the first one if many are the same
+            union |= signatures[left[best]]
+            group.append(left[best])
+            left = numpy.delete(left, best)
+        order += group
+
+    order = [int(i) for i in order]
+    if union_cost(signatures, order, groupsize) >= union_cost(signatures, list(range(num)), groupsize):
+        return list(range(num))
+
+    return order
+
+class PackedPlanes:
+    """
+    Planes kept as packed bits (1/8 of the memory of the boolean images), in the
+    given order. As DMDPatterns.PatternFiles, iterating on them unpacks them in
+    order, and read(start, stop) unpacks the planes from start to stop.
+    """
+
+    def __init__(self, stored, shape, order = None):
+
+        self.stored = stored #packed bits of each plane
+        self.shape = shape
+        self.order = list(range(len(stored))) if order is None else order
+
+    def __len__(self):
+
+        return len(self.order)
+
+    def unpack(self, k):
+
+        return numpy.unpackbits(self.stored[self.order[k]], count = self.shape[0]*self.shape[1]).reshape(self.shape).view(bool)
+
+    def __iter__(self):
+
+        for k in range(len(self)):
+            yield self.unpack(k)
+
+    def read(self, start, stop):
+
+        return [self.unpack(k) for k in range(start, min(stop, len(self)))]
+
+class PlaneLayout:
+
+    def __init__(self, dedup = True):
+
+        self.dedup = dedup #if False every pattern has its own plane, as they come
+        self.keys = {} #hash of the plane: its slot, i.e. its index among the planes uploaded
+        self.slots = [] #slot of the plane of each pattern
+        self.planes = 0 #number of planes to upload
+
+    def __len__(self):
+
+        return len(self.slots)
+
+    @property
+    def duplicates(self):
+
+        return len(self.slots) - self.planes
+
+    def add(self, image):
+        """
+        Adds a pattern at the end of the sequence, and returns True if its plane
+        is new (it has to be uploaded) or False if it is already in the layout.
+        """
+        if self.dedup:
+            key = plane_key(image)
+            if key in self.keys:
+                self.slots.append(self.keys[key])
+                return False
+            self.keys[key] = self.planes
+
+        self.slots.append(self.planes)
+        self.planes += 1
+
+        return True
+
+    def unique(self, images):
+        """
+        Adds all the images, and yields the ones whose plane is new, in order
+        (it works also with an iterator, one image at a time).
+        """
+        for image in images:
+            if self.add(image):
+                yield image
+
+    def select(self, images):
+        """
+        Adds all the images of a sequence that reads them only when needed (e.g.
+        DMDPatterns.PatternFiles), and returns the indices of the ones whose plane is
+        new. Without dedup the images are not read at all.
+        """
+        if not self.dedup:
+            self.slots += range(self.planes, self.planes + len(images))
+            self.planes += len(images)
+            return list(range(len(images)))
+
+        return [i for i, image in enumerate(images) if self.add(image)]
+
+    def reorder(self, order):
+        """
+        Uploads the planes in a different order: order[k] is the plane (in the
+        order they were added) uploaded as k-th.
+        """
+        slot = numpy.empty(len(order), dtype = numpy.int64)
+        slot[numpy.asarray(order, dtype = numpy.int64)] = numpy.arange(len(order))
+        self.keys = {key: int(slot[s]) for key, s in self.keys.items()}
+        self.slots = [int(slot[s]) for s in self.slots]
+
+    def pack(self, planes, groupsize = 24):
+        """
+        Reorders the planes to upload (as yielded by unique) to reduce the size of
+        the encoded images, see pack_order, and returns them in the new order. All
+        the planes are needed before choosing the order: if they come from an
+        iterator they are kept as packed bits (1/8 of the memory of the boolean
+        images) and they are returned as PackedPlanes.
+        """
+        if hasattr(planes, '__len__'):
+            planes = list(planes)
+            order = pack_order([edge_signature(plane) for plane in planes], groupsize)
+            self.reorder(order)
+            return [planes[k] for k in order]
+
+        stored = []
+        signatures = []
+        shape = None
+        for plane in planes:
+            plane = numpy.asarray(plane, dtype = bool)
+            shape = plane.shape
+            stored.append(numpy.packbits(plane))
+            signatures.append(edge_signature(plane))
+        order = pack_order(signatures, groupsize)
+        self.reorder(order)
+
+        return PackedPlanes(stored, shape, order)
+
+    def positions(self):
+        """
+        Image (patind) and bit (bitpos) of the plane of each pattern, as arrays.
+        """
+        slots = numpy.array(self.slots, dtype = numpy.int64)
+
+        return slots//24, slots%24
@@ -0,0 +1,117 @@
+"""
+Pattern LUT of the DLPC900, built and checked before sending it.
+
+PatternLut collects the definitions of the patterns (exposure, bit depth, color,
+trigger in, dark time, trigger out, image index and bit position) and returns
+them as a numpy structured array (PATTERN), after checking that every value fits
+in its field. pattern_payloads packs all of them at once into the 12 bytes of
+the pattern definition command (see DMDPacking.pattern_entry), so that
+DmdDeviceHID.definepatterns can send the whole LUT back to back, reading the
+answers of the device only every few definitions.
+"""
+
+import numpy
+
+PATTERN = numpy.dtype([('exposure', '<u4'), ('bitdepth', 'u1'), ('color', 'u1'), ('triggerin', '?'),
+                       ('darktime', '<u4'), ('triggerout', '?'), ('patind', '<u2'), ('bitpos', 'u1')])
+
+#allowed values of each field, [min, max)
+LIMITS = {'exposure': (0, 1 << 24), 'bitdepth': (1, 9), 'color': (0, 8), 'triggerin': (0, 2),
+          'darktime': (0, 1 << 24), 'triggerout': (0, 2), 'patind': (0, 1 << 11), 'bitpos': (0, 24)}
+MAX_PATTERNS = (1 << 11) - 1 #the number of patterns of the LUT has 11 bits
+
+class PatternLut:
+
+    def __init__(self):
+
+        self.rows = []
+
+    def __len__(self):
+
+        return len(self.rows)
+
+    def add(self, exposure, bitdepth, color, triggerin, darktime, triggerout, patind, bitpos):
+        """
+        Adds a pattern at the end of the LUT (the arguments are the same of
+        DmdDeviceHID.definepattern, without the index).
+        """
+        if isinstance(color, str):
+            color = int(color, 2)
+        self.rows.append((int(exposure), int(bitdepth), int(color), int(bool(triggerin)),
+                          int(darktime), int(bool(triggerout)), int(patind), int(bitpos)))
+
+    @classmethod
+    def sequence(cls, exposure, triggerin, darktime, triggerout, bitdepth = 1, color = '111'):
+        """
+        LUT of a sequence of binary patterns, merged 24 by 24 in the images
+        (pattern j is the bit j%24 of the image j//24), as in defsequence.
+        """
+        lut = cls()
+        for j in range(len(exposure)):
+            lut.add(exposure[j], bitdepth, color, triggerin[j], darktime[j], triggerout[j], j//24, j%24)
+
+        return lut
+
+    def array(self):
+        """
+        The patterns as a PATTERN array. Raises a ValueError if a value does not
+        fit in its field, or if there are too many patterns.
+        """
+        if len(self.rows) > MAX_PATTERNS:
+            raise ValueError("{} patterns, the LUT can have at most {}".format(len(self.rows), MAX_PATTERNS))
+
+        columns = numpy.array(self.rows, dtype = numpy.int64).reshape(-1, len(PATTERN.names))
+        for i, name in enumerate(PATTERN.names):
+            check_field(name, columns[:,i])
+
+        entries = numpy.zeros(len(columns), dtype = PATTERN)
+        for i, name in enumerate(PATTERN.names):
+            entries[name] = columns[:,i]
+
+        return entries
+
+def check_field(name, values):
+    """
+    Raises a ValueError if one of the values of a field is out of its range.
+    """
+    low, high = LIMITS[name]
+    values = numpy.asarray(values)
+    wrong = numpy.flatnonzero((values < low) | (values >= high))
+    if len(wrong):
+        raise ValueError("pattern {}: {} = {} is out of range [{}, {})".format(
+            wrong[0], name, values[wrong[0]], low, high))
+
+def check_patterns(entries):
+    """
+    Checks the values of a PATTERN array (e.g. changed after PatternLut.array),
+    as PatternLut.array does. Returns the entries.
+    """
+    if len(entries) > MAX_PATTERNS:
+        raise ValueError("{} patterns, the LUT can have at most {}".format(len(entries), MAX_PATTERNS))
+    for name in PATTERN.names:
+        check_field(name, entries[name].astype(numpy.int64))
+
+    return entries
+
+def pattern_payloads(entries, indices = None):
+    """
+    Payloads of the pattern definition commands of the entries (a PATTERN array),
+    as a numpy.uint8 array of n x 12 bytes, the same of DMDPacking.pattern_entry.
+    The indices of the patterns are 0...n-1, unless they are given.
+    """
+    if indices is None:
+        indices = numpy.arange(len(entries))
+    indices = numpy.asarray(indices, dtype = numpy.uint32)
+    shifts = numpy.array([0, 8, 16], dtype = numpy.uint32)
+
+    payloads = numpy.zeros((len(entries), 12), dtype = numpy.uint8)
+    payloads[:,0:2] = indices[:,None] >> shifts[:2] & 0xff
+    payloads[:,2:5] = entries['exposure'][:,None] >> shifts & 0xff
+    payloads[:,5] = entries['triggerin'].astype(numpy.uint8) << 7 | entries['color'] << 4 | \
+        (entries['bitdepth'] - 1) << 1 | 0x01
+    payloads[:,6:9] = entries['darktime'][:,None] >> shifts & 0xff
+    payloads[:,9] = ~entries['triggerout']
+    position = entries['bitpos'].astype(numpy.uint32) << 11 | entries['patind']
+    payloads[:,10:12] = position[:,None] >> shifts[:2] & 0xff
+
+    return payloads
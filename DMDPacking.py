@@ -0,0 +1,105 @@
+"""
+Packing of the fields of the DLPC900 commands.
+
+The device classes used to build every payload by formatting the numbers as bit
+strings (convlen), concatenating them and converting them back to bytes
+(bitstobytes). Here the same fields are packed directly with struct and
+int.to_bytes (little endian, as the DLPC900 wants), with a couple of helpers for
+the fields that are not made of whole bytes (the options byte of a pattern and
+the 11+5 bits of the image index and bit position).
+
+The values are checked: a number that does not fit in its field raises a
+ValueError instead of making the payload longer, as convlen did.
+
+For the meaning of the fields, please refer to the DLPC900 programmer's guide.
+"""
+
+import struct
+
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+SETBMP = struct.Struct('<HI') #image index, image size
+LUT_CONFIG = struct.Struct('<HI') #number of patterns, number of repeats
+
+#compression of the encoded images (byte 25 of their header)
+UNCOMPRESSED = 0x00
+RLE = 0x01
+ENHANCED_RLE = 0x02
+
+def check_range(value, bits, name = 'value'):
+    """
+    Raises a ValueError if value does not fit in the given number of bits.
+    """
+    if not 0 <= value < 1 << bits:
+        raise ValueError("{} = {} does not fit in {} bits".format(name, value, bits))
+
+    return value
+
+def pack_uint(value, size):
+    """
+    Packs an unsigned integer in size bytes, little endian.
+    """
+    return int(check_range(int(value), 8*size)).to_bytes(size, 'little')
+
+def pack_u16(value):
+
+    return U16.pack(check_range(int(value), 16))
+
+def pack_u24(value):
+
+    return pack_uint(value, 3)
+
+def pack_u32(value):
+
+    return U32.pack(check_range(int(value), 32))
+
+def options_byte(bitdepth, color, triggerin):
+    """
+    Options byte of a pattern definition: bit 7 is the trigger in, bits 6-4 the
+    color (a bit string as '111' or an int), bits 3-1 the bit depth minus 1, and
+    bit 0 is always 1.
+    """
+    if isinstance(color, str):
+        color = int(color, 2)
+
+    return (bool(triggerin) << 7) | (check_range(color, 3, 'color') << 4) | \
+        (check_range(bitdepth - 1, 3, 'bitdepth - 1') << 1) | 0x01
+
+def pattern_position(patind, bitpos):
+    """
+    Last two bytes of a pattern definition: the index of the image (11 bits) and
+    the position of the bit plane in the 24 bit image (5 bits, the most significant).
+    """
+    return pack_u16((check_range(bitpos, 5, 'bitpos') << 11) | check_range(patind, 11, 'patind'))
+
+def pattern_entry(index, exposure, bitdepth, color, triggerin, darktime, triggerout, patind, bitpos):
+    """
+    The 12 bytes of the payload of the pattern definition command (0x1a34).
+    """
+    return pack_u16(index) + pack_u24(exposure) + \
+        bytes((options_byte(bitdepth, color, triggerin),)) + \
+        pack_u24(darktime) + bytes((int(not triggerout),)) + \
+        pattern_position(patind, bitpos)
+
+def lut_config(imgnum, repeatnum):
+    """
+    Payload of the LUT configuration command (0x1a31): the number of patterns
+    (11 bits) and the number of repeats (32 bits).
+    """
+    return LUT_CONFIG.pack(check_range(imgnum, 11, 'imgnum'), check_range(repeatnum, 32, 'repeatnum'))
+
+def setbmp_payload(index, size):
+    """
+    Payload of the command (0x1a2a) that announces the upload of an image:
+    the index of the image (5 bits) and its size in bytes.
+    """
+    return SETBMP.pack(check_range(index, 5, 'index'), check_range(size, 32, 'size'))
+
+def image_header(width, height, size, compression = ENHANCED_RLE):
+    """
+    Returns the 48 bytes of the header of an encoded image: after the size there
+    are 8 bytes of 0xff, the black curtain (4 bytes), and the compression
+    (UNCOMPRESSED, RLE or ENHANCED_RLE).
+    """
+    return b'Spld' + pack_u16(width) + pack_u16(height) + pack_u32(size) + \
+        b'\xff'*8 + b'\x00'*4 + bytes((0x00, compression, 0x01)) + b'\x00'*21
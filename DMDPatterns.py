@@ -0,0 +1,192 @@
+"""
+Reading of the pattern images from the disk.
+
+pattern_files finds the images of a sequence (a folder, a glob or a single file)
+and sorts them by the numbers in their names, so that pattern_9.png comes before
+pattern_10.png (there is no need any more to use names with the same number of
+digits). read_patterns is a generator that decodes the images in a pool of threads
+a few at a time, so that only a small window of images is in memory, and it can be
+passed directly to DmdDeviceHID.defsequence or encode_groups, which merge and
+encode the groups of 24 images as they arrive:
+
+    files = pattern_files("D:\\patterns\\light_sheet\\*.png")
+    n = len(files)
+    dmd.defsequence(read_patterns(files), [exposure]*n, [False]*n, [0]*n, [True]*n, 0)
+
+open_patterns does the same for any source, including a multi-page TIFF, and
+encoded_file finds the .encd file already saved for a folder of patterns, if any.
+For a list of files it returns a PatternFiles, which reads the images only when
+they are needed, also a group at a time: defsequence reads and encodes the groups
+starting from the last one (the DLPC900 wants them in reverse order), uploading
+each one while the next ones are read and encoded.
+"""
+
+import glob
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import PIL.Image
+import PIL.ImageSequence
+
+PATTERN_EXTENSIONS = ('.png', '.tif', '.tiff')
+STACK_EXTENSIONS = ('.tif', '.tiff')
+
+def numeric_key(path):
+    """
+    Key for sorting the names with numbers by their value (natural sort).
+    """
+    parts = re.split(r'(\d+)', os.path.basename(path))
+    parts[1::2] = [int(part) for part in parts[1::2]]
+
+    return parts
+
+def pattern_files(source, extensions = PATTERN_EXTENSIONS):
+    """
+    Returns the sorted list of the images of a sequence. source can be a folder
+    (all the files with the given extensions), a glob (as 'patterns/*_320.png')
+    or a single file.
+    """
+    source = os.fsdecode(source)
+
+    if os.path.isdir(source):
+        files = [os.path.join(source, name) for name in os.listdir(source)
+                 if name.lower().endswith(extensions)]
+    elif re.search(r'[*?[]', source):
+        files = glob.glob(source)
+    elif os.path.isfile(source):
+        files = [source]
+    else:
+        raise FileNotFoundError("No patterns found in {}".format(source))
+
+    return sorted(files, key = numeric_key)
+
+def as_pattern(pattern):
+    """
+    Boolean array of an image: a pixel is on if it is not 0 in any channel.
+    """
+    pattern = numpy.asarray(pattern)
+    if pattern.ndim == 3:
+        return pattern.any(axis = 2)
+
+    return pattern != 0 #not astype: the 1 bit images of PIL are bool arrays with 255 for True
+
+def read_pattern(path):
+    """
+    Reads an image as a boolean array (see as_pattern).
+    """
+    with PIL.Image.open(path) as image:
+        return as_pattern(image)
+
+def read_patterns(files, threads = 4, window = 32):
+    """
+    Generator of the images in files, in order. They are decoded by a pool of
+    threads, at most window images ahead of the one yielded.
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        try:
+            for path in files:
+                pending.append(pool.submit(read_pattern, path))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending: #if the generator is closed before the end
+                future.cancel()
+
+class PatternFiles:
+    """
+    The images of a list of files, read only when they are needed: iterating on
+    it reads them in order (see read_patterns), and read(start, stop) reads the
+    images from start to stop, in parallel.
+    """
+
+    def __init__(self, files, threads = 4, window = 32):
+
+        self.files = list(files)
+        self.threads = threads
+        self.window = window
+
+    def __len__(self):
+
+        return len(self.files)
+
+    def __iter__(self):
+
+        return read_patterns(self.files, self.threads, self.window)
+
+    def read(self, start, stop):
+
+        return list(read_patterns(self.files[start:stop], self.threads, self.window))
+
+    def subset(self, indices):
+        """
+        The images at the given indices, read only when they are needed too.
+        """
+        return PatternFiles([self.files[i] for i in indices], self.threads, self.window)
+
+def read_stack(path):
+    """
+    Generator of the pages of a multi-page TIFF, as boolean arrays.
+    """
+    with PIL.Image.open(path) as image:
+        for page in PIL.ImageSequence.Iterator(image):
+            yield as_pattern(page)
+
+def is_stack(source):
+
+    return os.path.isfile(source) and source.lower().endswith(STACK_EXTENSIONS)
+
+def open_patterns(source, threads = 4, window = 32):
+    """
+    Returns the number of patterns in source and the patterns: a generator of the
+    pages of a multi-page TIFF (a single page TIFF is a stack of one image), or a
+    PatternFiles for anything accepted by pattern_files.
+    """
+    source = os.fsdecode(source)
+
+    if is_stack(source):
+        with PIL.Image.open(source) as image:
+            num = getattr(image, 'n_frames', 1)
+        return num, read_stack(source)
+
+    files = pattern_files(source)
+
+    return len(files), PatternFiles(files, threads, window)
+
+def encoded_file(source):
+    """
+    Returns the .encd file to be loaded instead of encoding the patterns of source:
+    source itself if it is an .encd file, or, for a folder, the file saved in it by
+    DMDDeviceHID.save_encoded_sequence with the name of the folder, if it is newer
+    than all the images. Otherwise None.
+    """
+    source = os.fsdecode(source)
+
+    if source.lower().endswith('.encd') and os.path.isfile(source):
+        return source
+
+    if not os.path.isdir(source):
+        return None
+
+    folder = os.path.normpath(source)
+    path = os.path.join(folder, os.path.basename(folder) + '.encd')
+    if not is_up_to_date(path, pattern_files(folder)):
+        return None
+
+    return path
+
+def is_up_to_date(path, files):
+    """
+    True if the file at path exists and it is newer than all the files.
+    """
+    if not os.path.isfile(path):
+        return False
+
+    modified = os.path.getmtime(path)
+
+    return all(os.path.getmtime(name) <= modified for name in files)
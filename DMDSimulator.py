@@ -0,0 +1,354 @@
+"""
+Simulated DLPC900, to use DmdDeviceHID without the DMD (for benchmarks and
+tests). It replaces the hid.Device of the class:
+
+    dmd = DmdDeviceHID(device = SimulatedDevice())
+    dmd.defsequence(images, exposure, trigger_in, dark_time, trigger_out, 0)
+    dmd.device.pattern(5) #the bit plane shown as 6th pattern, decoded from the upload
+
+The 65 bytes reports written are put together in commands (flags, sequence byte,
+length, command and payload, as in DmdDeviceHID.frame_command), which are executed:
+the LUT configuration, the patterns defined, the images uploaded by setbmp and
+bmpload (decoded back into 24 bit images, unless decode is False), the mode and the
+state of the sequence are kept as attributes. When the command asks for an answer,
+the answer report is queued and returned by read.
+
+A latency can be added to every report written and to every read, and errors can
+be injected: each command fails with probability error_rate, and fail(n) makes the
+next n commands fail. A failed command has the error flag (0x20) in its answer, and
+as in the DLPC900 the error code register (command 0x0100) tells only about the
+last command executed: it is NO_ERROR again after a command that did not fail.
+"""
+
+import random
+import time
+from collections import Counter, deque
+import numpy
+from DMD_ScopeFoundry.DMDPacking import pack_u16, SETBMP, LUT_CONFIG, UNCOMPRESSED, RLE, ENHANCED_RLE
+
+#error codes, see the programmer's guide
+NO_ERROR = 0
+INVALID_COMMAND = 3
+INVALID_PARAMETER = 6
+INTERNAL_ERROR = 255
+
+class SimulatedDevice:
+
+    def __init__(self, latency = 0.0, read_latency = 0.0, error_rate = 0.0, error_code = INTERNAL_ERROR,
+                 seed = None, decode = True):
+
+        self.latency = latency #seconds for each report written
+        self.read_latency = read_latency #seconds for each read
+        self.error_rate = error_rate #probability that a command fails
+        self.error_code = error_code #code of the injected errors
+        self.random = random.Random(seed)
+        self.decode = decode #if False the uploaded images are kept encoded only
+        self.failures = 0
+
+        self.message = bytearray()
+        self.expected = None #length of the command being received
+        self.answers = deque()
+
+        self.reports = 0 #reports written
+        self.bytes_written = 0
+        self.counts = Counter() #commands executed, by code (com1 << 8 | com2)
+
+        self.mode = None
+        self.state = 'stop'
+        self.lut = None #(number of patterns, number of repeats)
+        self.patterns = {} #index: dictionary of the fields of the pattern definition
+        self.encoded = {} #index: encoded image uploaded
+        self.images = {} #index: decoded image, height x width x 3
+        self.upload = None #[index, size, data received] of the image being uploaded
+        self.errorcode = NO_ERROR
+        self.errortext = ''
+        self.testdata = b''
+
+    def fail(self, n = 1):
+        """
+        The next n commands fail.
+        """
+        self.failures += n
+
+    def write(self, data):
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.reports += 1
+        self.bytes_written += len(data)
+        report = bytes(data)[1:] #without the report id
+
+        if self.expected is None: #first report of a command
+            self.expected = 4 + (report[2] | report[3] << 8)
+        self.message += report
+
+        if len(self.message) >= self.expected:
+            message = bytes(self.message[:self.expected])
+            self.message.clear()
+            self.expected = None
+            self.execute(message)
+
+        return len(data)
+
+    def read(self, size, timeout = None):
+
+        if self.read_latency:
+            time.sleep(self.read_latency)
+
+        if not self.answers:
+            return b'' #as hid when the timeout expires
+
+        return self.answers.popleft()[:size]
+
+    def execute(self, message):
+        """
+        Executes a command, and queues its answer if it is asked for.
+        """
+        flags, sequencebyte = message[0], message[1]
+        code = message[5] << 8 | message[4]
+        payload = message[6:]
+        self.counts[code] += 1
+
+        answer = b''
+        error = None
+        try:
+            answer = self.handle(code, bool(flags & 0x80), payload)
+        except SimulatedError as failure:
+            error, self.errortext = failure.args
+
+        injectable = code not in (0x0100, 0x0101) #the error registers can always be read
+        if error is None and injectable and (self.failures or (self.error_rate and self.random.random() < self.error_rate)):
+            self.failures = max(self.failures - 1, 0)
+            error, self.errortext = self.error_code, 'injected error'
+
+        if injectable:
+            self.errorcode = NO_ERROR if error is None else error
+
+        if flags & 0x40:
+            head = bytes(((flags & 0xc0) | (0x20 if error is not None else 0), sequencebyte)) + pack_u16(len(answer))
+            report = head + answer
+            self.answers.append(report + bytes(-len(report) % 64))
+
+    def handle(self, code, read, payload):
+        """
+        Changes the state of the device for a command, and returns the data of
+        its answer. Raises SimulatedError if the command is not valid.
+        """
+        if code == 0x0100: #error code of the last command
+            return bytes((self.errorcode,))
+        if code == 0x0101: #error description
+            return self.errortext.encode()[:60]
+        if code == 0x1100: #test write and read
+            if read:
+                return self.testdata
+            self.testdata = bytes(payload)
+        elif code in (0x0200, 0x0201): #power mode, idle mode
+            check(len(payload) == 1, "missing parameter")
+        elif code == 0x1a1b: #display mode
+            check(len(payload) == 1 and payload[0] <= 3, "invalid mode")
+            self.mode = payload[0]
+        elif code == 0x1a24: #start, pause or stop the sequence
+            check(len(payload) == 1 and payload[0] <= 2, "invalid state")
+            if payload[0] == 2:
+                self.check_sequence()
+            self.state = ('stop', 'pause', 'start')[payload[0]]
+        elif code == 0x1a31: #LUT configuration
+            check(len(payload) == LUT_CONFIG.size, "invalid length")
+            self.lut = LUT_CONFIG.unpack(payload)
+        elif code == 0x1a34: #pattern definition
+            check(len(payload) == 12, "invalid length")
+            self.define(payload)
+        elif code == 0x1a2a: #image upload announced
+            check(len(payload) == SETBMP.size, "invalid length")
+            index, size = SETBMP.unpack(payload)
+            self.upload = [index, size, bytearray()]
+        elif code == 0x1a2b: #image upload
+            self.receive(payload)
+        else:
+            raise SimulatedError(INVALID_COMMAND, "unknown command 0x{:04x}".format(code))
+
+        return b''
+
+    def define(self, payload):
+
+        options = payload[5]
+        position = payload[10] | payload[11] << 8
+        index = payload[0] | payload[1] << 8
+        self.patterns[index] = {'exposure': int.from_bytes(payload[2:5], 'little'),
+                                'bitdepth': ((options >> 1) & 0x07) + 1,
+                                'color': (options >> 4) & 0x07,
+                                'triggerin': bool(options & 0x80),
+                                'darktime': int.from_bytes(payload[6:9], 'little'),
+                                'triggerout': not payload[9],
+                                'patind': position & 0x7ff,
+                                'bitpos': position >> 11}
+
+    def receive(self, payload):
+
+        check(self.upload is not None, "no image announced")
+        check(len(payload) >= 2, "invalid length")
+        length = payload[0] | payload[1] << 8
+        check(len(payload) >= 2 + length, "invalid length")
+
+        index, size, data = self.upload
+        data += payload[2:2 + length]
+        check(len(data) <= size, "more data than announced")
+
+        if len(data) == size:
+            self.upload = None
+            self.encoded[index] = bytes(data)
+            if self.decode:
+                try:
+                    self.images[index] = decode_image(self.encoded[index])
+                except (ValueError, IndexError):
+                    raise SimulatedError(INVALID_PARAMETER, "invalid image")
+
+    def check_sequence(self):
+
+        check(self.lut is not None, "LUT not configured")
+        for index in range(self.lut[0]):
+            check(index in self.patterns, "pattern {} not defined".format(index))
+            check(self.patterns[index]['patind'] in self.encoded,
+                  "image of pattern {} not uploaded".format(index))
+
+    def pattern(self, index):
+        """
+        Bit plane (boolean height x width) shown as the index-th pattern of the LUT.
+        """
+        definition = self.patterns[index]
+
+        return image_planes(self.images[definition['patind']])[definition['bitpos']]
+
+    def sequence(self):
+        """
+        All the bit planes of the LUT, in order.
+        """
+        return [self.pattern(index) for index in range(self.lut[0])]
+
+class SimulatedError(Exception):
+    """
+    Raised by the simulated device for an invalid command: args are the error
+    code and its description.
+    """
+
+def check(condition, text, code = INVALID_PARAMETER):
+
+    if not condition:
+        raise SimulatedError(code, text)
+
+def image_planes(image):
+    """
+    The 24 bit planes of an image (height x width x 3) as merged by
+    DmdDeviceHID.mergeimages: the bits of the third channel are the planes
+    0-7, the second channel 8-15 and the first 16-23.
+    """
+    packed = image[:,:,0].astype(numpy.uint32) << 16 | image[:,:,1].astype(numpy.uint32) << 8 | image[:,:,2]
+
+    return [(packed >> bit & 1).astype(bool) for bit in range(24)]
+
+def read_count(data, i):
+    """
+    Reads a count of the enhanced rle (1 or 2 bytes), returns it and the next position.
+    """
+    n = data[i]
+    if n & 0x80:
+        return (n & 0x7f) | (data[i + 1] << 7), i + 2
+
+    return n, i + 1
+
+def decode_image(data):
+    """
+    Decodes an encoded image (see DmdDeviceHID.encode_image), header included,
+    into a height x width x 3 numpy.uint8 array: uncompressed, rle or enhanced rle,
+    as written in its header.
+    """
+    if data[:4] != b'Spld':
+        raise ValueError("Invalid image header")
+    width = data[4] | data[5] << 8
+    height = data[6] | data[7] << 8
+
+    if data[25] == UNCOMPRESSED:
+        if len(data) < 48 + 3*width*height:
+            raise ValueError("The image has less than {} pixels".format(width*height))
+        return numpy.frombuffer(data, numpy.uint8, 3*width*height, 48).reshape(height, width, 3).copy()
+    if data[25] == RLE:
+        return decode_rle(data, width, height)
+    if data[25] != ENHANCED_RLE:
+        raise ValueError("Unsupported compression: {}".format(data[25]))
+
+    image = numpy.zeros((height, width, 3), dtype = numpy.uint8)
+    i = 48
+    row = 0
+    column = 0
+
+    while True:
+        if data[i] == 0:
+            if data[i + 1] == 0: #end of row
+                if column != width:
+                    raise ValueError("Row {} has {} pixels".format(row, column))
+                row += 1
+                column = 0
+                i += 2
+            elif data[i + 1] == 1: #copy from the previous row, or end of image
+                n, i = read_count(data, i + 2)
+                if n == 0:
+                    break
+                image[row, column:column + n] = image[row - 1, column:column + n]
+                column += n
+            else: #uncompressed pixels
+                n, i = read_count(data, i + 1)
+                image[row, column:column + n] = numpy.frombuffer(data, numpy.uint8, 3*n, i).reshape(n, 3)
+                column += n
+                i += 3*n
+        else: #repeated pixel
+            n, i = read_count(data, i)
+            image[row, column:column + n] = numpy.frombuffer(data, numpy.uint8, 3, i)
+            column += n
+            i += 3
+
+        if column > width:
+            raise ValueError("Row {} has more than {} pixels".format(row, width))
+
+    if row != height:
+        raise ValueError("The image has {} rows instead of {}".format(row, height))
+
+    return image
+
+def decode_rle(data, width, height):
+    """
+    Decodes the pixels of an image encoded with the rle (not enhanced).
+    """
+    image = numpy.zeros((height, width, 3), dtype = numpy.uint8)
+    i = 48
+    row = 0
+    column = 0
+
+    while True:
+        if data[i] == 0:
+            if data[i + 1] == 0: #end of row
+                if column != width:
+                    raise ValueError("Row {} has {} pixels".format(row, column))
+                row += 1
+                column = 0
+                i += 2
+            elif data[i + 1] == 1: #end of image
+                break
+            else: #uncompressed pixels
+                n = data[i + 1]
+                image[row, column:column + n] = numpy.frombuffer(data, numpy.uint8, 3*n, i + 2).reshape(n, 3)
+                column += n
+                i += 2 + 3*n
+        else: #repeated pixel
+            n = data[i]
+            image[row, column:column + n] = numpy.frombuffer(data, numpy.uint8, 3, i + 1)
+            column += n
+            i += 4
+
+        if column > width:
+            raise ValueError("Row {} has more than {} pixels".format(row, width))
+
+    if row != height:
+        raise ValueError("The image has {} rows instead of {}".format(row, height))
+
+    return image
@@ -0,0 +1,125 @@
+"""
+Timing of the operations of DmdDeviceHID.
+
+Each instrumented method of DmdDeviceHID (command, checkforerrors, definepattern,
+setbmp, bmpload, ...) records in dmd.stats, for every call, the time spent, the
+bytes and reports written to the DMD and the answers read (the round trips)
+during the call, nested calls included. Then:
+
+    dmd.stats.summary()               #count, times, percentiles, bytes, MB/s... of each operation
+    dmd.stats.histogram('bmpload')    #numpy.histogram of the times of the calls
+    print(dmd.stats.report())
+
+Only the last samples (maxlen) of each operation are kept, while the totals
+count all the calls since the last reset.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy
+
+class ProtocolStats:
+
+    def __init__(self, maxlen = 10000):
+
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        with self.lock:
+            self.bytes = 0 #written since the creation, by all the operations
+            self.reports = 0
+            self.reads = 0
+            self.samples = {} #name: deque of (time, bytes, reports, reads) of the last calls
+            self.totals = {} #name: [calls, time, bytes, reports, reads]
+
+    def written(self, nbytes, reports):
+
+        with self.lock:
+            self.bytes += nbytes
+            self.reports += reports
+
+    def read(self):
+
+        with self.lock:
+            self.reads += 1
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Records a call of the operation name, lasting as the with block.
+        """
+        start = (self.bytes, self.reports, self.reads)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t
+            sample = (duration, self.bytes - start[0], self.reports - start[1], self.reads - start[2])
+            with self.lock:
+                if name not in self.samples:
+                    self.samples[name] = deque(maxlen = self.maxlen)
+                    self.totals[name] = [0, 0.0, 0, 0, 0]
+                self.samples[name].append(sample)
+                total = self.totals[name]
+                total[0] += 1
+                for i in range(4):
+                    total[i + 1] += sample[i]
+
+    def times(self, name):
+        """
+        Times of the last calls of an operation, in seconds.
+        """
+        with self.lock:
+            return numpy.array([sample[0] for sample in self.samples.get(name, ())])
+
+    def histogram(self, name, bins = 20, log = True):
+        """
+        Histogram of the times of the last calls of an operation (counts and
+        edges of the bins in seconds, as numpy.histogram). With log = True the
+        bins are evenly spaced on a logarithmic scale.
+        """
+        times = self.times(name)
+        if log and len(times) and times.min() > 0:
+            bins = numpy.geomspace(times.min(), times.max()*(1 + 1e-9), bins + 1)
+
+        return numpy.histogram(times, bins)
+
+    def summary(self, name = None):
+        """
+        Statistics of an operation (of all the operations if name is None, as a
+        dictionary by name): number of calls, total time, mean, min, median, 90th and
+        99th percentile and max of the last calls, total bytes, reports and reads,
+        and the rate of the bytes written in MB/s. An operation never called has
+        a summary of zeros.
+        """
+        if name is None:
+            return {name: self.summary(name) for name in list(self.totals)}
+
+        with self.lock:
+            calls, total, nbytes, reports, reads = self.totals.get(name, (0, 0.0, 0, 0, 0))
+        times = self.times(name)
+        percentiles = numpy.percentile(times, [0, 50, 90, 99, 100]) if len(times) else [0.0]*5
+
+        return {'calls': calls, 'time': total, 'mean': total/calls if calls else 0.0,
+                'min': percentiles[0], 'median': percentiles[1], 'p90': percentiles[2],
+                'p99': percentiles[3], 'max': percentiles[4],
+                'bytes': nbytes, 'reports': reports, 'reads': reads,
+                'MB/s': nbytes/total/1e6 if total else 0.0}
+
+    def report(self):
+        """
+        The summary as a table, one operation per line.
+        """
+        lines = ['{:<20}{:>8}{:>11}{:>11}{:>11}{:>11}{:>12}{:>9}{:>9}'.format(
+            'operation', 'calls', 'total s', 'mean ms', 'p90 ms', 'max ms', 'bytes', 'reads', 'MB/s')]
+        for name, s in self.summary().items():
+            lines.append('{:<20}{:>8}{:>11.3f}{:>11.3f}{:>11.3f}{:>11.3f}{:>12}{:>9}{:>9.2f}'.format(
+                name, s['calls'], s['time'], 1e3*s['mean'], 1e3*s['p90'], 1e3*s['max'],
+                s['bytes'], s['reads'], s['MB/s']))
+
+        return '\n'.join(lines)
@@ -0,0 +1,13 @@
+"""
+The modules import each other as DMD_ScopeFoundry.X: this folder is registered
+as the DMD_ScopeFoundry package (it has no __init__.py), whatever the name of the
+checkout, so that the tests can be run with pytest from here.
+"""
+
+import os
+import sys
+import types
+
+package = types.ModuleType('DMD_ScopeFoundry')
+package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+sys.modules['DMD_ScopeFoundry'] = package
@@ -0,0 +1,91 @@
+"""
+Tests of the cache of the encoded images (DMDCache.EncodedCache) and of
+DMDDeviceHID.cached_encode, in a temporary folder: the images found in the cache
+are not encoded again, the least recently used ones are deleted when the cache is
+too big, and a file written while it is read is seen either whole or not at all.
+"""
+
+import os
+import threading
+import numpy
+from DMD_ScopeFoundry import DMDDeviceHID
+from DMD_ScopeFoundry.DMDCache import EncodedCache
+from DMD_ScopeFoundry.DMDDeviceHID import cached_encode, encode_image, encoded_key, mergeimages
+
+def merged(seed):
+
+    rng = numpy.random.default_rng(seed)
+
+    return mergeimages([rng.random((16, 40)) < 0.5 for _ in range(24)])
+
+def test_miss_and_hit(tmp_path, monkeypatch):
+
+    cache = EncodedCache(str(tmp_path))
+    image = merged(0)
+    encoded, size = cached_encode(image, cache)
+
+    assert cache.get(encoded_key(image)) is not None
+    assert os.listdir(tmp_path) == [encoded_key(image) + '.bin']
+    assert numpy.array_equal(encoded, encode_image(image)[0]) and size == len(encoded)
+
+    def encode(image):
+        raise AssertionError("encoded again")
+    monkeypatch.setattr(DMDDeviceHID, 'encode_image', encode)
+    found, found_size = cached_encode(image, cache)
+
+    assert found_size == size and numpy.array_equal(found, encoded)
+
+def test_encoder_version(tmp_path, monkeypatch):
+
+    image = merged(1)
+    key = encoded_key(image)
+    monkeypatch.setattr(DMDDeviceHID, 'ENCODER_VERSION', DMDDeviceHID.ENCODER_VERSION + 1)
+
+    assert encoded_key(image) != key
+    assert EncodedCache(str(tmp_path)).get(encoded_key(image)) is None
+
+def test_lru_eviction(tmp_path):
+
+    cache = EncodedCache(str(tmp_path), maxsize = 250)
+    for t, key in enumerate('abc'):
+        cache.put(key, numpy.full(100, t, dtype = numpy.uint8))
+        os.utime(cache.path(key), (1000 + t, 1000 + t))
+
+    assert sorted(os.listdir(tmp_path)) == ['b.bin', 'c.bin'] #a was the oldest
+    assert cache.size() == 200
+
+    assert cache.get('b')[1] == 100 #b is now the most recently used
+    cache.put('d', numpy.zeros(100, dtype = numpy.uint8))
+
+    assert sorted(os.listdir(tmp_path)) == ['b.bin', 'd.bin']
+    assert cache.get('c') is None
+    assert numpy.array_equal(cache.get('b')[0], numpy.full(100, 1))
+
+def test_concurrent_writers(tmp_path):
+    #two versions of different size written again and again with the same key
+    cache = EncodedCache(str(tmp_path))
+    versions = [numpy.full(4000, 1, dtype = numpy.uint8), numpy.full(10000, 2, dtype = numpy.uint8)]
+    done = threading.Event()
+
+    def write(version):
+        while not done.is_set():
+            cache.put('key', version)
+
+    writers = [threading.Thread(target = write, args = (version,)) for version in versions]
+    for writer in writers:
+        writer.start()
+    try:
+        seen = set()
+        for _ in range(2000):
+            found = cache.get('key')
+            if found is not None:
+                encoded, size = found
+                assert any(numpy.array_equal(encoded, version) for version in versions)
+                seen.add(size)
+    finally:
+        done.set()
+        for writer in writers:
+            writer.join()
+
+    assert seen
+    assert os.listdir(tmp_path) == ['key.bin'] #no temporary file left
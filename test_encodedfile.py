@@ -0,0 +1,123 @@
+"""
+Tests of the version 2 .encd files (DMDEncodedFile): the groups written are read
+back as they were, the old pickled files are converted without changes, and the
+broken files raise a ValueError. The sequences saved are loaded on the simulated
+device by def_sequence_by_file, straight from the mapped groups.
+"""
+
+import os
+import numpy
+import pytest
+from DMD_ScopeFoundry.DMDEncodedFile import (EncodedFile, write_encoded, convert_legacy, load_legacy,
+                                             is_encoded_file, HEADER, ENTRY)
+from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID, save_encoded_sequence
+from DMD_ScopeFoundry.DMDSimulator import SimulatedDevice
+
+LEGACY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pattern', '2019-01-25-12-20-56', '0001.encd')
+
+def groups(sizes):
+
+    rng = numpy.random.default_rng(len(sizes))
+
+    return [rng.integers(0, 256, size, dtype = numpy.uint8) for size in sizes]
+
+@pytest.mark.parametrize('kind', ['array', 'bytes', 'list', 'generator'])
+def test_write_read(tmp_path, kind):
+
+    path = str(tmp_path / 'sequence.encd')
+    encoded = groups([1000, 0, 70000, 4])
+    given = {'array': encoded, 'bytes': [bytes(e) for e in encoded],
+             'list': [list(numpy.uint8(x) for x in e) for e in encoded], #as in the old files
+             'generator': (e for e in encoded)}[kind]
+    write_encoded(path, 80, given)
+
+    assert is_encoded_file(path)
+    with EncodedFile(path) as file:
+        assert file.num == 80 and len(file) == 4
+        assert file.sizes == [1000, 0, 70000, 4]
+        assert [bytes(group) for group in file] == [bytes(e) for e in encoded]
+        assert bytes(file[2][:10]) == bytes(encoded[2][:10])
+
+def test_write_sizes(tmp_path):
+    #only the first sizes[i] bytes of each group are written
+    path = str(tmp_path / 'sequence.encd')
+    encoded = groups([100, 200])
+    write_encoded(path, 30, encoded, [60, 200])
+
+    with EncodedFile(path) as file:
+        assert bytes(file[0]) == bytes(encoded[0][:60]) and bytes(file[1]) == bytes(encoded[1])
+
+def test_wrong_number_of_groups(tmp_path):
+
+    path = str(tmp_path / 'sequence.encd')
+    with pytest.raises(ValueError):
+        write_encoded(path, 49, groups([10, 10]))
+
+    assert os.listdir(tmp_path) == [] #not even the temporary file
+
+def test_convert_legacy(tmp_path):
+
+    num, encodedimages, sizes = load_legacy(LEGACY)
+    path = convert_legacy(LEGACY, str(tmp_path / 'converted.encd'))
+
+    assert not is_encoded_file(LEGACY) and is_encoded_file(path)
+    assert os.path.getsize(path) < os.path.getsize(LEGACY)
+    with EncodedFile(path) as file:
+        assert file.num == num and file.sizes == list(sizes)
+        for group, encoded, size in zip(file, encodedimages, sizes):
+            assert bytes(group) == bytes(bytearray(encoded[:size]))
+
+def test_truncated(tmp_path):
+
+    path = str(tmp_path / 'sequence.encd')
+    write_encoded(path, 48, groups([500, 300]))
+    length = os.path.getsize(path)
+
+    for size in (length - 1, HEADER.size + 2*ENTRY.size, HEADER.size + ENTRY.size, HEADER.size - 1, 0):
+        with open(path, 'r+b') as file:
+            file.truncate(size)
+        with pytest.raises(ValueError, match = "truncated|not an encoded sequence"):
+            EncodedFile(path)
+
+def test_wrong_magic(tmp_path):
+
+    path = str(tmp_path / 'sequence.encd')
+    write_encoded(path, 24, groups([100]))
+    with open(path, 'r+b') as file:
+        file.write(b'ENCX')
+
+    with pytest.raises(ValueError, match = "ENCX"):
+        EncodedFile(path)
+
+def test_wrong_version(tmp_path):
+
+    path = str(tmp_path / 'sequence.encd')
+    write_encoded(path, 24, groups([100]))
+    with open(path, 'r+b') as file:
+        file.seek(4)
+        file.write(b'\x03\x00')
+
+    with pytest.raises(ValueError, match = "version 3"):
+        EncodedFile(path)
+
+def test_load_file(tmp_path):
+
+    rng = numpy.random.default_rng(0)
+    images = [rng.random((16, 40)) < 0.5 for _ in range(30)]
+    save_encoded_sequence(images, str(tmp_path) + os.sep, 'sequence', workers = 1)
+
+    dmd = DmdDeviceHID(device = SimulatedDevice())
+    dmd.def_sequence_by_file(str(tmp_path / 'sequence.encd'), [1000], [False], [0], [True], 0)
+
+    for k in range(30):
+        assert numpy.array_equal(dmd.device.pattern(k), images[k])
+
+def test_load_converted(tmp_path):
+    #the same images are uploaded from the old file and from the converted one
+    uploaded = []
+    for path in (LEGACY, convert_legacy(LEGACY, str(tmp_path / 'converted.encd'))):
+        dmd = DmdDeviceHID(device = SimulatedDevice())
+        dmd.def_sequence_by_file(path, [1000], [False], [0], [True], 0)
+        uploaded.append(dmd.device.encoded)
+
+    assert uploaded[0] == uploaded[1] and len(uploaded[0]) == len(load_legacy(LEGACY)[2])
@@ -0,0 +1,194 @@
+"""
+Tests of the encoders of DmdDeviceHID: the numba and numpy backends of new_encode
+give the same bytes, which are the ones of the pixel by pixel new_encode_loop (on
+small images, since it takes tens of seconds on a full frame), and every encoded
+image is decoded back by DMDSimulator.decode_image. The .encd files in pattern/
+are encoded again from their decoded images, giving the same bytes.
+"""
+
+import glob
+import os
+import numpy
+import pytest
+from DMD_ScopeFoundry import DMDDeviceHID
+from DMD_ScopeFoundry.DMDDeviceHID import (new_encode, new_encode_loop, encode_image,
+                                           enhanced_rle_size, mergeimages, numba)
+from DMD_ScopeFoundry.DMDPacking import UNCOMPRESSED, RLE, ENHANCED_RLE
+from DMD_ScopeFoundry.DMDEncodedFile import load_legacy
+from DMD_ScopeFoundry.DMDSimulator import decode_image
+
+PATTERNS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pattern')
+ENCODED_FILES = sorted(glob.glob(os.path.join(PATTERNS, '**', '*.encd'), recursive = True) +
+                       glob.glob(os.path.join(PATTERNS, '.encd')))
+BACKENDS = ['numpy', pytest.param('numba', marks = pytest.mark.skipif(numba is None, reason = "numba is not installed"))]
+
+HEIGHT, WIDTH = 1080, 1920
+
+def hadamard_planes(height, width, cell = 8):
+    """
+    24 rows of a 1024x1024 hadamard matrix (Sylvester), each one folded in a
+    32x32 tile of cell x cell pixels repeated on the image.
+    """
+    y, x = numpy.mgrid[:height, :width]
+    column = (y//cell % 32)*32 + x//cell % 32
+    planes = []
+    for row in range(1, 25):
+        bits = numpy.bitwise_and(row*37 % 1024, column)
+        parity = numpy.zeros_like(bits)
+        while bits.any():
+            parity ^= bits & 1
+            bits >>= 1
+        planes.append(parity.astype(bool))
+
+    return planes
+
+def frames():
+
+    rng = numpy.random.default_rng(1)
+    x = numpy.arange(WIDTH)
+
+    return {
+        'random': [rng.random((HEIGHT, WIDTH)) < 0.5 for _ in range(24)],
+        'black': [numpy.zeros((HEIGHT, WIDTH), dtype = bool)]*24,
+        'white': [numpy.ones((HEIGHT, WIDTH), dtype = bool)]*24,
+        'stripes': [numpy.broadcast_to(x//(k + 1) % 2 == 0, (HEIGHT, WIDTH)) for k in range(24)],
+        'hadamard': hadamard_planes(HEIGHT, WIDTH),
+        'sparse': [rng.random((HEIGHT, WIDTH)) < 0.02 for _ in range(24)],
+        }
+
+FRAMES = frames()
+
+def small_images():
+    """
+    Small images with a few colors, so that there are runs, literals and rows
+    copied from the previous one, also the shortest ones.
+    """
+    rng = numpy.random.default_rng(2)
+    images = []
+    for height, width in [(1, 1), (1, 2), (2, 1), (2, 3), (3, 4), (4, 7), (5, 16), (8, 130), (3, 300)]:
+        for colors in (1, 2, 3, 256):
+            images.append(rng.integers(0, colors, (height, width, 3), dtype = numpy.uint8))
+    for _ in range(20):
+        height, width = rng.integers(1, 12, 2)
+        image = rng.integers(0, 2, (height, width, 3), dtype = numpy.uint8)
+        image[rng.random(height) < 0.3] = image[0] #rows equal to the first one
+        images.append(image)
+
+    return images
+
+SMALL = small_images()
+
+@pytest.fixture(scope = 'module', params = list(FRAMES))
+def merged(request):
+
+    return mergeimages(FRAMES[request.param])
+
+@pytest.mark.skipif(numba is None, reason = "numba is not installed")
+def test_numba_matches_numpy(merged):
+
+    encoded, size = new_encode(merged, 'numpy')
+    fast, fast_size = new_encode(merged, 'numba')
+
+    assert size == fast_size == len(encoded) == len(fast)
+    assert numpy.array_equal(encoded, fast)
+
+def test_size_without_writing(merged):
+
+    assert enhanced_rle_size(merged, 'numpy') == new_encode(merged, 'numpy')[1]
+
+@pytest.mark.parametrize('compression', [None, UNCOMPRESSED, RLE, ENHANCED_RLE])
+def test_decode_frame(merged, compression):
+
+    encoded, size = encode_image(merged, compression)
+
+    assert size == len(encoded) and size % 4 == 0
+    assert numpy.array_equal(decode_image(bytes(encoded)), merged)
+
+def test_smallest_compression(merged):
+
+    sizes = [encode_image(merged, compression)[1] for compression in (UNCOMPRESSED, RLE, ENHANCED_RLE)]
+
+    assert encode_image(merged)[1] == min(sizes)
+
+def invariant_images():
+    #images of invariant_encode, also narrow ones, where the rle can be the smallest
+    rng = numpy.random.default_rng(3)
+    images = []
+    for height, width in [(2, 2), (3, 10), (50, 130), (50, 200), (40, 300), (20, 1920)]:
+        for colors in (1, 2, 256):
+            row = rng.integers(0, colors, (1, width, 3), dtype = numpy.uint8)
+            column = rng.integers(0, colors, (height, 1, 3), dtype = numpy.uint8)
+            images += [numpy.repeat(row, height, 0), numpy.repeat(column, width, 1)]
+
+    return images
+
+@pytest.mark.parametrize('image', invariant_images(), ids = lambda image: '{}x{}'.format(*image.shape[:2]))
+def test_smallest_compression_invariant(image):
+
+    sizes = [encode_image(image, compression)[1] for compression in (UNCOMPRESSED, RLE, ENHANCED_RLE)]
+    encoded, size = encode_image(image)
+
+    assert size == min(sizes)
+    assert numpy.array_equal(decode_image(bytes(encoded)), image)
+
+def test_rle_stream():
+    """
+    The rle (compression 0x01) written by hand as in the DLPC900 programmer's guide:
+    n (1-255) and a pixel repeated n times, 0x00 n (2-255) and n different pixels,
+    0x00 0x00 at the end of each row and 0x00 0x01 at the end of the image. The
+    pixels are written as their 3 bytes in the image (as new_encode_loop does).
+    """
+    width = 300
+    A, B, C, D, E, F = [bytes((k, 2*k, 3*k)) for k in range(10, 16)]
+    distinct = [bytes((0, k >> 8, k & 0xff)) for k in range(width)]
+    rows = [[A]*300, [B, C, D] + [E]*296 + [F], distinct]
+    image = numpy.frombuffer(b''.join(b''.join(row) for row in rows), dtype = numpy.uint8).reshape(3, width, 3)
+
+    data = b'\xff' + A + b'\x2d' + A + b'\x00\x00'
+    data += b'\x00\x03' + B + C + D + b'\xff' + E + b'\x29' + E + b'\x01' + F + b'\x00\x00'
+    data += b'\x00\xff' + b''.join(distinct[:255]) + b'\x00\x2d' + b''.join(distinct[255:]) + b'\x00\x00'
+    data += b'\x00\x01'
+    size = 48 + len(data) + -(48 + len(data)) % 4
+    header = b'Spld' + bytes((width & 0xff, width >> 8, 3, 0)) + size.to_bytes(4, 'little') + \
+        b'\xff'*8 + b'\x00'*4 + b'\x00\x01\x01' + b'\x00'*21
+    expected = header + data + bytes(size - 48 - len(data))
+
+    encoded, encoded_size = encode_image(image, RLE)
+
+    assert size == 992 and encoded_size == size
+    assert bytes(encoded) == expected
+    assert numpy.array_equal(decode_image(expected), image)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('path', ENCODED_FILES, ids = lambda path: os.path.relpath(path, PATTERNS))
+def test_shipped_files(path, backend):
+    #the groups of these files were encoded by the original (pixel by pixel) encoder
+    num, encodedimages, sizes = load_legacy(path)
+    for group, size in zip(encodedimages, sizes):
+        data = bytes(bytearray(group))
+        encoded, encoded_size = new_encode(decode_image(data), backend)
+        assert encoded_size == size
+        assert bytes(encoded) == data
+
+@pytest.mark.parametrize('image', SMALL, ids = lambda image: '{}x{}'.format(*image.shape[:2]))
+def test_small_images(image):
+
+    reference, size = new_encode_loop(image)
+    encoded, encoded_size = new_encode(image, 'numpy')
+
+    assert size == encoded_size
+    assert reference == encoded.tolist()
+    assert numpy.array_equal(decode_image(bytes(encoded)), image)
+    if numba is not None:
+        assert numpy.array_equal(new_encode(image, 'numba')[0], encoded)
+
+def test_pointer_jumping(monkeypatch):
+    #the rows with many runs are encoded with pointer jumping: here it is used for all of them
+    monkeypatch.setattr(DMDDeviceHID, 'RUN_PASSES', 1)
+    monkeypatch.setattr(DMDDeviceHID, 'JUMP_PASSES', -1)
+
+    for image in SMALL + [mergeimages(FRAMES['sparse'])]:
+        encoded, size = new_encode(image, 'numpy')
+        assert numpy.array_equal(decode_image(bytes(encoded)), image)
+        if image.size < 10000:
+            assert new_encode_loop(image)[0] == encoded.tolist()
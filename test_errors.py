@@ -0,0 +1,127 @@
+"""
+Tests of the error checking of DmdDeviceHID on the simulated device, with errors
+injected in a single command: the error code register of the DLPC900 tells only
+about the last command, so the commands sent back to back must have their answers
+checked one by one. updatelut sends only the patterns that changed.
+"""
+
+import numpy
+import pytest
+from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID, MAX_ANSWERS
+from DMD_ScopeFoundry.DMDLut import PatternLut
+from DMD_ScopeFoundry.DMDSimulator import SimulatedDevice, NO_ERROR, INTERNAL_ERROR
+
+class FailingDevice(SimulatedDevice):
+    """
+    The n-th command with the given code fails (n from 1), and the answers waiting
+    to be read are counted. The images uploaded are random bytes, not decoded.
+    """
+    def __init__(self, code = None, n = 0):
+
+        super().__init__(decode = False)
+        self.failing = (code, n)
+        self.waiting = 0
+
+    def execute(self, message):
+
+        code = message[5] << 8 | message[4]
+        if (code, self.counts[code] + 1) == self.failing:
+            self.fail()
+        super().execute(message)
+        self.waiting = max(self.waiting, len(self.answers))
+
+def image(size):
+
+    return numpy.random.default_rng(size).integers(0, 256, size, dtype = numpy.uint8)
+
+def test_last_command_only():
+
+    dmd = DmdDeviceHID(device = SimulatedDevice())
+    dmd.device.fail()
+    dmd.idle_on()
+    assert dmd.errorcode() == INTERNAL_ERROR
+
+    dmd.device.fail()
+    dmd.idle_on()
+    dmd.idle_off()
+    assert dmd.errorcode() == NO_ERROR
+
+@pytest.mark.parametrize('ackwindow', [0, 1, 4, 100])
+def test_bmpload(ackwindow):
+
+    data = image(504*10 + 100)
+    dmd = DmdDeviceHID(device = FailingDevice())
+    dmd.setbmp(0, len(data))
+
+    assert not dmd.bmpload(data, len(data), ackwindow)
+    assert dmd.device.encoded[0] == bytes(data)
+    assert not dmd.device.answers #all the answers were read
+    assert dmd.device.waiting <= min(ackwindow or MAX_ANSWERS, MAX_ANSWERS)
+
+@pytest.mark.parametrize('packet', [1, 6, 8, 11])
+def test_bmpload_middle_packet(packet):
+    #with a window of 4 packets, 6 is in the middle of the second one
+    data = image(504*10 + 100)
+    dmd = DmdDeviceHID(device = FailingDevice(0x1a2b, packet))
+    dmd.setbmp(0, len(data))
+
+    assert dmd.bmpload(data, len(data), 4)
+    assert dmd.device.counts[0x1a2b] == min(packet + 3 - (packet - 1) % 4, 11) #stopped at the end of the window
+    assert not dmd.device.answers
+
+def test_upload_again():
+
+    data = image(504*10 + 100)
+    dmd = DmdDeviceHID(device = FailingDevice(0x1a2b, 6))
+    dmd.ackwindow = 4
+    dmd.uploadimage(3, data, len(data))
+
+    assert dmd.device.counts[0x1a2b] == 8 + 11
+    assert dmd.device.encoded[3] == bytes(data)
+
+def sequence_lut(num):
+
+    return PatternLut.sequence([1000 + j for j in range(num)], [False]*num, [j % 7 for j in range(num)], [True]*num)
+
+@pytest.mark.parametrize('entry', [1, 17, 40, 75])
+def test_definepatterns_middle_entry(entry):
+
+    lut = sequence_lut(75)
+    dmd = DmdDeviceHID(device = FailingDevice(0x1a34, entry))
+
+    assert dmd.definepatterns(lut)
+    assert dmd.device.counts[0x1a34] == min(-(-entry//MAX_ANSWERS)*MAX_ANSWERS, 75) + 75 #defined again one by one
+    assert not dmd.device.answers
+    for j in range(75):
+        assert dmd.device.patterns[j]['exposure'] == 1000 + j and dmd.device.patterns[j]['darktime'] == j % 7
+
+def test_definepatterns():
+
+    dmd = DmdDeviceHID(device = FailingDevice())
+
+    assert not dmd.definepatterns(sequence_lut(75))
+    assert dmd.device.counts[0x1a34] == 75
+    assert not dmd.device.answers
+    assert [dmd.device.patterns[j]['bitpos'] for j in range(75)] == [j % 24 for j in range(75)]
+
+def test_updatelut():
+
+    images = [numpy.random.default_rng(j).random((8, 16)) < 0.5 for j in range(30)]
+    dmd = DmdDeviceHID(device = SimulatedDevice())
+    dmd.defsequence(images, [1000]*30, [False]*30, [0]*30, [True]*30, 0, workers = 1)
+    defined = dmd.device.counts[0x1a34]
+    uploaded = dmd.device.counts[0x1a2b]
+
+    exposure = [1000]*30
+    exposure[3] = exposure[21] = 2000
+    sent = dmd.updatelut(PatternLut.sequence(exposure, [False]*30, [0]*30, [True]*30))
+
+    assert list(sent) == [3, 21]
+    assert dmd.device.counts[0x1a34] == defined + 2
+    assert dmd.device.counts[0x1a2b] == uploaded
+    assert [dmd.device.patterns[j]['exposure'] for j in range(30)] == exposure
+    for j in range(30):
+        assert numpy.array_equal(dmd.device.pattern(j), images[j])
+
+    assert list(dmd.updatelut(PatternLut.sequence(exposure, [False]*30, [0]*30, [True]*30))) == []
+    assert dmd.device.counts[0x1a34] == defined + 2
@@ -0,0 +1,168 @@
+"""
+Tests of frame_command: the hid reports of a command are the same ones written
+by the old DmdDeviceHID.command, which appended the header and the payload to a
+list byte by byte (legacy_command below is that code, writing to a list).
+"""
+
+import numpy
+import pytest
+from DMD_ScopeFoundry.DMDDeviceHID import (DmdDeviceHID, frame_command, convlen, bitstobytes,
+                                           REPORT_SIZE)
+
+def legacy_command(mode,sequencebyte,com1,com2,data):
+    reports = []
+    buffer = []
+
+    flagstring=''
+    if mode=='r':
+        flagstring+='1'
+    else:
+        flagstring+='0'
+    flagstring+='1000000' #the one indicates we want an answer by the device.
+    buffer.append(0x0)
+    buffer.append(bitstobytes(flagstring)[0])
+    buffer.append(sequencebyte)
+    temp=bitstobytes(convlen(len(data)+2,16))
+    buffer.append(temp[0])
+    buffer.append(temp[1])
+    buffer.append(com2)
+    buffer.append(com1)
+
+    if len(buffer)+len(data)<=65: #65 = max number of sent bytes
+
+        for i in data:
+            buffer.append(i)
+
+        for i in range(65-len(buffer)):
+            buffer.append(0x00)
+
+        reports.append(bytes(buffer))
+
+    else:
+        for i in range(65-len(buffer)):
+            buffer.append(data[i])
+
+        reports.append(bytes(buffer))
+
+        buffer = [0x00]
+
+        j=0
+        while j<len(data)-58:
+            buffer.append(data[j+58])
+            j=j+1
+            if j%64==0: #we need 64 instead of 65
+                reports.append(bytes(buffer))
+
+                buffer = [0x00]
+
+        if j%64!=0:
+
+            while j%64!=0:
+                buffer.append(0x00)
+                j=j+1
+
+            reports.append(bytes(buffer))
+
+    return reports
+
+def legacy_bmpload(image,size):
+    reports = []
+    packnum=int(size//504)+1
+    counter=0
+
+    for i in range(packnum):
+        payload=[]
+
+        if i<packnum-1:
+            leng=convlen(504,16)
+            bits=504
+        else:
+            leng=convlen(size%504,16)
+            bits=size%504
+
+        leng=bitstobytes(leng)
+
+        for j in range(2):
+            payload.append(leng[j])
+
+        for j in range(bits):
+            payload.append(image[counter])
+            counter+=1
+
+        reports += legacy_command('w',0x11,0x1a,0x2b,payload)
+
+    return reports
+
+class Recorder:
+    """
+    Keeps the reports written, and answers every read with no error.
+    """
+    def __init__(self):
+
+        self.reports = []
+
+    def write(self, data):
+
+        self.reports.append(bytes(data))
+
+        return len(data)
+
+    def read(self, size, timeout = None):
+
+        return bytes(size)
+
+def split(frames):
+
+    assert len(frames) % REPORT_SIZE == 0
+
+    return [bytes(frames[i:i + REPORT_SIZE]) for i in range(0, len(frames), REPORT_SIZE)]
+
+LENGTHS = list(range(300)) + [504, 506, 1000, 4096]
+
+@pytest.mark.parametrize('mode', ['r', 'w'])
+def test_frames_match_legacy(mode):
+
+    rng = numpy.random.default_rng(0)
+    for length in LENGTHS:
+        data = rng.integers(0, 256, length, dtype = numpy.uint8)
+        expected = legacy_command(mode, 0x11, 0x1a, 0x2b, data.tolist())
+        for payload in (data.tolist(), bytes(data), bytearray(data), memoryview(bytes(data)), data):
+            assert split(frame_command(mode, 0x11, 0x1a, 0x2b, payload)) == expected, (length, type(payload))
+
+def test_prefix_and_reused_frames():
+
+    rng = numpy.random.default_rng(1)
+    frames = None
+    for length in (504, 504, 100, 0):
+        data = rng.integers(0, 256, length, dtype = numpy.uint8)
+        prefix = bytes((length & 0xff, length >> 8))
+        frames = frame_command('w', 0x11, 0x1a, 0x2b, data, prefix, frames)
+        assert split(frames) == legacy_command('w', 0x11, 0x1a, 0x2b, list(prefix) + data.tolist())
+
+def test_no_answer():
+
+    data = bytes(range(100))
+    frames = split(frame_command('w', 0x00, 0x1a, 0x34, data, answer = False))
+    expected = legacy_command('w', 0x00, 0x1a, 0x34, list(data))
+
+    assert frames[0][1] == expected[0][1] & ~0x40
+    assert frames[0][2:] == expected[0][2:] and frames[1:] == expected[1:]
+
+def test_command_stream():
+
+    dmd = DmdDeviceHID(device = Recorder())
+    dmd.command('r', 0x22, 0x02, 0x00, [])
+    dmd.command('w', 0x00, 0x1a, 0x1b, [0x01])
+    dmd.command('w', 0x00, 0x1a, 0x31, list(range(6)))
+
+    assert dmd.device.reports == legacy_command('r', 0x22, 0x02, 0x00, []) + \
+        legacy_command('w', 0x00, 0x1a, 0x1b, [0x01]) + legacy_command('w', 0x00, 0x1a, 0x31, list(range(6)))
+
+@pytest.mark.parametrize('size', [4, 500, 504, 1008, 5000])
+def test_bmpload_stream(size):
+
+    image = numpy.random.default_rng(size).integers(0, 256, size, dtype = numpy.uint8)
+    dmd = DmdDeviceHID(device = Recorder())
+    dmd.bmpload(image, size, ackwindow = 1)
+
+    assert dmd.device.reports == legacy_bmpload(image.tolist(), size)
@@ -0,0 +1,147 @@
+"""
+Tests of DMDPacking: the fields are packed in the same bytes that the device
+classes got from the bit strings of convlen and bitstobytes (the legacy_ functions
+below are the old code of DmdDeviceHID), for all the values of the small fields
+and for a sample of the others. The values out of range raise a ValueError.
+"""
+
+import numpy
+import pytest
+from DMD_ScopeFoundry.DMDDeviceHID import convlen, bitstobytes
+from DMD_ScopeFoundry.DMDPacking import (pack_u16, pack_u24, pack_u32, options_byte, pattern_position,
+                                         pattern_entry, lut_config, setbmp_payload, image_header,
+                                         UNCOMPRESSED, RLE, ENHANCED_RLE)
+
+def legacy(value, bits):
+
+    return bytes(bitstobytes(convlen(value, bits)))
+
+def legacy_options(bitdepth, color, triggerin):
+
+    optionsbyte='1'
+    optionsbyte=convlen(bitdepth-1,3)+optionsbyte
+    optionsbyte=color+optionsbyte
+    if triggerin:
+        optionsbyte='1'+optionsbyte
+    else:
+        optionsbyte='0'+optionsbyte
+
+    return bitstobytes(optionsbyte)[0]
+
+def legacy_pattern(index, exposure, bitdepth, color, triggerin, darktime, triggerout, patind, bitpos):
+
+    payload=[]
+    payload+=bitstobytes(convlen(index,16))
+    payload+=bitstobytes(convlen(exposure,24))
+    payload.append(legacy_options(bitdepth, color, triggerin))
+    payload+=bitstobytes(convlen(darktime,24))
+    payload+=bitstobytes(convlen(not triggerout,8))
+    payload+=bitstobytes(convlen(bitpos,5)+convlen(patind,11))
+
+    return bytes(payload)
+
+def legacy_lut(imgnum, repeatnum):
+
+    return bytes(bitstobytes(convlen(repeatnum,32)+'00000'+convlen(imgnum,11)))
+
+def legacy_setbmp(index, size):
+
+    return bytes(bitstobytes('0'*11+convlen(index,5))+bitstobytes(convlen(size,32)))
+
+def legacy_header(width, height, size):
+
+    header = [0x53, 0x70, 0x6c, 0x64]
+    header += bitstobytes(convlen(width,16))
+    header += bitstobytes(convlen(height,16))
+    header += bitstobytes(convlen(size,32))
+    header += [0xff]*8
+    header += [0x00]*4 ## black curtain
+    header += [0x00, 0x02, 0x01] ## enhanced rle
+    header += [0x00]*21
+
+    return bytes(header)
+
+def sample(bits, n = 5000):
+    #the edges of the range, the powers of 2 with their neighbours, and random values
+    top = (1 << bits) - 1
+    values = {0, 1, top - 1, top}
+    for k in range(bits):
+        values |= {(1 << k) - 1, 1 << k, (1 << k) + 1}
+    values |= set(numpy.random.default_rng(bits).integers(0, top, n, endpoint = True).tolist())
+
+    return sorted(v for v in values if v <= top)
+
+def test_u16():
+
+    for value in range(1 << 16):
+        assert pack_u16(value) == legacy(value, 16)
+
+@pytest.mark.parametrize('bits, pack', [(24, pack_u24), (32, pack_u32)])
+def test_u24_u32(bits, pack):
+
+    for value in sample(bits):
+        assert pack(value) == legacy(value, bits)
+
+def test_options_byte():
+
+    for bitdepth in range(1, 9):
+        for color in range(8):
+            for triggerin in (False, True):
+                expected = legacy_options(bitdepth, convlen(color, 3), triggerin)
+                assert options_byte(bitdepth, convlen(color, 3), triggerin) == expected
+                assert options_byte(bitdepth, color, triggerin) == expected
+
+def test_pattern_position():
+
+    for bitpos in range(32):
+        for patind in range(1 << 11):
+            assert pattern_position(patind, bitpos) == bytes(bitstobytes(convlen(bitpos, 5) + convlen(patind, 11)))
+
+def test_pattern_entry():
+
+    rng = numpy.random.default_rng(0)
+    exposures = sample(24, 200)
+    for _ in range(5000):
+        fields = (int(rng.integers(0, 400)), exposures[rng.integers(len(exposures))], int(rng.integers(1, 9)),
+                  convlen(int(rng.integers(0, 8)), 3), bool(rng.integers(2)), exposures[rng.integers(len(exposures))],
+                  bool(rng.integers(2)), int(rng.integers(0, 2048)), int(rng.integers(0, 24)))
+        assert pattern_entry(*fields) == legacy_pattern(*fields)
+        assert len(pattern_entry(*fields)) == 12
+
+def test_lut_config():
+
+    repeats = sample(32, 50)
+    for imgnum in range(1 << 11):
+        for repeatnum in repeats[imgnum % len(repeats)::len(repeats)//4]:
+            assert lut_config(imgnum, repeatnum) == legacy_lut(imgnum, repeatnum)
+
+def test_setbmp_payload():
+
+    for index in range(32):
+        for size in sample(32, 200):
+            assert setbmp_payload(index, size) == legacy_setbmp(index, size)
+
+def test_image_header():
+
+    for width, height in ((1920, 1080), (1, 1), (2716, 1600), (65535, 65535)):
+        for size in sample(32, 50):
+            header = image_header(width, height, size)
+            assert header == legacy_header(width, height, size)
+            for compression in (UNCOMPRESSED, RLE, ENHANCED_RLE):
+                other = image_header(width, height, size, compression)
+                assert len(other) == 48 and other[25] == compression
+                assert other[:25] == header[:25] and other[26:] == header[26:]
+
+@pytest.mark.parametrize('call', [
+    lambda: pack_u16(1 << 16), lambda: pack_u16(-1), lambda: pack_u24(1 << 24), lambda: pack_u32(1 << 32),
+    lambda: options_byte(0, 7, False), lambda: options_byte(9, 7, False), lambda: options_byte(1, 8, False),
+    lambda: pattern_position(1 << 11, 0), lambda: pattern_position(0, 32),
+    lambda: lut_config(1 << 11, 0), lambda: lut_config(1, 1 << 32),
+    lambda: setbmp_payload(32, 0), lambda: setbmp_payload(0, 1 << 32),
+    lambda: pattern_entry(0, 1 << 24, 1, '111', False, 0, False, 0, 0),
+    lambda: image_header(1 << 16, 1080, 0),
+    ])
+def test_out_of_range(call):
+
+    with pytest.raises(ValueError):
+        call()
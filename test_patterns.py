@@ -0,0 +1,165 @@
+"""
+Tests of the reading of the patterns from the disk (DMDPatterns) and of their
+encoding a group at a time: the groups of a PatternFiles are read starting from
+the last one, and the first one is uploaded while the others are still read.
+"""
+
+import threading
+from concurrent.futures import Future
+import numpy
+import PIL.Image
+import pytest
+from DMD_ScopeFoundry import DMDDeviceHID
+from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID, encode_groups, encode_stream, mergeimages, encode_image
+from DMD_ScopeFoundry.DMDPatterns import PatternFiles, pattern_files, open_patterns
+from DMD_ScopeFoundry.DMDSimulator import SimulatedDevice
+
+HEIGHT, WIDTH = 24, 40
+
+def save_patterns(folder, num, seed = 0):
+
+    rng = numpy.random.default_rng(seed)
+    images = [rng.random((HEIGHT, WIDTH)) < 0.3 for _ in range(num)]
+    for i, image in enumerate(images):
+        PIL.Image.fromarray(image).save(folder / 'pattern_{}.png'.format(i))
+
+    return images
+
+class ReadLog(PatternFiles):
+    """
+    Keeps the start of each group read.
+    """
+    def __init__(self, files, log):
+
+        super().__init__(files)
+        self.log = log
+
+    def read(self, start, stop):
+
+        self.log.append(start)
+
+        return super().read(start, stop)
+
+    def subset(self, indices):
+
+        return ReadLog([self.files[i] for i in indices], self.log)
+
+def test_pattern_files(tmp_path):
+
+    images = save_patterns(tmp_path, 30)
+    num, patterns = open_patterns(tmp_path)
+    files = pattern_files(tmp_path)
+
+    assert num == 30 and isinstance(patterns, PatternFiles) and len(patterns) == 30
+    assert files[:3] == [str(tmp_path / 'pattern_{}.png'.format(i)) for i in range(3)] #9 before 10
+    assert all(numpy.array_equal(a, b) for a, b in zip(patterns, images))
+    assert all(numpy.array_equal(a, b) for a, b in zip(patterns.read(24, 30), images[24:]))
+    assert all(numpy.array_equal(a, images[i]) for a, i in zip(patterns.subset([5, 1]), [5, 1]))
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_encode_last_group_first(tmp_path, workers):
+
+    images = save_patterns(tmp_path, 60)
+    log = []
+    patterns = ReadLog(pattern_files(tmp_path), log)
+
+    encoded = encode_groups(patterns, workers, reverse = True)
+    index, data, size, duration = next(encoded)
+    if workers == 1:
+        assert log == [48] #only the last group was read
+    rest = list(encoded)
+
+    assert log == [48, 24, 0]
+    assert [index] + [r[0] for r in rest] == [2, 1, 0]
+    for index, data, size, duration in [(index, data, size, duration)] + rest:
+        assert numpy.array_equal(data, encode_image(mergeimages(images[24*index:24*index + 24]))[0])
+
+class UploadEvents(SimulatedDevice):
+    """
+    Sets uploading when the first image is announced (setbmp).
+    """
+    def __init__(self):
+
+        super().__init__()
+        self.uploading = threading.Event()
+
+    def execute(self, message):
+
+        if message[5] << 8 | message[4] == 0x1a2a:
+            self.uploading.set()
+
+        return super().execute(message)
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_upload_while_reading(tmp_path, dedup):
+
+    images = save_patterns(tmp_path, 72)
+    device = UploadEvents()
+    uploading = []
+
+    class Waiting(PatternFiles):
+        #the first group is read only after the upload of the last one has started
+        def read(self, start, stop):
+            if start == 0:
+                uploading.append(device.uploading.wait(10))
+            return super().read(start, stop)
+
+        def subset(self, indices):
+            return Waiting([self.files[i] for i in indices])
+
+    dmd = DmdDeviceHID(device = device)
+    dmd.defsequence(Waiting(pattern_files(tmp_path)), [1000]*72, [False]*72, [0]*72, [True]*72, 0,
+                    workers = 1, dedup = dedup)
+
+    assert uploading == [True]
+    for k in range(72):
+        assert numpy.array_equal(device.pattern(k), images[k])
+
+def test_pack_files(tmp_path):
+    #the packed planes of the files are read again a group at a time
+    images = save_patterns(tmp_path, 30)
+    images += images[:10]
+    for k in range(30, 40):
+        PIL.Image.fromarray(images[k]).save(tmp_path / 'pattern_{}.png'.format(k))
+    device = SimulatedDevice()
+
+    dmd = DmdDeviceHID(device = device)
+    dmd.defsequence(PatternFiles(pattern_files(tmp_path)), [1000]*40, [False]*40, [0]*40, [True]*40, 0,
+                    workers = 1, pack = True)
+
+    for k in range(40):
+        assert numpy.array_equal(device.pattern(k), images[k])
+
+class Pool:
+    #records the processes asked for, without starting them
+    sizes = []
+
+    def __init__(self, workers):
+
+        self.sizes.append(workers)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        return False
+
+    def submit(self, function, *args):
+
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+def test_workers_per_group(monkeypatch):
+
+    monkeypatch.setattr(DMDDeviceHID, 'ProcessPoolExecutor', Pool)
+    Pool.sizes = []
+    images = [numpy.zeros((HEIGHT, WIDTH), dtype = bool)]*30
+
+    assert len(list(encode_stream(iter(images), workers = 8))) == 2
+    assert len(list(encode_stream(iter(images[:24]), workers = 8))) == 1
+    assert len(list(encode_groups(PatternFiles([]), workers = 8))) == 0
+
+    assert Pool.sizes == [2]
@@ -0,0 +1,165 @@
+"""
+Tests of DmdDeviceHID.defsequence on the simulated device: the images uploaded
+are decoded back by DMDSimulator, and every pattern of the LUT must show the plane
+of the frame at its place in the sequence, whatever the way the frames are given
+(a list, an iterator or files read when needed), the number of workers, and
+with or without dedup and pack.
+"""
+
+import numpy
+import PIL.Image
+import pytest
+from DMD_ScopeFoundry.DMDDeviceHID import DmdDeviceHID
+from DMD_ScopeFoundry.DMDPatterns import PatternFiles
+from DMD_ScopeFoundry.DMDSimulator import SimulatedDevice
+
+HEIGHT, WIDTH = 16, 40
+
+def sequence_frames(num = 60):
+    """
+    Vertical stripes shifted by one pixel each time, alternated with random
+    frames, and the first 10 frames again at the end.
+    """
+    rng = numpy.random.default_rng(num)
+    x = numpy.arange(WIDTH)
+    frames = []
+    for k in range(num - 10):
+        if k % 2:
+            frames.append(rng.random((HEIGHT, WIDTH)) < 0.5)
+        else:
+            frames.append(numpy.broadcast_to((x + k//2)//16 % 2 == 0, (HEIGHT, WIDTH)).copy())
+
+    return frames + frames[:10]
+
+def given(frames, kind, folder):
+
+    if kind == 'list':
+        return list(frames)
+    if kind == 'iterator':
+        return iter(frames)
+
+    files = []
+    for k, frame in enumerate(frames):
+        files.append(str(folder / 'pattern_{}.png'.format(k)))
+        PIL.Image.fromarray(frame).save(files[-1])
+
+    return PatternFiles(files)
+
+class UploadOrder(SimulatedDevice):
+    """
+    Keeps the index of each image announced by setbmp.
+    """
+    def __init__(self):
+
+        super().__init__()
+        self.announced = []
+
+    def handle(self, code, read, payload):
+
+        answer = super().handle(code, read, payload)
+        if code == 0x1a2a:
+            self.announced.append(self.upload[0])
+
+        return answer
+
+def load(frames, kind, folder, **options):
+
+    num = len(frames)
+    dmd = DmdDeviceHID(device = UploadOrder())
+    dmd.defsequence(given(frames, kind, folder), [1000]*num, [False]*num, [0]*num, [True]*num, 0, **options)
+
+    return dmd
+
+def check_sequence(dmd, frames):
+
+    device = dmd.device
+    assert device.lut[0] == len(frames) and len(device.patterns) == len(frames)
+    for k, frame in enumerate(frames):
+        assert numpy.array_equal(device.pattern(k), frame), k
+
+def position(dmd, k):
+
+    return dmd.device.patterns[k]['patind'], dmd.device.patterns[k]['bitpos']
+
+@pytest.mark.parametrize('pack', [False, True])
+@pytest.mark.parametrize('dedup', [False, True])
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('kind', ['list', 'iterator', 'files'])
+def test_defsequence(tmp_path, kind, workers, dedup, pack):
+
+    frames = sequence_frames()
+    dmd = load(frames, kind, tmp_path, workers = workers, dedup = dedup, pack = pack)
+
+    check_sequence(dmd, frames)
+    assert dmd.device.announced == [2, 1, 0] #the last group first
+    assert not dmd.device.answers
+    assert dmd.timings['first upload'] is not None and len(dmd.timings['upload']) == 3
+    #the last 10 frames are the first ones again
+    assert [position(dmd, 50 + k) == position(dmd, k) for k in range(10)] == [dedup]*10
+    assert len({position(dmd, k) for k in range(60)}) == (50 if dedup else 60)
+
+@pytest.mark.parametrize('kind', ['list', 'iterator', 'files'])
+def test_repeated_frames(tmp_path, kind):
+    #10 frames shown 5 times fit in a single image
+    frames = sequence_frames(20)[:10]*5
+    dmd = load(frames, kind, tmp_path, workers = 2)
+
+    check_sequence(dmd, frames)
+    assert dmd.device.announced == [0]
+    assert [position(dmd, k) for k in range(50)] == [(0, k % 10) for k in range(50)]
+
+@pytest.mark.parametrize('kind', ['list', 'iterator', 'files'])
+def test_pack(tmp_path, kind):
+    #the stripes go together in the first image, the random frames in the others
+    frames = sequence_frames()
+    plain = load(frames, 'list', tmp_path, workers = 1)
+    dmd = load(frames, kind, tmp_path, workers = 1, pack = True)
+
+    check_sequence(dmd, frames)
+    stripes = [position(dmd, k) for k in range(0, 50, 2)]
+    assert len(stripes) == 25 and sum(image == 0 for image, bit in stripes) == 24
+    assert len(set(stripes)) == 25
+    assert [position(dmd, k) for k in range(5)] == [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]
+    assert sum(map(len, dmd.device.encoded.values())) < sum(map(len, plain.device.encoded.values()))
+
+@pytest.mark.parametrize('num', [1, 24, 25])
+def test_group_sizes(tmp_path, num):
+
+    frames = sequence_frames(60)[:num]
+    dmd = load(frames, 'list', tmp_path, workers = 1, dedup = False)
+
+    check_sequence(dmd, frames)
+    assert dmd.device.announced == list(range((num + 23)//24))[::-1]
+
+@pytest.mark.parametrize('dedup, pack', [(False, False), (True, True)])
+def test_updatelut(tmp_path, dedup, pack):
+    #the new exposures keep the images and bits of the layout of defsequence
+    frames = sequence_frames()
+    dmd = load(frames, 'list', tmp_path, workers = 1, dedup = dedup, pack = pack)
+    dmd.startsequence()
+    uploaded = dmd.device.counts[0x1a2b]
+    defined = dmd.device.counts[0x1a34]
+
+    lut = dmd.lut.copy()
+    lut['exposure'][[5, 40]] = 3000
+    lut['darktime'][59] = 100
+
+    assert list(dmd.updatelut(lut)) == [5, 40, 59]
+    assert dmd.device.state == 'start' #started again
+    assert dmd.device.counts[0x1a34] == defined + 3 and dmd.device.counts[0x1a2b] == uploaded
+    assert [dmd.device.patterns[k]['exposure'] for k in (4, 5, 40)] == [1000, 3000, 3000]
+    assert dmd.device.patterns[59]['darktime'] == 100
+    check_sequence(dmd, frames)
+
+def test_updatelut_longer(tmp_path):
+    #the patterns added can show any plane already uploaded, but only those
+    frames = sequence_frames()
+    dmd = load(frames, 'list', tmp_path, workers = 1, dedup = False)
+    lut = numpy.concatenate((dmd.lut, dmd.lut[:2]))
+
+    assert list(dmd.updatelut(lut)) == [60, 61]
+    check_sequence(dmd, frames + frames[:2])
+
+    lut['patind'][61] = 3
+    with pytest.raises(ValueError):
+        dmd.updatelut(lut)
@@ -0,0 +1,25 @@
+"""
+Tests of ProtocolStats.
+"""
+
+from DMD_ScopeFoundry.DMDStats import ProtocolStats
+
+def test_summary():
+
+    stats = ProtocolStats()
+    with stats.measure('bmpload'):
+        stats.written(130, 2)
+        stats.read()
+
+    summary = stats.summary('bmpload')
+    assert summary['calls'] == 1 and summary['bytes'] == 130 and summary['reports'] == 2 and summary['reads'] == 1
+    assert list(stats.summary()) == ['bmpload']
+
+def test_summary_not_called():
+    #e.g. the bmpload of a load where nothing was uploaded
+    stats = ProtocolStats()
+    summary = stats.summary('bmpload')
+
+    assert summary['calls'] == 0 and summary['MB/s'] == 0.0 and summary['bytes'] == 0
+    assert stats.summary() == {}
+    assert len(stats.report().splitlines()) == 1